@@ -19,7 +19,7 @@ from offlineimap.repository import Repository
 from offlineimap.ui import getglobalui
 from offlineimap.threadutil import InstanceLimitedThread
 from subprocess import Popen, PIPE
-from threading import Event
+from threading import Event, Lock
 import os
 from sys import exc_info
 import traceback
@@ -190,6 +190,9 @@ class SyncableAccount(Account):
         self._lockfd = None
         self._lockfilepath = os.path.join(self.config.getmetadatadir(),
                                           "%s.lock" % self)
+        # names of the remote folders being synced, see syncfolder()
+        self._syncingfolders = set()
+        self._syncinglock = Lock()
 
     def lock(self):
         """Lock the account, throwing an exception if it is locked already"""
@@ -215,6 +218,27 @@ class SyncableAccount(Account):
             except OSError:
                 pass #Failed to delete for some reason.
 
+    def startfoldersync(self, foldername):
+        """Note that the remote folder foldername is being synced
+
+        The main sync, IDLE and watch threads may all want to sync a
+        folder, only one of them may do so at a time.
+        :returns: False if the folder is being synced already"""
+        self._syncinglock.acquire()
+        try:
+            if foldername in self._syncingfolders:
+                return False
+            self._syncingfolders.add(foldername)
+            return True
+        finally:
+            self._syncinglock.release()
+
+    def endfoldersync(self, foldername):
+        """Note that syncing foldername is done, see startfoldersync()"""
+        self._syncinglock.acquire()
+        self._syncingfolders.discard(foldername)
+        self._syncinglock.release()
+
     def syncrunner(self):
         self.ui.registerthread(self)
         accountmetadata = self.getaccountmeta()
@@ -285,6 +309,10 @@ class SyncableAccount(Account):
             localrepos = self.localrepos
             statusrepos = self.statusrepos
 
+            # open the connections up front (possibly all of them)
+            remoterepos.connect()
+            localrepos.connect()
+
             # init repos with list of folders, so we have them (and the
             # folder delimiter etc)
             remoterepos.getfolders()
@@ -354,6 +382,21 @@ class SyncableAccount(Account):
         except Exception as e:
             self.ui.error(e, exc_info()[2], msg = "Calling hook")
 
+def _retrydeletes(account, folders):
+    """Retry the deletes that failed during a folder sync
+
+    They are only removed from the status folder once they succeed, so
+    an error just leaves them for the next sync."""
+    ui = getglobalui()
+    if Account.abort_NOW_signal.is_set():
+        return
+    for folder in folders:
+        try:
+            folder.commitdeletes()
+        except Exception as e:
+            ui.error(e, exc_info()[2], msg = "Deleting messages in "
+                     "folder '%s' [acc: '%s']" % (folder, account))
+
 def syncfolder(account, remotefolder, quick):
     """This function is called as target for the
     InstanceLimitedThread invokation in SyncableAccount.
@@ -365,6 +408,10 @@ def syncfolder(account, remotefolder, quick):
 
     ui = getglobalui()
     ui.registerthread(account)
+    statusfolder = None
+    syncing = False
+    # the deletes are not retried if committing them failed
+    committing = False
     try:
         # Load local folder.
         localfolder = localrepos.\
@@ -381,6 +428,12 @@ def syncfolder(account, remotefolder, quick):
         # Write the mailboxes
         mbnames.add(account.name, localfolder.getname())
 
+        syncing = account.startfoldersync(remotefolder.getname())
+        if not syncing:
+            ui.debug('', "Not syncing folder '%s', another thread is "
+                     "syncing it already" % remotefolder)
+            return
+
         # Load status folder.
         statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().\
                                              replace(remoterepos.getsep(),
@@ -448,7 +501,12 @@ def syncfolder(account, remotefolder, quick):
             ui.debug('', "Not syncing to read-only repository '%s'" \
                          % remoterepos.getname())
 
-        statusfolder.save()
+        # Delete the messages collected by both sync directions at once
+        committing = True
+        localfolder.commitdeletes()
+        remotefolder.commitdeletes()
+        localfolder.save_quickstatus()
+        remotefolder.save_quickstatus()
         localrepos.restore_atime()
     except (KeyboardInterrupt, SystemExit):
         raise
@@ -466,7 +524,21 @@ def syncfolder(account, remotefolder, quick):
                     # we reconstruct foldername above rather than using
                     # localfolder, as the localfolder var is not
                     # available if assignment fails.
+            if statusfolder is not None and not committing:
+                _retrydeletes(account, (localfolder, remotefolder))
     except Exception as e:
         ui.error(e, msg = "ERROR in syncfolder for %s folder %s: %s" % \
                 (account, remotefolder.getvisiblename(),
                  traceback.format_exc()))
+        if statusfolder is not None and not committing:
+            _retrydeletes(account, (localfolder, remotefolder))
+    finally:
+        try:
+            if statusfolder is not None:
+                # Status backends may defer writes, flush them even if the
+                # sync got aborted, so we don't lose track of copied
+                # messages.
+                statusfolder.save()
+        finally:
+            if syncing:
+                account.endfoldersync(remotefolder.getname())
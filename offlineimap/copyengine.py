@@ -0,0 +1,405 @@
+# Pipelined copying of messages between folders
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+from threading import Event, Lock, local
+import time
+try:
+    from Queue import Queue, Full
+except ImportError: # python3
+    from queue import Queue, Full
+from sys import exc_info
+from offlineimap import imaputil, threadutil, OfflineImapError
+from offlineimap.ui import getglobalui
+import offlineimap.accounts
+
+
+def getcopyworkers(folder):
+    """Number of threads that should work on copying from/to `folder`
+
+    Folders that don't suggest threads get a single worker, all others
+    as many as their copy instance limit (maxconnections) permits."""
+    if not folder.suggeststhreads():
+        return 1
+    return threadutil.getInstanceLimit(folder.getcopyinstancelimit())
+
+def getcopysemaphore(folder):
+    """The semaphore bounding the copy threads working on the repository
+    of `folder` at once, across all folders being synced, or None"""
+    if not folder.suggeststhreads():
+        return None
+    return threadutil.getInstanceSemaphore(folder.getcopyinstancelimit())
+
+def getadaptivelimit(folder):
+    """The threadutil.AdaptiveLimit of the copy workers of `folder`,
+    or None if their number is fixed"""
+    if not folder.suggeststhreads():
+        return None
+    return threadutil.getAdaptiveLimit(folder.getcopyinstancelimit())
+
+
+class CopyEngine(object):
+    """Copy messages from one folder to another in pipelined stages
+
+    1) fetch: a few threads get the flags and bodies from the source.
+    2) store: a few threads save them in the destination folder.
+    3) status: the thread invoking :meth:`run` records the results in
+       the status folder and renames source UIDs where needed.
+
+    The stages are connected by bounded queues, so only a few message
+    bodies are held in memory at any time, whatever the folder size.
+    Threads are long-lived, so IMAP connections and their SELECTed
+    folder are reused from one message to the next.
+
+    The fetch and store threads of all folders copying from or to a
+    repository share its copy instance limit (maxconnections), taken
+    for each chunk or batch they process. If the repository has
+    adaptiveconnections set, only as many of them work at once as its
+    threadutil.AdaptiveLimit permits, which is fed with the duration,
+    size and throttling of each chunk or batch."""
+
+    chunksize = 200
+    """Number of messages handed to a fetch thread at once"""
+
+    batchbytes = 10 * 1024 * 1024
+    """Max total size of the messages handed to a store thread at once"""
+
+    def __init__(self, srcfolder, dstfolder, statusfolder):
+        self.src = srcfolder
+        self.dst = dstfolder
+        self.status = statusfolder
+        self.ui = getglobalui()
+        self.fetchers = getcopyworkers(srcfolder)
+        self.storers = getcopyworkers(dstfolder)
+        self._sems = {'fetch': getcopysemaphore(srcfolder),
+                      'store': getcopysemaphore(dstfolder)}
+        self._limits = {'fetch': getadaptivelimit(srcfolder),
+                        'store': getadaptivelimit(dstfolder)}
+        # the stage whose limits a worker thread holds, see _put()
+        self._held = local()
+        self.savebatchsize = dstfolder.getsavebatchsize()
+        self._fetchq = Queue()
+        self._storeq = Queue(2 * self.storers)
+        self._statusq = Queue(2 * self.storers)
+        self._lock = Lock()
+        self._running = {}
+        self._abort = Event()
+        self._error = None
+
+    def _worker(self, stage, inq, process, outq, nextsentinels):
+        """Body of fetch and store threads
+
+        Consume items from inq until receiving a None sentinel. The
+        last thread of a stage to finish passes nextsentinels sentinels
+        on to outq. Once aborted, items are drained but not processed."""
+        self.ui.registerthread(self.src.repository.account)
+        if stage == 'fetch':
+            folder = self.src
+        else:
+            folder = self.dst
+        try:
+            while True:
+                item = inq.get()
+                if item is None:
+                    break
+                if self._abort.is_set():
+                    if stage == 'store':
+                        self._closebatch(*item)
+                    continue
+                self._acquire(stage)
+                throttles = folder.getthrottlecount()
+                start, nbytes = time.time(), 0
+                try:
+                    nbytes = process(*item)
+                finally:
+                    self._release(stage, time.time() - start, nbytes or 0,
+                                  folder.getthrottlecount() > throttles)
+        finally:
+            self._lock.acquire()
+            try:
+                self._running[stage] -= 1
+                last = not self._running[stage]
+            finally:
+                self._lock.release()
+            if last:
+                for i in range(nextsentinels):
+                    outq.put(None)
+
+    def _acquire(self, stage):
+        """Take the limits of the repository stage works on"""
+        if self._sems[stage] is not None:
+            self._sems[stage].acquire()
+        if self._limits[stage] is not None:
+            self._limits[stage].acquire()
+        self._held.stage = stage
+        self._held.waited = 0.0
+
+    def _release(self, stage, seconds, nbytes, throttled):
+        """Hand back the limits taken by _acquire()
+
+        :param seconds: how long the chunk or batch took, including the
+            time spent waiting in _put()"""
+        self._held.stage = None
+        if self._limits[stage] is not None:
+            self._limits[stage].release(seconds - self._held.waited, nbytes,
+                                        throttled)
+        if self._sems[stage] is not None:
+            self._sems[stage].release()
+
+    def _put(self, queue, item):
+        """Put item on one of the bounded queues between the stages
+
+        While waiting for room, the calling thread hands back the
+        limits of its stage. Otherwise e.g. fetch threads waiting for
+        their store stage could hold all copy slots of a repository,
+        that the store threads of another folder syncing the other way
+        need to make progress."""
+        try:
+            queue.put_nowait(item)
+            return
+        except Full:
+            pass
+        stage = getattr(self._held, 'stage', None)
+        if stage is None:
+            queue.put(item)
+            return
+        start = time.time()
+        if self._limits[stage] is not None:
+            self._limits[stage].pause()
+        if self._sems[stage] is not None:
+            self._sems[stage].release()
+        try:
+            queue.put(item)
+        finally:
+            if self._sems[stage] is not None:
+                self._sems[stage].acquire()
+            if self._limits[stage] is not None:
+                self._limits[stage].resume()
+            self._held.waited += time.time() - start
+
+    def _guard(self, uid, func, *args):
+        """Run func(*args) on behalf of message uid, handling errors
+
+        Per-message errors are reported, all others abort copying.
+        :returns: True on success"""
+        try:
+            func(*args)
+            return True
+        except OfflineImapError as e:
+            if e.severity > OfflineImapError.ERROR.MESSAGE:
+                self._fail(e)
+            else:
+                self.ui.error(e, exc_info()[2])
+        except Exception as e:
+            self.ui.error(e, "Copying message %s [acc: %s]:\n %s" %\
+                              (uid, self.src.accountname, exc_info()[2]))
+            self._fail(e)
+        return False
+
+    def _fail(self, e):
+        """Abort copying, remembering the first fatal exception"""
+        self._lock.acquire()
+        try:
+            if self._error is None:
+                self._error = e
+        finally:
+            self._lock.release()
+        self._abort.set()
+
+    def _queuestore(self, batch, message, flags, rtime, uid):
+        """Add a message to batch, handing the batch to the store stage
+        once it is full"""
+        batch.append((message, flags, rtime, uid))
+        if len(batch) >= self.savebatchsize or \
+                sum([imaputil.messagesize(item[0]) for item in batch]) >= \
+                self.batchbytes:
+            self._flushstore(batch)
+
+    def _closebatch(self, batch):
+        """Close the message files of a batch once it has been saved"""
+        for message, flags, rtime, uid in batch:
+            imaputil.closemessage(message)
+
+    def _flushstore(self, batch):
+        if batch:
+            self._put(self._storeq, (batch[:],))
+            del batch[:]
+
+    def _fetch(self, chunk):
+        """Fetch stage: hand a chunk of messages to the store stage
+
+        The bodies are retrieved with folder.getmessages(), which lets
+        IMAP fetch many messages per round trip. They are passed on in
+        batches of dstfolder.getsavebatchsize() messages, so that IMAP
+        can upload them with a single APPEND.
+
+        :returns: the size of the bodies fetched in bulk"""
+        pending = {}
+        for num, total, uid in chunk:
+            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                # bail out on CTRL-C or SIGTERM
+                self._abort.set()
+                return
+            self.ui.copyingmessage(uid, num, total, self.src, self.dst)
+            self._guard(uid, self._fetchmeta, uid, pending)
+        if not pending:
+            return
+        uids = sorted(pending)
+        batch, nbytes = [], 0
+        try:
+            for uid, message in self.src.getmessages(uids):
+                if uid in pending:
+                    flags, rtime = pending.pop(uid)
+                    nbytes += imaputil.messagesize(message)
+                    self._queuestore(batch, message, flags, rtime, uid)
+                else:
+                    imaputil.closemessage(message)
+            self._flushstore(batch)
+        except OfflineImapError as e:
+            self._flushstore(batch)
+            if e.severity > OfflineImapError.ERROR.MESSAGE:
+                self._fail(e)
+                return
+            # retry the messages one by one below
+            self.ui.error(e, exc_info()[2])
+        except Exception as e:
+            self.ui.error(e, "Fetching messages %s [acc: %s]:\n %s" %\
+                              (uids, self.src.accountname, exc_info()[2]))
+            self._fail(e)
+            return
+        # Messages missing from the bulk fetch. getmessage() will
+        # raise an appropriate error if they are really unavailable.
+        for uid in sorted(pending):
+            flags, rtime = pending[uid]
+            self._guard(uid, self._fetchone, uid, flags, rtime)
+        return nbytes
+
+    def _fetchmeta(self, uid, pending):
+        """Get flags and time of uid, adding it to pending if its body
+        needs to be fetched"""
+        flags = self.src.getmessageflags(uid)
+        rtime = self.src.getmessagetime(uid)
+        if uid > 0 and self.dst.uidexists(uid):
+            # dst has message with that UID already, only update status
+            self._put(self._statusq, (uid, uid, flags, rtime))
+        elif not self.dst.storesmessages():
+            self._put(self._storeq, ([(None, flags, rtime, uid)],))
+        else:
+            pending[uid] = (flags, rtime)
+
+    def _fetchone(self, uid, flags, rtime):
+        message = self.src.getmessage(uid)
+        self._put(self._storeq, ([(message, flags, rtime, uid)],))
+
+    def _store(self, batch):
+        """Store stage: save a batch of messages and hand over the new UIDs
+
+        If saving the batch fails with a per-message error, the
+        messages are retried one by one. Message files are closed
+        afterwards, whether they could be saved or not.
+
+        :returns: the size of the batch"""
+        try:
+            return self._savebatch(batch)
+        finally:
+            self._closebatch(batch)
+
+    def _savebatch(self, batch):
+        nbytes = sum([imaputil.messagesize(item[0]) for item in batch
+                      if item[0] is not None])
+        if len(batch) > 1:
+            try:
+                new_uids = self.dst.savemessages(
+                    [(uid, message, flags, rtime)
+                     for (message, flags, rtime, uid) in batch])
+                for (message, flags, rtime, uid), new_uid in zip(batch,
+                                                                 new_uids):
+                    self._put(self._statusq, (uid, new_uid, flags, rtime))
+                return nbytes
+            except OfflineImapError as e:
+                if e.severity > OfflineImapError.ERROR.MESSAGE:
+                    self._fail(e)
+                    return
+                self.ui.error(e, exc_info()[2])
+            except Exception as e:
+                self.ui.error(e, "Copying messages %s [acc: %s]:\n %s" %\
+                                  ([item[3] for item in batch],
+                                   self.src.accountname, exc_info()[2]))
+                self._fail(e)
+                return
+        for message, flags, rtime, uid in batch:
+            self._guard(uid, self._storeone, message, flags, rtime, uid)
+        return nbytes
+
+    def _storeone(self, message, flags, rtime, uid):
+        new_uid = self.dst.savemessage(uid, message, flags, rtime)
+        self._put(self._statusq, (uid, new_uid, flags, rtime))
+
+    def _record(self, uid, new_uid, flags, rtime):
+        """Status stage: record the copied message"""
+        if new_uid > 0:
+            if new_uid != uid:
+                # Got new UID, change the local uid to match the new one.
+                self.src.change_message_uid(uid, new_uid)
+                self.status.deletemessage(uid)
+            # Save uploaded status in the statusfolder
+            self.status.savemessage(new_uid, None, flags, rtime)
+        elif new_uid == 0:
+            # Message was stored to dstfolder, but we can't find it's UID
+            # This means we can't link current message to the one created
+            # in IMAP. So we just delete local message and on next run
+            # we'll sync it back
+            self.src.deletemessage(uid)
+        else:
+            raise OfflineImapError("Trying to save msg (uid %d) on folder "
+                                   "%s returned invalid uid %d" % (uid,
+                                   self.dst.getvisiblename(), new_uid),
+                                   OfflineImapError.ERROR.MESSAGE)
+
+    def _startstage(self, stage, count, *args):
+        self._running[stage] = count
+        for i in range(count):
+            thread = threadutil.ExitNotifyThread(target = self._worker,
+                name = "Copy %s %s:%s" % (stage, self.src.repository,
+                                          self.src),
+                args = (stage,) + args)
+            thread.start()
+
+    def run(self, uidlist):
+        """Copy all messages in uidlist
+
+        Per-message errors are reported and skipped. Errors of higher
+        severity stop copying and are raised once all threads are done."""
+        total = len(uidlist)
+        items = [(num + 1, total, uid) for num, uid in enumerate(uidlist)]
+        for i in range(0, total, self.chunksize):
+            self._fetchq.put((items[i:i + self.chunksize],))
+        for i in range(self.fetchers):
+            self._fetchq.put(None)
+
+        self._startstage('fetch', self.fetchers, self._fetchq, self._fetch,
+                         self._storeq, self.storers)
+        self._startstage('store', self.storers, self._storeq, self._store,
+                         self._statusq, 1)
+        while True:
+            item = self._statusq.get()
+            if item is None:
+                break
+            if self._abort.is_set():
+                continue
+            self._guard(item[0], self._record, *item)
+        if self._error is not None:
+            raise self._error
@@ -15,9 +15,10 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import threadutil
+from offlineimap import imaputil, threadutil
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
+from offlineimap.copyengine import CopyEngine
 import offlineimap.accounts
 import os.path
 import re
@@ -25,6 +26,53 @@ from sys import exc_info
 import traceback
 
 
+class SyncPlan(object):
+    """What syncing a folder to another one needs to do
+
+    Computed by :meth:`BaseFolder.getsyncplan` from the message lists
+    of the folders, and consumed by the three sync passes.
+
+    Instance variables (self.):
+      copy: sorted list of UIDs in the folder but not in the status
+        folder, to be copied (pass 1)
+      delete: sorted list of positive UIDs in the status folder but not
+        in the folder, to be deleted (pass 2)
+      flags: dict mapping positive UIDs present in all three folders,
+        whose flags differ from the status folder, to (addflags,
+        delflags) sets (pass 3)"""
+
+    def __init__(self, srcitems, statusitems, dstuids):
+        """
+        :param srcitems: iterator of (uid, flags) of the source folder
+            sorted by UID, as returned by :meth:`MessageList.iterflags`
+        :param statusitems: the same for the status folder
+        :param dstuids: set of the UIDs in the destination folder"""
+        self.copy = []
+        self.delete = []
+        self.flags = {}
+        src = next(srcitems, None)
+        status = next(statusitems, None)
+        while src is not None or status is not None:
+            if status is None or (src is not None and src[0] < status[0]):
+                self.copy.append(src[0])
+                src = next(srcitems, None)
+            elif src is None or status[0] < src[0]:
+                if status[0] >= 0:
+                    self.delete.append(status[0])
+                status = next(statusitems, None)
+            else:
+                (uid, selfflags), (uid, statusflags) = src, status
+                src = next(srcitems, None)
+                status = next(statusitems, None)
+                # Ignore messages with negative UIDs missed by pass 1 and
+                # don't do anything if the message has been deleted remotely
+                if uid < 0 or not uid in dstuids:
+                    continue
+                if selfflags != statusflags:
+                    self.flags[uid] = (selfflags - statusflags,
+                                       statusflags - selfflags)
+
+
 class BaseFolder(object):
     def __init__(self, name, repository):
         """
@@ -44,6 +92,9 @@ class BaseFolder(object):
         if self.visiblename == self.getsep():
             self.visiblename = ''
         self.config = repository.getconfig()
+        # (statusfolder, uidlist) of messages to remove from a status
+        # folder once they are really deleted, see commitdeletes()
+        self._statusdeletes = []
 
     def getname(self):
         """Returns name"""
@@ -67,6 +118,11 @@ class BaseFolder(object):
         InstanceLimitedThreads."""
         raise NotImplementedException
 
+    def getthrottlecount(self):
+        """Number of operations the server throttled so far, see
+        threadutil.AdaptiveLimit"""
+        return 0
+
     def storesmessages(self):
         """Should be true for any backend that actually saves message bodies.
         (Almost all of them).  False for the LocalStatus backend.  Saves
@@ -156,6 +212,13 @@ class BaseFolder(object):
         os.rename(uidfilename + ".tmp", uidfilename)
         self._base_saved_uidvalidity = newval
 
+    def save_quickstatus(self):
+        """Save the state quickchanged() compares against
+
+        Called after the folder has been synced. Backends that need
+        more than the status folder for quickchanged() implement this."""
+        pass
+
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
 
@@ -174,6 +237,12 @@ class BaseFolder(object):
         You must call cachemessagelist() before calling this function!"""
         raise NotImplementedException
 
+    def iterflags(self):
+        """Yields (uid, frozenset of flags) for all messages, sorted by UID
+
+        You must call cachemessagelist() before calling this function!"""
+        return self.getmessagelist().iterflags()
+
     def uidexists(self, uid):
         """Returns True if uid exists"""
         return uid in self.getmessagelist()
@@ -191,6 +260,15 @@ class BaseFolder(object):
         """Returns the content of the specified message."""
         raise NotImplementedException
 
+    def getmessages(self, uids):
+        """Yields (uid, content) tuples for the messages in uids
+
+        Backends that can retrieve several messages at once (IMAP)
+        override this. Messages that could not be retrieved may be
+        left out, so callers need to check for missing UIDs."""
+        for uid in uids:
+            yield (uid, self.getmessage(uid))
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -215,6 +293,23 @@ class BaseFolder(object):
         """
         raise NotImplementedException
 
+    def getsavebatchsize(self):
+        """Number of messages that should be passed to savemessages()
+        at once. Backends that gain nothing from batching return 1."""
+        return 1
+
+    def savemessages(self, messages):
+        """Save several messages, see savemessage()
+
+        Backends that can store many messages at once (IMAP) override
+        this.
+
+        :param messages: list of (uid, content, flags, rtime) tuples
+        :returns: list with the return value of savemessage() for each
+            message, in the same order"""
+        return [self.savemessage(uid, content, flags, rtime)
+                for (uid, content, flags, rtime) in messages]
+
     def getmessagetime(self, uid):
         """Return the received time for the specified message."""
         raise NotImplementedException
@@ -231,6 +326,34 @@ class BaseFolder(object):
         dryrun mode."""
         raise NotImplementedException
 
+    def savemessagesflags(self, uidflags):
+        """Sets the flags of several messages
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode.
+
+        :param uidflags: dict mapping each UID to its new set() of flags"""
+        for uid, flags in uidflags.items():
+            self.savemessageflags(uid, flags)
+
+    def changemessagesflags(self, uidchanges):
+        """Adds and removes flags of several messages
+
+        Unlike savemessagesflags(), flags not mentioned are left alone.
+        Backends that can change flags without replacing all of them
+        (IMAP) override this.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode.
+
+        :param uidchanges: dict mapping each UID to an (addflags,
+            delflags) tuple of sets"""
+        self.savemessagesflags(dict(
+                (uid, (self.getmessageflags(uid) | addflags) - delflags)
+                for uid, (addflags, delflags) in uidchanges.items()))
+
     def addmessageflags(self, uid, flags):
         """Adds the specified flags to the message's flag set.  If a given
         flag is already present, it will not be duplicated.
@@ -294,6 +417,34 @@ class BaseFolder(object):
         for uid in uidlist:
             self.deletemessage(uid)
 
+    def commitdeletes(self):
+        """Carry out deletions deferred by deletemessage(s)()
+
+        Backends may collect the messages deleted while a folder is
+        synced and delete them all at once, e.g. with a single IMAP
+        EXPUNGE. They are gone from the message list right away, but
+        only deleted when this is called after the sync. Only then are
+        they removed from the status folder, so if deleting fails they
+        are not copied back by the next sync. If it raises, the deletes
+        are kept and can be retried by calling it again."""
+        self._commitdeletes()
+        statusdeletes, self._statusdeletes = self._statusdeletes, []
+        for statusfolder, uidlist in statusdeletes:
+            statusfolder.deletemessages(uidlist)
+
+    def deletestatusoncommit(self, statusfolder, uidlist):
+        """Remove uidlist from statusfolder once commitdeletes() succeeds
+
+        :param uidlist: UIDs just passed to deletemessages()"""
+        self._statusdeletes.append((statusfolder, uidlist))
+
+    def _commitdeletes(self):
+        """Delete the messages collected by deletemessage(s)()
+
+        Backends deferring deletes implement this. It needs to keep the
+        messages to delete if it fails."""
+        pass
+
     def copymessageto(self, uid, dstfolder, statusfolder, register = 1):
         """Copies a message from self to dst if needed, updating the status
 
@@ -332,7 +483,10 @@ class BaseFolder(object):
             #remained negative, no server was willing to assign us an
             #UID. If newid is 0, saving succeeded, but we could not
             #retrieve the new UID. Ignore message in this case.
-            new_uid = dstfolder.savemessage(uid, message, flags, rtime)
+            try:
+                new_uid = dstfolder.savemessage(uid, message, flags, rtime)
+            finally:
+                imaputil.closemessage(message)
             if new_uid > 0:
                 if new_uid != uid:
                     # Got new UID, change the local uid to match the new one.
@@ -366,7 +520,16 @@ class BaseFolder(object):
                                exc_info()[2]))
             raise    #raise on unknown errors, so we can fix those
 
-    def syncmessagesto_copy(self, dstfolder, statusfolder):
+    def getsyncplan(self, dstfolder, statusfolder):
+        """Work out what syncing self to dstfolder needs to do
+
+        This looks at each message list only once, instead of checking
+        each UID with uidexists() or getmessageflags() in every pass.
+        :returns: a :class:`SyncPlan`"""
+        return SyncPlan(self.iterflags(), statusfolder.iterflags(),
+                        set(dstfolder.getmessageuidlist()))
+
+    def syncmessagesto_copy(self, dstfolder, statusfolder, plan=None):
         """Pass1: Copy locally existing messages not on the other side
 
         This will copy messages to dstfolder that exist locally but are
@@ -377,40 +540,35 @@ class BaseFolder(object):
            - If dstfolder doesn't have it yet, add them to dstfolder.
            - Update statusfolder
 
+        If either folder suggests threads, the messages are copied by a
+        pipelined :class:`offlineimap.copyengine.CopyEngine` instead.
+
         This function checks and protects us from action in ryrun mode.
-        """
-        threads = []
 
-        copylist = filter(lambda uid: not \
-                              statusfolder.uidexists(uid),
-                            self.getmessageuidlist())
+        :param plan: :class:`SyncPlan`, computed if not passed in
+        """
+        if plan is None:
+            plan = self.getsyncplan(dstfolder, statusfolder)
+        copylist = plan.copy
         num_to_copy = len(copylist)
         if num_to_copy and self.repository.account.dryrun:
             self.ui.info("[DRYRUN] Copy {} messages from {}[{}] to {}".format(
                     num_to_copy, self, self.repository, dstfolder.repository))
             return
+        if not num_to_copy:
+            return
+        if self.suggeststhreads() or dstfolder.suggeststhreads():
+            CopyEngine(self, dstfolder, statusfolder).run(copylist)
+            return
         for num, uid in enumerate(copylist):
             # bail out on CTRL-C or SIGTERM
             if offlineimap.accounts.Account.abort_NOW_signal.is_set():
                 break
             self.ui.copyingmessage(uid, num+1, num_to_copy, self, dstfolder)
             # exceptions are caught in copymessageto()
-            if self.suggeststhreads():
-                self.waitforthread()
-                thread = threadutil.InstanceLimitedThread(\
-                    self.getcopyinstancelimit(),
-                    target = self.copymessageto,
-                    name = "Copy message from %s:%s" % (self.repository, self),
-                    args = (uid, dstfolder, statusfolder))
-                thread.start()
-                threads.append(thread)
-            else:
-                self.copymessageto(uid, dstfolder, statusfolder,
-                                   register = 0)
-        for thread in threads:
-            thread.join()
+            self.copymessageto(uid, dstfolder, statusfolder, register = 0)
 
-    def syncmessagesto_delete(self, dstfolder, statusfolder):
+    def syncmessagesto_delete(self, dstfolder, statusfolder, plan=None):
         """Pass 2: Remove locally deleted messages on dst
 
         Get all UIDS in statusfolder but not self. These are messages
@@ -418,20 +576,39 @@ class BaseFolder(object):
         statusfolder.
 
         This function checks and protects us from action in ryrun mode.
+
+        :param plan: :class:`SyncPlan`, computed if not passed in
         """
-        deletelist = filter(lambda uid: uid>=0 \
-                                and not self.uidexists(uid),
-                            statusfolder.getmessageuidlist())
+        if plan is None:
+            plan = self.getsyncplan(dstfolder, statusfolder)
+        # Leave out the messages we deleted from self in the other sync
+        # direction, they are only still in statusfolder until deleting
+        # them is committed.
+        pending = set()
+        for folder, uidlist in self._statusdeletes:
+            if folder is statusfolder:
+                pending.update(uidlist)
+        deletelist = [uid for uid in plan.delete if not uid in pending]
         if len(deletelist):
             self.ui.deletingmessages(deletelist, [dstfolder])
             if self.repository.account.dryrun:
                 return #don't delete messages in dry-run mode
-            # delete in statusfolder first to play safe. In case of abort, we
-            # won't lose message, we will just retransmit some unneccessary.
-            for folder in [statusfolder, dstfolder]:
-                folder.deletemessages(deletelist)
-
-    def syncmessagesto_flags(self, dstfolder, statusfolder):
+            # Messages gone from dstfolder too only need to be removed
+            # from statusfolder. The others are removed from it once
+            # dstfolder.commitdeletes() deleted them. In case of an
+            # abort, we won't lose messages, we will just retransmit
+            # some unnecessarily.
+            dstlist, gonelist = [], []
+            for uid in deletelist:
+                if dstfolder.uidexists(uid):
+                    dstlist.append(uid)
+                else:
+                    gonelist.append(uid)
+            statusfolder.deletemessages(gonelist)
+            dstfolder.deletemessages(dstlist)
+            dstfolder.deletestatusoncommit(statusfolder, dstlist)
+
+    def syncmessagesto_flags(self, dstfolder, statusfolder, plan=None):
         """Pass 3: Flag synchronization
 
         Compare flag mismatches in self with those in statusfolder. If
@@ -440,26 +617,21 @@ class BaseFolder(object):
         statusfolder.
 
         This function checks and protects us from action in ryrun mode.
+
+        :param plan: :class:`SyncPlan`, computed if not passed in
         """
-        # For each flag, we store a list of uids to which it should be
-        # added.  Then, we can call addmessagesflags() to apply them in
-        # bulk, rather than one call per message.
+        if plan is None:
+            plan = self.getsyncplan(dstfolder, statusfolder)
+        # The flag changes of each changed message are applied to
+        # dstfolder in bulk, e.g. with one IMAP STORE per distinct
+        # change, and statusfolder gets the new flags of self. For the
+        # UI, we also store a list of uids to which each flag should be
+        # added or removed.
+        statusflagsets = {}
         addflaglist = {}
         delflaglist = {}
-        for uid in self.getmessageuidlist():
-            # Ignore messages with negative UIDs missed by pass 1 and
-            # don't do anything if the message has been deleted remotely
-            if uid < 0 or not dstfolder.uidexists(uid):
-                continue
-
-            selfflags = self.getmessageflags(uid)
-            statusflags = statusfolder.getmessageflags(uid)
-            #if we could not get message flags from LocalStatus, assume empty.
-            if statusflags is None:
-                statusflags = set()
-
-            addflags = selfflags - statusflags
-            delflags = statusflags - selfflags
+        for uid, (addflags, delflags) in plan.flags.iteritems():
+            statusflagsets[uid] = self.getmessageflags(uid)
 
             for flag in addflags:
                 if not flag in addflaglist:
@@ -473,17 +645,14 @@ class BaseFolder(object):
 
         for flag, uids in addflaglist.items():
             self.ui.addingflags(uids, flag, dstfolder)
-            if self.repository.account.dryrun:
-                continue #don't actually add in a dryrun
-            dstfolder.addmessagesflags(uids, set(flag))
-            statusfolder.addmessagesflags(uids, set(flag))
 
         for flag,uids in delflaglist.items():
             self.ui.deletingflags(uids, flag, dstfolder)
-            if self.repository.account.dryrun:
-                continue #don't actually remove in a dryrun
-            dstfolder.deletemessagesflags(uids, set(flag))
-            statusfolder.deletemessagesflags(uids, set(flag))
+
+        if not plan.flags or self.repository.account.dryrun:
+            return #don't actually change flags in a dryrun
+        dstfolder.changemessagesflags(plan.flags)
+        statusfolder.savemessagesflags(statusflagsets)
                 
     def syncmessagesto(self, dstfolder, statusfolder):
         """Syncs messages in this folder to the destination dstfolder.
@@ -514,6 +683,10 @@ class BaseFolder(object):
         :param dstfolder: Folderinstance to sync the msgs to.
         :param statusfolder: LocalStatus instance to sync against.
         """
+        # Pass 1 only adds the copied messages to statusfolder and pass 2
+        # only removes messages which are gone from self, so the plan
+        # stays valid for all passes.
+        plan = self.getsyncplan(dstfolder, statusfolder)
         passes = [('copying messages'       , self.syncmessagesto_copy),
                   ('deleting messages'      , self.syncmessagesto_delete),
                   ('syncing flags'          , self.syncmessagesto_flags)]
@@ -523,7 +696,7 @@ class BaseFolder(object):
             if offlineimap.accounts.Account.abort_NOW_signal.is_set():
                 break
             try:
-                action(dstfolder, statusfolder)
+                action(dstfolder, statusfolder, plan)
             except (KeyboardInterrupt):
                 raise
             except OfflineImapError as e:
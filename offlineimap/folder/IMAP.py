@@ -18,13 +18,19 @@
 import email
 import random
 import binascii
+import itertools
 import re
+import os
 import time
-from sys import exc_info
 from .Base import BaseFolder
+from .MessageList import MessageList
 from offlineimap import imaputil, imaplibutil, OfflineImapError
 from offlineimap.imaplib2 import MonthNames
 
+# Max length of the sequence sets in UID STORE commands. RFC 7162
+# recommends to keep command lines below 8192 octets.
+MAXSEQUENCELENGTH = 8000
+
 
 class IMAPFolder(BaseFolder):
     def __init__(self, imapserver, name, repository):
@@ -35,6 +41,9 @@ class IMAPFolder(BaseFolder):
         self.root = None # imapserver.root
         self.imapserver = imapserver
         self.messagelist = None
+        self._quickstatus = None
+        # UIDs deleted, but not yet expunged, see commitdeletes()
+        self._pendingdeletes = []
         self.randomgenerator = random.Random()
         #self.ui is set in BaseFolder
 
@@ -61,6 +70,9 @@ class IMAPFolder(BaseFolder):
     def getcopyinstancelimit(self):
         return 'MSGCOPY_' + self.repository.getname()
 
+    def getthrottlecount(self):
+        return self.imapserver.throttlecount
+
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
 
@@ -69,41 +81,50 @@ class IMAPFolder(BaseFolder):
         if hasattr(self, '_uidvalidity'):
             # use cached value if existing
             return self._uidvalidity
-        imapobj = self.imapserver.acquireconnection()
-        try:
+        def getuidvalidity(imapobj):
             # SELECT (if not already done) and get current UIDVALIDITY
             self.selectro(imapobj)
             typ, uidval = imapobj.response('UIDVALIDITY')
             assert uidval != [None] and uidval != None, \
                 "response('UIDVALIDITY') returned [None]!"
-            self._uidvalidity = long(uidval[-1])
-            return self._uidvalidity
-        finally:
-            self.imapserver.releaseconnection(imapobj)
+            return long(uidval[-1])
+        self._uidvalidity = self.imapserver.withconnection(getuidvalidity,
+                                                           self.getfullname())
+        return self._uidvalidity
 
     def quickchanged(self, statusfolder):
+        """Check the folder STATUS against its state at the last sync
+
+        The STATUS of all folders is queried at once by the repository,
+        so no SELECT is needed per folder. If no state has been saved
+        yet, fall back to SELECTing the folder and comparing the
+        number of messages."""
+        saved = self._loadquickstatus()
+        status = None
+        if saved is not None:
+            status = self.repository.getfolderstatus(self.getfullname())
+        if status is None:
+            return self._quickchanged_select(statusfolder)
+        for key in ('MESSAGES', 'UIDNEXT', 'UIDVALIDITY'):
+            if status.get(key) is None or status[key] != saved.get(key):
+                return True
+        # flag changes bump HIGHESTMODSEQ
+        if status.get('HIGHESTMODSEQ') is not None and \
+                saved.get('HIGHESTMODSEQ') is not None and \
+                status['HIGHESTMODSEQ'] != saved['HIGHESTMODSEQ']:
+            return True
+        if long(status['MESSAGES']) != statusfolder.getmessagecount():
+            return True
+        return False
+
+    def _quickchanged_select(self, statusfolder):
         # An IMAP folder has definitely changed if the number of
         # messages or the UID of the last message have changed.  Otherwise
         # only flag changes could have occurred.
-        retry = True # Should we attempt another round or exit?
-        while retry:
-            retry = False
-            imapobj = self.imapserver.acquireconnection()
-            try:
-                # Select folder and get number of messages
-                restype, imapdata = imapobj.select(self.getfullname(), True,
-                                                   True)
-                self.imapserver.releaseconnection(imapobj)
-            except OfflineImapError as e:
-                # retry on dropped connections, raise otherwise
-                self.imapserver.releaseconnection(imapobj, True)
-                if e.severity == OfflineImapError.ERROR.FOLDER_RETRY:
-                    retry = True
-                else: raise
-            except:
-                # cleanup and raise on all other errors
-                self.imapserver.releaseconnection(imapobj, True)
-                raise
+        # Select folder and get number of messages
+        restype, imapdata = self.imapserver.withconnection(
+            lambda imapobj: imapobj.select(self.getfullname(), True, True),
+            self.getfullname(), True)
         # 1. Some mail servers do not return an EXISTS response
         # if the folder is empty.  2. ZIMBRA servers can return
         # multiple EXISTS replies in the form 500, 1000, 1500,
@@ -118,70 +139,122 @@ class IMAPFolder(BaseFolder):
             return True      
         return False
 
-    def cachemessagelist(self):
-        maxage = self.config.getdefaultint("Account %s" % self.accountname,
-                                           "maxage", -1)
-        maxsize = self.config.getdefaultint("Account %s" % self.accountname,
-                                            "maxsize", -1)
-        self.messagelist = {}
+    def _getquickstatusfilename(self):
+        """provides the quick STATUS cache filename"""
+        return os.path.join(self.repository.getquickstatusdir(),
+                            self.getfolderbasename())
+
+    def _recordquickstatus(self, imapobj, imapdata):
+        """Remember the state of the just SELECTed folder
 
-        imapobj = self.imapserver.acquireconnection()
+        Has to be called right after the SELECT, before any of its
+        untagged responses are consumed. The values are written by
+        :meth:`save_quickstatus` once the folder has been synced."""
+        status = {}
+        if imapdata == [None]:
+            status['MESSAGES'] = '0'
+        else:
+            status['MESSAGES'] = str(max([long(x) for x in imapdata]))
+        for key in ('UIDNEXT', 'UIDVALIDITY', 'HIGHESTMODSEQ'):
+            dat = imapobj._get_untagged_response(key, True)
+            if dat:
+                status[key] = dat[-1]
+        self._quickstatus = status
+
+    def _loadquickstatus(self):
+        """:returns: dict of the values saved by :meth:`save_quickstatus`
+            or None"""
+        filename = self._getquickstatusfilename()
+        if not os.path.exists(filename):
+            return None
+        file = open(filename, 'rt')
         try:
-            res_type, imapdata = imapobj.select(self.getfullname(), True, True)
-            if imapdata == [None] or imapdata[0] == '0':
-                # Empty folder, no need to populate message list
-                return
-            # By default examine all UIDs in this folder
-            msgsToFetch = '1:*'
-
-            if (maxage != -1) | (maxsize != -1):
-                search_cond = "(";
-
-                if(maxage != -1):
-                    #find out what the oldest message is that we should look at
-                    oldest_struct = time.gmtime(time.time() - (60*60*24*maxage))
-                    if oldest_struct[0] < 1900:
-                        raise OfflineImapError("maxage setting led to year %d. "
-                                               "Abort syncing." % oldest_struct[0],
-                                               OfflineImapError.ERROR.REPO)
-                    search_cond += "SINCE %02d-%s-%d" % (
-                        oldest_struct[2],
-                        MonthNames[oldest_struct[1]],
-                        oldest_struct[0])
-
-                if(maxsize != -1):
-                    if(maxage != -1): # There are two conditions, add space
-                        search_cond += " "
-                    search_cond += "SMALLER %d" % maxsize
-
-                search_cond += ")"
-
-                res_type, res_data = imapobj.search(None, search_cond)
-                if res_type != 'OK':
-                    raise OfflineImapError("SEARCH in folder [%s]%s failed. "
-                        "Search string was '%s'. Server responded '[%s] %s'" % (
-                            self.getrepository(), self,
-                            search_cond, res_type, res_data),
-                        OfflineImapError.ERROR.FOLDER)
-
-                # Result UIDs are seperated by space, coalesce into ranges
-                msgsToFetch = imaputil.uid_sequence(res_data[0].split())
-                if not msgsToFetch:
-                    return # No messages to sync
-
-            # Get the flags and UIDs for these. single-quotes prevent
-            # imaplib2 from quoting the sequence.
-            res_type, response = imapobj.fetch("'%s'" % msgsToFetch,
-                                               '(FLAGS UID)')
-            if res_type != 'OK':
-                raise OfflineImapError("FETCHING UIDs in folder [%s]%s failed. "
-                                       "Server responded '[%s] %s'" % (
-                            self.getrepository(), self,
-                            res_type, response),
-                        OfflineImapError.ERROR.FOLDER)
+            items = file.readline().split()
+        finally:
+            file.close()
+        return dict(zip(items[::2], items[1::2]))
+
+    def save_quickstatus(self):
+        """Save the folder state as of the last cachemessagelist()
+
+        quickchanged() compares it with the current STATUS."""
+        status = self._quickstatus
+        filename = self._getquickstatusfilename()
+        if status is None or status.get('UIDNEXT') is None:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return
+        file = open(filename + ".tmp", 'wt')
+        file.write(' '.join(['%s %s' % item for item in
+                             sorted(status.items())]) + '\n')
+        file.close()
+        os.rename(filename + ".tmp", filename)
+
+    def _getmodseqfilename(self):
+        """provides the HIGHESTMODSEQ cache filename"""
+        return os.path.join(self.repository.getmodseqdir(),
+                            self.getfolderbasename())
+
+    def _loadmodseqcache(self):
+        """Load the cached flag state written by :meth:`_savemodseqcache`
+
+        :returns: (uidvalidity, highestmodseq, messagelist) or None if
+                  there is no (usable) cache"""
+        filename = self._getmodseqfilename()
+        if not os.path.exists(filename):
+            return None
+        messagelist = MessageList()
+        file = open(filename, 'rt')
+        try:
+            try:
+                uidvalidity, modseq = [long(x) for x in
+                                       file.readline().split()]
+                for line in file:
+                    uid, flags = line.rstrip('\n').split(':', 1)
+                    uid = long(uid)
+                    messagelist[uid] = {'uid': uid, 'flags': set(flags),
+                                        'time': None}
+            except ValueError:
+                self.ui.warn("Ignoring corrupt HIGHESTMODSEQ cache '%s'" %
+                             filename, minor = 1)
+                return None
         finally:
-            self.imapserver.releaseconnection(imapobj)
+            file.close()
+        return (uidvalidity, modseq, messagelist)
+
+    def _savemodseqcache(self, uidvalidity, modseq):
+        """Save HIGHESTMODSEQ and the current messagelist flags"""
+        filename = self._getmodseqfilename()
+        file = open(filename + '.tmp', 'wt')
+        file.write('%d %d\n' % (uidvalidity, modseq))
+        for uid, flags in self.messagelist.iterflags():
+            file.write('%d:%s\n' % (uid, ''.join(sorted(flags))))
+        file.close()
+        os.rename(filename + '.tmp', filename)
+
+    def _deletemodseqcache(self):
+        filename = self._getmodseqfilename()
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    def _gethighestmodseq(self, imapobj):
+        """Return HIGHESTMODSEQ of the currently SELECTed folder
+
+        :returns: the modseq as long, or None if CONDSTORE is disabled,
+                  unsupported or the mailbox does not keep modseqs."""
+        if not self.repository.getcondstore():
+            return None
+        if not ('CONDSTORE' in imapobj.capabilities or
+                'QRESYNC' in imapobj.capabilities):
+            return None
+        typ, nomodseq = imapobj.response('NOMODSEQ')
+        typ, modseq = imapobj.response('HIGHESTMODSEQ')
+        if nomodseq != [None] or modseq == [None]:
+            return None
+        return long(modseq[-1])
 
+    def _parsemessagelist(self, response, messagelist):
+        """Parse a FETCH (FLAGS UID RFC822.SIZE) response into messagelist"""
         for messagestr in response:
             # looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg
             # Discard initial message number.
@@ -197,11 +270,225 @@ class IMAPFolder(BaseFolder):
                 uid = long(options['UID'])
                 flags = imaputil.flagsimap2maildir(options['FLAGS'])
                 rtime = imaplibutil.Internaldate2epoch(messagestr)
-                self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+                messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+                if 'RFC822.SIZE' in options:
+                    messagelist[uid]['size'] = long(options['RFC822.SIZE'])
+
+    def _cachemessagelist_changedsince(self, imapobj, cache, modseq, exists):
+        """Update a cached messagelist with changes since its modseq
+
+        Only the flags of messages changed since the cached
+        HIGHESTMODSEQ are fetched (RFC 7162). Expunged messages are
+        learned from VANISHED responses if QRESYNC is enabled, and via a
+        UID SEARCH otherwise.
+
+        :returns: the updated messagelist or None if a full rescan is
+                  needed."""
+        cachedmodseq, messagelist = cache
+        if cachedmodseq < modseq:
+            qresync = 'QRESYNC' in imapobj.enabled
+            modifier = '(CHANGEDSINCE %d%s)' % (cachedmodseq,
+                                                 ' VANISHED' if qresync else '')
+            res_type, response = imapobj.uid('fetch', "'1:*'",
+                                             '(FLAGS RFC822.SIZE)', modifier)
+            if res_type != 'OK':
+                return None
+            self._parsemessagelist(response, messagelist)
+            if qresync:
+                # looks like: '(EARLIER) 41,43:116' or None
+                typ, vanished = imapobj.response('VANISHED')
+                for data in vanished:
+                    if data is None: continue
+                    for uid in imaputil.uid_sequence_expand(data.split()[-1]):
+                        messagelist.pop(uid, None)
+        if len(messagelist) != exists:
+            # Messages were expunged but we do not know which ones yet
+            res_type, res_data = imapobj.uid('search', 'ALL')
+            if res_type != 'OK' or res_data == [None]:
+                return None
+            uids = set(long(uid) for uid in res_data[0].split())
+            for uid in messagelist.keys():
+                if uid not in uids:
+                    del messagelist[uid]
+            if len(messagelist) != exists:
+                return None
+        return messagelist
+
+    def cachemessagelist(self):
+        maxage = self.config.getdefaultint("Account %s" % self.accountname,
+                                           "maxage", -1)
+        maxsize = self.config.getdefaultint("Account %s" % self.accountname,
+                                            "maxsize", -1)
+        self.messagelist = MessageList()
+        result = self.imapserver.withconnection(
+            lambda imapobj: self._cachemessagelist_select(imapobj, maxage,
+                                                          maxsize),
+            self.getfullname(), True)
+        if result is None:
+            return
+        response, modseq, uidvalidity = result
+        self._parsemessagelist(response, self.messagelist)
+        if modseq is not None:
+            self._savemodseqcache(uidvalidity, modseq)
+        else:
+            self._deletemodseqcache()
+
+    def _cachemessagelist_select(self, imapobj, maxage, maxsize):
+        """SELECT the folder and FETCH the flags of the messages to sync
+
+        :returns: (FETCH response, modseq, uidvalidity) or None if
+            self.messagelist is complete already"""
+        modseq = uidvalidity = None
+        res_type, imapdata = imapobj.select(self.getfullname(), True, True)
+        self._recordquickstatus(imapobj, imapdata)
+        if imapdata == [None] or imapdata[0] == '0':
+            # Empty folder, no need to populate message list
+            self._deletemodseqcache()
+            return None
+        # By default examine all UIDs in this folder
+        msgsToFetch = '1:*'
+
+        if (maxage != -1) | (maxsize != -1):
+            search_cond = "(";
+
+            if(maxage != -1):
+                #find out what the oldest message is that we should look at
+                oldest_struct = time.gmtime(time.time() - (60*60*24*maxage))
+                if oldest_struct[0] < 1900:
+                    raise OfflineImapError("maxage setting led to year %d. "
+                                           "Abort syncing." % oldest_struct[0],
+                                           OfflineImapError.ERROR.REPO)
+                search_cond += "SINCE %02d-%s-%d" % (
+                    oldest_struct[2],
+                    MonthNames[oldest_struct[1]],
+                    oldest_struct[0])
+
+            if(maxsize != -1):
+                if(maxage != -1): # There are two conditions, add space
+                    search_cond += " "
+                search_cond += "SMALLER %d" % maxsize
+
+            search_cond += ")"
+
+            res_type, res_data = imapobj.search(None, search_cond)
+            if res_type != 'OK':
+                raise OfflineImapError("SEARCH in folder [%s]%s failed. "
+                    "Search string was '%s'. Server responded '[%s] %s'" % (
+                        self.getrepository(), self,
+                        search_cond, res_type, res_data),
+                    OfflineImapError.ERROR.FOLDER)
+
+            # Result UIDs are seperated by space, coalesce into ranges
+            msgsToFetch = imaputil.uid_sequence(res_data[0].split())
+            if not msgsToFetch:
+                return None # No messages to sync
+        else:
+            # CONDSTORE only helps if we look at the whole folder
+            modseq = self._gethighestmodseq(imapobj)
+
+        if modseq is not None:
+            typ, uidval = imapobj.response('UIDVALIDITY')
+            if uidval == [None]:
+                modseq = None
+        if modseq is not None:
+            uidvalidity = long(uidval[-1])
+            # cache it for get_uidvalidity(), as we consumed the response
+            self._uidvalidity = uidvalidity
+            cache = self._loadmodseqcache()
+            if cache is not None and cache[0] == uidvalidity and \
+                    cache[1] <= modseq:
+                exists = max([long(msgid) for msgid in imapdata])
+                messagelist = self._cachemessagelist_changedsince(
+                    imapobj, cache[1:], modseq, exists)
+                if messagelist is not None:
+                    self.messagelist = messagelist
+                    if cache[1] != modseq:
+                        self._savemodseqcache(uidvalidity, modseq)
+                    return None
+
+        # Get the flags and UIDs for these. single-quotes prevent
+        # imaplib2 from quoting the sequence.
+        res_type, response = imapobj.fetch("'%s'" % msgsToFetch,
+                                           '(FLAGS UID RFC822.SIZE)')
+        if res_type != 'OK':
+            raise OfflineImapError("FETCHING UIDs in folder [%s]%s failed. "
+                                   "Server responded '[%s] %s'" % (
+                        self.getrepository(), self,
+                        res_type, response),
+                    OfflineImapError.ERROR.FOLDER)
+        return response, modseq, uidvalidity
 
     def getmessagelist(self):
         return self.messagelist
 
+    def getmessages(self, uids):
+        """Retrieve several messages from the IMAP server (incl bodies)
+
+        Messages are fetched with one UID FETCH per batch of at most
+        fetchbatchsize messages or fetchbatchbytes bytes (as far as
+        their RFC822.SIZE is known). Messages the server did not return
+        are not yielded, use getmessage() to get a proper error for them.
+
+        :returns: generator of (uid, body) tuples"""
+        maxcount = self.repository.getfetchbatchsize()
+        maxbytes = self.repository.getfetchbatchbytes()
+        batch, batchbytes = [], 0
+        for uid in uids:
+            size = self.messagelist.get(uid, {}).get('size', 0)
+            if batch and batchbytes + size > maxbytes:
+                for msg in self._fetchmessages(batch):
+                    yield msg
+                batch, batchbytes = [], 0
+            batch.append(uid)
+            batchbytes += size
+            if len(batch) >= maxcount:
+                for msg in self._fetchmessages(batch):
+                    yield msg
+                batch, batchbytes = [], 0
+        if batch:
+            for msg in self._fetchmessages(batch):
+                yield msg
+
+    def _fetchmessages(self, uids):
+        """Fetch the bodies of uids with a single UID FETCH
+
+        :returns: list of (uid, body) tuples"""
+        def fetch(imapobj):
+            imapobj.select(self.getfullname(), readonly = True)
+            return imapobj.uid('fetch', "'%s'" % imaputil.uid_sequence(uids),
+                               '(BODY.PEEK[])')
+        res_type, data = self.imapserver.withconnection(fetch,
+            self.getfullname(), True)
+        if res_type != 'OK':
+            raise OfflineImapError("IMAP server '%s' failed to fetch messages "
+                "%s. Server responded: %s %s" % (self.getrepository(),
+                imaputil.uid_sequence(uids), res_type, data),
+                OfflineImapError.ERROR.MESSAGE)
+        # data looks like [('320 (UID 17061 BODY[] {2565}', 'msgbody...'),
+        # ')', ...]. Some servers send the UID after the body, in which
+        # case it is part of the string following the tuple.
+        messages = []
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            match = re.search('UID (\d+)', item[0])
+            if not match and i + 1 < len(data) and \
+                    isinstance(data[i + 1], basestring):
+                match = re.search('UID (\d+)', data[i + 1])
+            if not match:
+                self.ui.warn("No UID in FETCH response '%s'" % item[0],
+                             minor = 1)
+                continue
+            body = item[1]
+            if imaputil.ismessagefile(body):
+                # literals spooled to disk keep their CRLF line ends,
+                # they are converted while being copied if needed
+                body = imaputil.LiteralFile(body)
+            else:
+                body = body.replace("\r\n", "\n")
+            messages.append((long(match.group(1)), body))
+        return messages
+
     def getmessage(self, uid):
         """Retrieve message with UID from the IMAP server (incl body)
 
@@ -209,55 +496,47 @@ class IMAPFolder(BaseFolder):
                   (probably severity MESSAGE) if e.g. no message with
                   this UID could be found.
         """
-        imapobj = self.imapserver.acquireconnection()
-        try:
-            fails_left = 2 # retry on dropped connection
-            while fails_left:
-                try:
-                    imapobj.select(self.getfullname(), readonly = True)
-                    res_type, data = imapobj.uid('fetch', str(uid),
-                                                 '(BODY.PEEK[])')
-                    fails_left = 0
-                except imapobj.abort as e:
-                    # Release dropped connection, and get a new one
-                    self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
-                    self.ui.error(e, exc_info()[2])
-                    fails_left -= 1
-                    if not fails_left:
-                        raise e
-            if data == [None] or res_type != 'OK':
-                #IMAP server says bad request or UID does not exist
-                severity = OfflineImapError.ERROR.MESSAGE
-                reason = "IMAP server '%s' failed to fetch message UID '%d'."\
-                    "Server responded: %s %s" % (self.getrepository(), uid,
-                                                 res_type, data)
-                if data == [None]:
-                    #IMAP server did not find a message with this UID
-                    reason = "IMAP server '%s' does not have a message "\
-                             "with UID '%s'" % (self.getrepository(), uid)
-                raise OfflineImapError(reason, severity)
-            # data looks now e.g. [('320 (UID 17061 BODY[]
-            # {2565}','msgbody....')]  we only asked for one message,
-            # and that msg is in data[0]. msbody is in [0][1]
-            data = data[0][1].replace("\r\n", "\n")
-
-            if len(data)>200:
-                dbg_output = "%s...%s" % (str(data)[:150],
-                                          str(data)[-50:])
-            else:
-                dbg_output = data
-            self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
-                          (uid, dbg_output))
-        finally:
-            self.imapserver.releaseconnection(imapobj)
+        def fetch(imapobj):
+            imapobj.select(self.getfullname(), readonly = True)
+            return imapobj.uid('fetch', str(uid), '(BODY.PEEK[])')
+        res_type, data = self.imapserver.withconnection(fetch,
+            self.getfullname(), True)
+        if data == [None] or res_type != 'OK':
+            #IMAP server says bad request or UID does not exist
+            severity = OfflineImapError.ERROR.MESSAGE
+            reason = "IMAP server '%s' failed to fetch message UID '%d'."\
+                "Server responded: %s %s" % (self.getrepository(), uid,
+                                             res_type, data)
+            if data == [None]:
+                #IMAP server did not find a message with this UID
+                reason = "IMAP server '%s' does not have a message "\
+                         "with UID '%s'" % (self.getrepository(), uid)
+            raise OfflineImapError(reason, severity)
+        # data looks now e.g. [('320 (UID 17061 BODY[]
+        # {2565}','msgbody....')]  we only asked for one message,
+        # and that msg is in data[0]. msbody is in [0][1]
+        data = data[0][1]
+        if imaputil.ismessagefile(data):
+            # spooled to disk, see _fetchmessages()
+            self.ui.debug('imap', "Returned file from fetching %d: %d bytes" %
+                          (uid, imaputil.messagesize(data)))
+            return imaputil.LiteralFile(data)
+        data = data.replace("\r\n", "\n")
+
+        if len(data)>200:
+            dbg_output = "%s...%s" % (str(data)[:150],
+                                      str(data)[-50:])
+        else:
+            dbg_output = data
+        self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
+                      (uid, dbg_output))
         return data
 
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
 
     def getmessageflags(self, uid):
-        return self.messagelist[uid]['flags']
+        return self.messagelist.getmessageflags(uid)
 
     def generate_randomheader(self, content):
         """Returns a unique X-OfflineIMAP header
@@ -281,7 +560,10 @@ class IMAPFolder(BaseFolder):
 
         # compute unsigned crc32 of 'content' as unique hash
         # NB: crc32 returns unsigned only starting with python 3.0
-        headervalue  = str( binascii.crc32(content) & 0xffffffff ) + '-'
+        crc = 0
+        for chunk in imaputil.messagechunks(content):
+            crc = binascii.crc32(chunk, crc)
+        headervalue  = str( crc & 0xffffffff ) + '-'
         headervalue += str(self.randomgenerator.randint(0,9999999999))
         return (headername, headervalue)
 
@@ -290,6 +572,13 @@ class IMAPFolder(BaseFolder):
         self.ui.debug('imap',
                  'savemessage_addheader: called to add %s: %s' % (headername,
                                                                   headervalue))
+        if imaputil.ismessagefile(content):
+            # Add the header to the header lines and copy the rest of
+            # the file, which follows them, as it is.
+            leader = self.savemessage_addheader(
+                imaputil.messageheaders(content), headername, headervalue)
+            rest = iter(lambda: content.read(imaputil.MESSAGE_CHUNK_SIZE), '')
+            return imaputil.spoolmessage(itertools.chain([leader], rest))
         insertionpoint = content.find("\r\n\r\n")
         self.ui.debug('imap', 'savemessage_addheader: insertionpoint = %d' % insertionpoint)
         leader = content[0:insertionpoint]
@@ -332,74 +621,79 @@ class IMAPFolder(BaseFolder):
                                  (headername, str(matchinguids)))
         return long(matchinguids[0])
 
-    def savemessage_fetchheaders(self, imapobj, headername, headervalue):
-        """ We fetch all new mail headers and search for the right
-        X-OfflineImap line by hand. The response from the server has form:
-        (
-          'OK',
-          [
-            (
-              '185 (RFC822.HEADER {1789}',
-              '... mail headers ...'
-            ),
-            ' UID 2444)',
-            (
-              '186 (RFC822.HEADER {1789}',
-              '... 2nd mail headers ...'
-            ),
-            ' UID 2445)'
-          ]
-        )
-        We need to locate the UID just after mail headers containing our
-        X-OfflineIMAP line.
-
-        Returns UID when found, 0 when not found.
-        """
-        self.ui.debug('imap', 'savemessage_fetchheaders called for %s: %s' % \
-                 (headername, headervalue))
-
-        # run "fetch X:* rfc822.header"
-        # since we stored the mail we are looking for just recently, it would
-        # not be optimal to fetch all messages. So we'll find highest message
-        # UID in our local messagelist and search from there (exactly from
-        # UID+1). That works because UIDs are guaranteed to be unique and
-        # ascending.
+    def _appendstartuid(self):
+        """The lowest UID a message APPENDed from now on can get
 
+        Has to be taken before the APPEND. UIDs are assigned in
+        ascending order, so the new message ends up above every UID in
+        our local messagelist at this point. Messages that other threads
+        append meanwhile may end up above or below it, so taking it
+        after the APPEND could skip the message we are looking for."""
         if self.getmessagelist():
-            start = 1+max(self.getmessagelist().keys())
-        else:
-            # Folder was empty - start from 1
-            start = 1
+            return 1+max(self.getmessagelist().keys())
+        # Folder was empty - start from 1
+        return 1
 
+    def savemessage_fetchheaders(self, imapobj, headername, headervalue,
+                                 start):
+        """Find the UID of a just appended message by fetching headers
+
+        See :meth:`savemessages_fetchheaders`.
+        Returns UID when found, 0 when not found."""
+        uids = self.savemessages_fetchheaders(imapobj, headername,
+                                              [headervalue], start)
+        return uids.get(headervalue, 0)
+
+    def savemessages_fetchheaders(self, imapobj, headername, headervalues,
+                                  start):
+        """Find the UIDs of just appended messages by fetching headers
+
+        Since we stored the mails we are looking for just recently, we
+        only look at messages with a UID of at least `start`, as
+        returned by :meth:`_appendstartuid` before the APPEND. That
+        works because UIDs are guaranteed to be unique and ascending.
+        Only the `headername` header of these messages is fetched, with
+        a single UID FETCH, and the values are matched in memory.
+
+        :returns: dict mapping each headervalue found to its UID"""
+        self.ui.debug('imap', 'savemessages_fetchheaders called for %d %s '
+                      'headers from UID %d' % (len(headervalues), headername,
+                                               start))
         # Imaplib quotes all parameters of a string type. That must not happen
         # with the range X:*. So we use bytearray to stop imaplib from getting
         # in our way
-
-        result = imapobj.uid('FETCH', bytearray('%d:*' % start), 'rfc822.header')
+        result = imapobj.uid('FETCH', bytearray('%d:*' % start),
+                             '(BODY.PEEK[HEADER.FIELDS (%s)])' % headername)
         if result[0] != 'OK':
             raise OfflineImapError('Error fetching mail headers: ' + '. '.join(result[1]),
                      OfflineImapError.ERROR.MESSAGE)
 
-        result = result[1]
-
-        found = 0
-        for item in result:
-            if found == 0 and type(item) == type( () ):
-                # Walk just tuples
-                if re.search("(?:^|\\r|\\n)%s:\s*%s(?:\\r|\\n)" % (headername, headervalue),
-                        item[1], flags=re.IGNORECASE):
-                    found = 1
-            elif found == 1:
-                if type(item) == type (""):
-                    uid = re.search("UID\s+(\d+)", item, flags=re.IGNORECASE)
-                    if uid:
-                        return int(uid.group(1))
-                    else:
-                        self.ui.warn("Can't parse FETCH response, can't find UID: %s", result.__repr__())
-                else:
-                    self.ui.warn("Can't parse FETCH response, we awaited string: %s", result.__repr__())
-
-        return 0
+        # result looks like [('186 (UID 2444 BODY[HEADER.FIELDS
+        # (X-OFFLINEIMAP)] {45}', 'X-OfflineIMAP: 1234-5678\r\n\r\n'),
+        # ')', ...]. Some servers send the UID after the header, in which
+        # case it is part of the string following the tuple.
+        wanted = set(headervalues)
+        header_re = re.compile("(?:^|\r|\n)%s:\s*(\S+)" % headername,
+                               flags=re.IGNORECASE)
+        data = result[1]
+        uids = {}
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            match = header_re.search(item[1])
+            if not match or not match.group(1) in wanted:
+                continue
+            uid = re.search("UID\s+(\d+)", item[0], flags=re.IGNORECASE)
+            if not uid and i + 1 < len(data) and \
+                    isinstance(data[i + 1], basestring):
+                uid = re.search("UID\s+(\d+)", data[i + 1],
+                                flags=re.IGNORECASE)
+            if uid:
+                uids[match.group(1)] = long(uid.group(1))
+            else:
+                self.ui.warn("Can't parse FETCH response, can't find UID: %s" %
+                             item[0])
+        return uids
 
     def getmessageinternaldate(self, content, rtime=None):
         """Parses mail and returns an INTERNALDATE string
@@ -431,6 +725,9 @@ class IMAPFolder(BaseFolder):
                   (including double quotes) or `None` in case of failure
                   (which is fine as value for append)."""
         if rtime is None:
+            if imaputil.ismessagefile(content):
+                # the Date header is all we need
+                content = imaputil.messageheaders(content)
             message = email.message_from_string(content)
             # parsedate returns a 9-tuple that can be passed directly to
             # time.mktime(); Will be None if missing or not in a valid
@@ -507,114 +804,294 @@ class IMAPFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
-        retry_left = 2 # succeeded in APPENDING?
-        imapobj = self.imapserver.acquireconnection()
+        # get the date of the message, so we can pass it to the server.
+        date = self.getmessageinternaldate(content, rtime)
+        # Big messages are files, which are converted chunk by chunk
+        # and streamed as APPEND literal.
+        message = content
+        content = imaputil.messagecrlf(content)
+
+        def append(imapobj):
+            # UIDPLUS extension provides us with an APPENDUID response.
+            use_uidplus = 'UIDPLUS' in imapobj.capabilities
+            headername = headervalue = start = None
+            msg = content
+            if not use_uidplus:
+                # insert a random unique header that we can fetch later
+                (headername, headervalue) = self.generate_randomheader(
+                                                content)
+                self.ui.debug('imap', 'savemessage: header is: %s: %s' %\
+                                  (headername, headervalue))
+                msg = self.savemessage_addheader(content, headername,
+                                                 headervalue)
+            if imaputil.ismessagefile(msg):
+                dbg_output = "<%d bytes>" % imaputil.messagesize(msg)
+            elif len(msg)>200:
+                dbg_output = "%s...%s" % (msg[:150], msg[-50:])
+            else:
+                dbg_output = msg
+            self.ui.debug('imap', "savemessage: date: %s, content: '%s'" %
+                         (date, dbg_output))
+
+            try:
+                # Select folder for append and make the box READ-WRITE
+                imapobj.select(self.getfullname())
+            except imapobj.readonly:
+                # readonly exception. Return None to notify that we did
+                # not save the message. (see savemessage in Base.py)
+                self.ui.msgtoreadonly(self, uid, msg, flags)
+                return None
+
+            if not use_uidplus:
+                start = self._appendstartuid()
+            #Do the APPEND
+            try:
+                (typ, dat) = imapobj.append(self.getfullname(),
+                                   imaputil.flagsmaildir2imap(flags),
+                                   date, msg)
+            except imapobj.abort:
+                raise # connection has been reset, withconnection() retries
+            except imapobj.error as e: # APPEND failed
+                # If the server responds with 'BAD', append()
+                # raise()s directly.  So we catch that too.
+                raise OfflineImapError("Saving msg folder '%s', repo '%s'"
+                    "failed (error). Server reponded: %s\nMessage content was: "
+                    "%s" % (self, self.getrepository(), str(e), dbg_output),
+                                       OfflineImapError.ERROR.MESSAGE)
+            finally:
+                if msg is not content:
+                    # the copy with the extra header
+                    imaputil.closemessage(msg)
+            try:
+                return self._savemessage_getuid(imapobj, use_uidplus,
+                                                headername, headervalue,
+                                                start)
+            except imapobj.abort as e:
+                # the message has been saved, so retrying would upload
+                # it twice
+                raise OfflineImapError("Saved msg in folder '%s', repository "
+                    "'%s', but the connection broke before its UID was "
+                    "known: %s" % (self, self.getrepository(), e),
+                                       OfflineImapError.ERROR.MESSAGE)
+
         try:
-            while retry_left:
-                # UIDPLUS extension provides us with an APPENDUID response.
-                use_uidplus = 'UIDPLUS' in imapobj.capabilities
+            newuid = self.imapserver.withconnection(append, self.getfullname())
+        except imaplibutil.IMAP4.abort as e:
+            raise OfflineImapError("Saving msg in folder '%s', "
+                  "repository '%s' failed (abort). Server reponded: %s" %
+                  (self, self.getrepository(), str(e)),
+                                   OfflineImapError.ERROR.MESSAGE)
+        finally:
+            if content is not message:
+                # the converted copy, the caller closes the original
+                imaputil.closemessage(content)
+        if newuid is None:
+            return uid
+        uid = newuid
+
+        if uid: # avoid UID FETCH 0 crash happening later on
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+
+        self.ui.debug('imap', 'savemessage: returning new UID %d' % uid)
+        return uid
+
+    def _savemessage_getuid(self, imapobj, use_uidplus, headername,
+                            headervalue, start):
+        """Find the UID of the message just APPENDed on imapobj
+
+        :param start: :meth:`_appendstartuid` as of before the APPEND,
+            only needed without UIDPLUS
+        :returns: the UID, or 0 if it could not be determined"""
+        if not use_uidplus:
+            # Checkpoint. Let it write out stuff, etc. Eg searches for
+            # just uploaded messages won't work if we don't do this.
+            # Not needed when the UID comes with the APPEND response.
+            (typ,dat) = imapobj.check()
+            assert(typ == 'OK')
 
-                # get the date of the message, so we can pass it to the server.
+        # get the new UID. Test for APPENDUID response even if the
+        # server claims to not support it, as e.g. Gmail does :-(
+        if use_uidplus or imapobj._get_untagged_response('APPENDUID', True):
+            # get new UID from the APPENDUID response, it could look
+            # like OK [APPENDUID 38505 3955] APPEND completed with
+            # 38505 bein folder UIDvalidity and 3955 the new UID.
+            # note: we would want to use .response() here but that
+            # often seems to return [None], even though we have
+            # data. TODO
+            resp = imapobj._get_untagged_response('APPENDUID')
+            if resp == [None]:
+                self.ui.warn("Server supports UIDPLUS but got no APPENDUID "
+                             "appending a message.")
+                return 0
+            uid = long(resp[-1].split(' ')[1])
+            if uid == 0:
+                self.ui.warn("savemessage: Server supports UIDPLUS, but"
+                        " we got no usable uid back. APPENDUID reponse was "
+                        "'%s'" % str(resp))
+        else:
+            # we don't support UIDPLUS
+            uid = self.savemessage_searchforheader(imapobj, headername,
+                                                   headervalue)
+            # See docs for savemessage in Base.py for explanation
+            # of this and other return values
+            if uid == 0:
+                self.ui.debug('imap', 'savemessage: attempt to get new UID '
+                    'UID failed. Search headers manually.')
+                uid = self.savemessage_fetchheaders(imapobj, headername,
+                                                    headervalue, start)
+            if uid == 0:
+                self.ui.warn("savemessage: Searching mails for new "
+                    "Message-ID failed. Could not determine new UID.")
+        return uid
+
+    def getsavebatchsize(self):
+        return self.repository.getappendbatchsize()
+
+    def savemessages(self, messages):
+        """Save several messages on the server
+
+        If the server supports MULTIAPPEND (RFC 3502), new messages are
+        uploaded with as few APPEND commands as appendbatchbytes
+        permits, see :meth:`_multiappend`. Otherwise, or for messages
+        that exist already, this falls back to savemessage().
+
+        See folder/Base for details."""
+        # messages passed as files are streamed one by one
+        new = [i for i, (uid, content, flags, rtime) in enumerate(messages)
+               if not (uid > 0 and self.uidexists(uid)) and
+               not imaputil.ismessagefile(content)]
+        if len(new) < 2:
+            return super(IMAPFolder, self).savemessages(messages)
+
+        retval = [None] * len(messages)
+        newset = set(new)
+        for i, (uid, content, flags, rtime) in enumerate(messages):
+            if not i in newset:
+                # already have it (just save modified flags), or a file
+                retval[i] = self.savemessage(uid, content, flags, rtime)
+        maxbytes = self.repository.getappendbatchbytes()
+        batches, batch, size = [], [], 0
+        for i in new:
+            if batch and size + len(messages[i][1]) > maxbytes:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(i)
+            size += len(messages[i][1])
+        batches.append(batch)
+        use_multiappend = True
+        for batch in batches:
+            newuids = None
+            if use_multiappend:
+                newuids = self._multiappend([messages[j] for j in batch])
+            if newuids is None:
+                # the server does not support MULTIAPPEND
+                use_multiappend = False
+                newuids = [self.savemessage(*messages[j]) for j in batch]
+            for j, newuid in zip(batch, newuids):
+                retval[j] = newuid
+        return retval
+
+    def _multiappend(self, messages):
+        """Upload messages with a single APPEND command
+
+        The server assigns the UIDs of all messages in one go, they are
+        read from the APPENDUID response. MULTIAPPEND is atomic, so if
+        it fails none of the messages have been saved.
+
+        :param messages: list of (uid, content, flags, rtime) tuples
+        :returns: list of new UIDs as savemessage() would return them,
+            or None if the server does not support MULTIAPPEND"""
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            if not 'MULTIAPPEND' in imapobj.capabilities:
+                return None
+            # UIDPLUS extension provides us with an APPENDUID response.
+            use_uidplus = 'UIDPLUS' in imapobj.capabilities
+            appends, headers = [], []
+            for uid, content, flags, rtime in messages:
+                self.ui.savemessage('imap', uid, flags, self)
                 date = self.getmessageinternaldate(content, rtime)
                 content = re.sub("(?<!\r)\n", "\r\n", content)
-
                 if not use_uidplus:
                     # insert a random unique header that we can fetch later
                     (headername, headervalue) = self.generate_randomheader(
                                                     content)
-                    self.ui.debug('imap', 'savemessage: header is: %s: %s' %\
-                                      (headername, headervalue))
                     content = self.savemessage_addheader(content, headername,
-                                                         headervalue)    
-                if len(content)>200:
-                    dbg_output = "%s...%s" % (content[:150], content[-50:])
-                else:
-                    dbg_output = content
-                self.ui.debug('imap', "savemessage: date: %s, content: '%s'" %
-                             (date, dbg_output))
-
-                try:
-                    # Select folder for append and make the box READ-WRITE
-                    imapobj.select(self.getfullname())
-                except imapobj.readonly:
-                    # readonly exception. Return original uid to notify that
-                    # we did not save the message. (see savemessage in Base.py)
+                                                         headervalue)
+                    headers.append((headername, headervalue))
+                appends.append((imaputil.flagsmaildir2imap(flags), date,
+                                content))
+            self.ui.debug('imap', "savemessages: appending %d messages, "
+                          "%d bytes" % (len(appends),
+                                        sum([len(a[2]) for a in appends])))
+
+            try:
+                # Select folder for append and make the box READ-WRITE
+                imapobj.select(self.getfullname())
+            except imapobj.readonly:
+                # readonly exception. Return original uids to notify that
+                # we did not save the messages. (see savemessage in Base.py)
+                for uid, content, flags, rtime in messages:
                     self.ui.msgtoreadonly(self, uid, content, flags)
-                    return uid
-
-                #Do the APPEND
-                try:
-                    (typ, dat) = imapobj.append(self.getfullname(),
-                                       imaputil.flagsmaildir2imap(flags),
-                                       date, content)
-                    retry_left = 0                # Mark as success
-                except imapobj.abort as e:
-                    # connection has been reset, release connection and retry.
-                    retry_left -= 1
-                    self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
-                    if not retry_left:
-                        raise OfflineImapError("Saving msg in folder '%s', "
-                              "repository '%s' failed (abort). Server reponded: %s\n"
-                              "Message content was: %s" %
-                              (self, self.getrepository(), str(e), dbg_output),
-                                               OfflineImapError.ERROR.MESSAGE)
-                    self.ui.error(e, exc_info()[2])
-                except imapobj.error as e: # APPEND failed
-                    # If the server responds with 'BAD', append()
-                    # raise()s directly.  So we catch that too.
-                    # drop conn, it might be bad.
-                    self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = None
-                    raise OfflineImapError("Saving msg folder '%s', repo '%s'"
-                        "failed (error). Server reponded: %s\nMessage content was: "
-                        "%s" % (self, self.getrepository(), str(e), dbg_output),
-                                           OfflineImapError.ERROR.MESSAGE)
-            # Checkpoint. Let it write out stuff, etc. Eg searches for
-            # just uploaded messages won't work if we don't do this.
-            (typ,dat) = imapobj.check()
-            assert(typ == 'OK')
+                return [uid for (uid, content, flags, rtime) in messages]
 
-            # get the new UID. Test for APPENDUID response even if the
+            if not use_uidplus:
+                start = self._appendstartuid()
+            try:
+                imapobj.multiappend(self.getfullname(), appends)
+            except (imapobj.abort, imapobj.error) as e:
+                # drop conn, it might be bad. Nothing has been saved,
+                # so the caller can retry the messages one by one.
+                self.imapserver.releaseconnection(imapobj, True)
+                imapobj = None
+                raise OfflineImapError("Saving %d msgs in folder '%s', repo "
+                    "'%s' failed. Server reponded: %s" % (len(messages), self,
+                    self.getrepository(), str(e)),
+                                       OfflineImapError.ERROR.MESSAGE)
+            if not use_uidplus:
+                # Checkpoint, so that the new messages can be found.
+                (typ,dat) = imapobj.check()
+                assert(typ == 'OK')
+
+            # get the new UIDs. Test for APPENDUID response even if the
             # server claims to not support it, as e.g. Gmail does :-(
             if use_uidplus or imapobj._get_untagged_response('APPENDUID', True):
-                # get new UID from the APPENDUID response, it could look
-                # like OK [APPENDUID 38505 3955] APPEND completed with
-                # 38505 bein folder UIDvalidity and 3955 the new UID.
-                # note: we would want to use .response() here but that
-                # often seems to return [None], even though we have
-                # data. TODO
+                # The response holds the UIDs of all messages in the order
+                # they were appended, e.g. [APPENDUID 38505 3955:3957]
                 resp = imapobj._get_untagged_response('APPENDUID')
+                uids = []
                 if resp == [None]:
                     self.ui.warn("Server supports UIDPLUS but got no APPENDUID "
-                                 "appending a message.")
-                    return 0
-                uid = long(resp[-1].split(' ')[1])
-                if uid == 0:
-                    self.ui.warn("savemessage: Server supports UIDPLUS, but"
-                            " we got no usable uid back. APPENDUID reponse was "
-                            "'%s'" % str(resp))
+                                 "appending messages.")
+                else:
+                    uids = imaputil.uid_sequence_expand(resp[-1].split(' ')[1])
+                    if len(uids) != len(messages):
+                        self.ui.warn("savemessages: Appended %d messages, but "
+                            "APPENDUID reponse was '%s'" % (len(messages),
+                                                             str(resp)))
+                        uids = []
+                if not uids:
+                    uids = [0] * len(messages)
             else:
-                # we don't support UIDPLUS
-                uid = self.savemessage_searchforheader(imapobj, headername,
-                                                       headervalue)
-                # See docs for savemessage in Base.py for explanation
-                # of this and other return values
-                if uid == 0:
-                    self.ui.debug('imap', 'savemessage: attempt to get new UID '
-                        'UID failed. Search headers manually.')
-                    uid = self.savemessage_fetchheaders(imapobj, headername,
-                                                        headervalue)
-                    self.ui.warn('imap', "savemessage: Searching mails for new "
-                        "Message-ID failed. Could not determine new UID.")
+                # we don't support UIDPLUS, find all new messages by
+                # their headers at once
+                found = self.savemessages_fetchheaders(imapobj, headers[0][0],
+                    [headervalue for (headername, headervalue) in headers],
+                    start)
+                uids = [found.get(headervalue, 0)
+                        for (headername, headervalue) in headers]
+                if 0 in uids:
+                    self.ui.warn("savemessages: Could not determine the new "
+                                 "UID of %d messages." % uids.count(0))
         finally:
-            self.imapserver.releaseconnection(imapobj)
+            if imapobj:
+                self.imapserver.releaseconnection(imapobj)
 
-        if uid: # avoid UID FETCH 0 crash happening later on
-            self.messagelist[uid] = {'uid': uid, 'flags': flags}
-
-        self.ui.debug('imap', 'savemessage: returning new UID %d' % uid)
-        return uid
+        for uid, (olduid, content, flags, rtime) in zip(uids, messages):
+            if uid: # avoid UID FETCH 0 crash happening later on
+                self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        self.ui.debug('imap', 'savemessages: returning new UIDs %s' % uids)
+        return uids
 
     def savemessageflags(self, uid, flags):
         """Change a message's flags to `flags`.
@@ -622,24 +1099,118 @@ class IMAPFolder(BaseFolder):
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
         dryrun mode."""
-        imapobj = self.imapserver.acquireconnection()
-        try:
+        self.savemessagesflags({uid: flags})
+
+    def savemessagesflags(self, uidflags):
+        """Change the flags of several messages
+
+        Messages getting the same flags are changed together, with one
+        UID STORE FLAGS.SILENT per MAXSEQUENCELENGTH long sequence set.
+        All commands are pipelined. See :meth:`_storeflagscommand` for
+        servers rewriting flags.
+
+        See folder/Base for details."""
+        command = self._storeflagscommand('')
+        groups = {}
+        for uid, flags in uidflags.items():
+            groups.setdefault(frozenset(flags), []).append(uid)
+        def store(imapobj):
             try:
                 imapobj.select(self.getfullname())
             except imapobj.readonly:
-                self.ui.flagstoreadonly(self, [uid], flags)
-                return
-            result = imapobj.uid('store', '%d' % uid, 'FLAGS',
-                                 imaputil.flagsmaildir2imap(flags))
-            assert result[0] == 'OK', 'Error with store: ' + '. '.join(result[1])
-        finally:
-            self.imapserver.releaseconnection(imapobj)
-        result = result[1][0]
-        if not result:
-            self.messagelist[uid]['flags'] = flags
-        else:
-            flags = imaputil.flags2hash(imaputil.imapsplit(result)[1])['FLAGS']
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
+                for flags, uids in groups.items():
+                    self.ui.flagstoreadonly(self, uids, flags)
+                return None
+            pipeline = imapobj.pipeline()
+            for flags, uids in groups.items():
+                for uidseq in imaputil.uid_sequences(uids, MAXSEQUENCELENGTH):
+                    pipeline.queue('uid', 'store', uidseq, command,
+                                   imaputil.flagsmaildir2imap(flags))
+            return pipeline.wait()
+        results = self.imapserver.withconnection(store, self.getfullname())
+        if results is None:
+            return
+        updated = self._storeflagsresults(results)
+        for uid, flags in uidflags.items():
+            if not uid in updated:
+                self.messagelist[uid]['flags'] = set(flags)
+
+    def changemessagesflags(self, uidchanges):
+        """Add and remove flags of several messages
+
+        Messages getting the same changes are changed together, with
+        one UID STORE +FLAGS.SILENT and -FLAGS.SILENT per
+        MAXSEQUENCELENGTH long sequence set, so flags we don't know
+        about, like keywords or changes by other clients, are kept. All
+        commands are pipelined.
+
+        See folder/Base for details."""
+        groups = {}
+        for uid, (addflags, delflags) in uidchanges.items():
+            groups.setdefault((frozenset(addflags), frozenset(delflags)),
+                              []).append(uid)
+        def store(imapobj):
+            try:
+                imapobj.select(self.getfullname())
+            except imapobj.readonly:
+                for (addflags, delflags), uids in groups.items():
+                    self.ui.flagstoreadonly(self, uids, addflags | delflags)
+                return None
+            pipeline = imapobj.pipeline()
+            for (addflags, delflags), uids in groups.items():
+                for uidseq in imaputil.uid_sequences(uids, MAXSEQUENCELENGTH):
+                    for operation, flags in (('+', addflags),
+                                             ('-', delflags)):
+                        if flags:
+                            pipeline.queue('uid', 'store', uidseq,
+                                           self._storeflagscommand(operation),
+                                           imaputil.flagsmaildir2imap(flags))
+            return pipeline.wait()
+        results = self.imapserver.withconnection(store, self.getfullname())
+        if results is None:
+            return
+        updated = self._storeflagsresults(results)
+        for uid, (addflags, delflags) in uidchanges.items():
+            if not uid in updated:
+                self.messagelist[uid]['flags'] = \
+                    (self.messagelist[uid]['flags'] | addflags) - delflags
+
+    def _storeflagscommand(self, operation):
+        """The STORE data item name to use for operation ('+', '-' or '')
+
+        Normally the server is told not to send the new flags back,
+        we know them already. Servers that may store other flags than
+        they are told to (see the rewritesflags setting) have to send
+        them, see :meth:`_storeflagsresults`."""
+        if self.repository.getrewritesflags():
+            return operation + 'FLAGS'
+        return operation + 'FLAGS.SILENT'
+
+    def _storeflagsresults(self, results):
+        """Check the results of pipelined STOREs, and record the flags
+        the server sent back
+
+        :returns: set of the UIDs whose flags have been recorded"""
+        updated = set()
+        for typ, dat in results:
+            assert typ == 'OK', 'Error with store: ' + '. '.join(dat)
+            for result in dat:
+                if result == None:
+                    # Compensate for servers that don't return anything
+                    # from STORE, and for .SILENT stores.
+                    continue
+                attributehash = imaputil.flags2hash(
+                    imaputil.imapsplit(result)[1])
+                if not ('UID' in attributehash and 'FLAGS' in attributehash):
+                    # Compensate for servers that don't return a UID
+                    # attribute.
+                    continue
+                uid = long(attributehash['UID'])
+                if uid in self.messagelist:
+                    self.messagelist[uid]['flags'] = \
+                        imaputil.flagsimap2maildir(attributehash['FLAGS'])
+                    updated.add(uid)
+        return updated
 
     def addmessageflags(self, uid, flags):
         self.addmessagesflags([uid], flags)
@@ -660,48 +1231,31 @@ class IMAPFolder(BaseFolder):
         self.processmessagesflags('-', uidlist, flags)
 
     def processmessagesflags(self, operation, uidlist, flags):
-        if len(uidlist) > 101:
-            # Hack for those IMAP ervers with a limited line length
-            self.processmessagesflags(operation, uidlist[:100], flags)
-            self.processmessagesflags(operation, uidlist[100:], flags)
-            return
-
-        imapobj = self.imapserver.acquireconnection()
-        try:
+        command = self._storeflagscommand(operation)
+        def store(imapobj):
             try:
                 imapobj.select(self.getfullname())
             except imapobj.readonly:
                 self.ui.flagstoreadonly(self, uidlist, flags)
-                return
-            r = imapobj.uid('store',
-                            imaputil.uid_sequence(uidlist),
-                            operation + 'FLAGS',
-                            imaputil.flagsmaildir2imap(flags))
-            assert r[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
-            r = r[1]
-        finally:
-            self.imapserver.releaseconnection(imapobj)
-        # Some IMAP servers do not always return a result.  Therefore,
-        # only update the ones that it talks about, and manually fix
-        # the others.
-        needupdate = list(uidlist)
-        for result in r:
-            if result == None:
-                # Compensate for servers that don't return anything from
-                # STORE.
-                continue
-            attributehash = imaputil.flags2hash(imaputil.imapsplit(result)[1])
-            if not ('UID' in attributehash and 'FLAGS' in attributehash):
-                # Compensate for servers that don't return a UID attribute.
+                return None
+            # Split the UIDs for those IMAP servers with a limited line
+            # length, but pipeline the commands so big changes still
+            # take only one round trip.
+            pipeline = imapobj.pipeline()
+            for uidseq in imaputil.uid_sequences(uidlist, MAXSEQUENCELENGTH):
+                pipeline.queue('uid', 'store', uidseq, command,
+                               imaputil.flagsmaildir2imap(flags))
+            return pipeline.wait()
+        results = self.imapserver.withconnection(store, self.getfullname())
+        if results is None:
+            return
+        # Servers may not send the flags of all messages back, even if
+        # asked to. Therefore, update the ones they talk about, and
+        # manually fix the others.
+        updated = self._storeflagsresults(results)
+        for uid in uidlist:
+            if uid in updated:
                 continue
-            flagstr = attributehash['FLAGS']
-            uid = long(attributehash['UID'])
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flagstr)
-            try:
-                needupdate.remove(uid)
-            except ValueError:          # Let it slide if it's not in the list
-                pass
-        for uid in needupdate:
             if operation == '+':
                 self.messagelist[uid]['flags'] |= flags
             elif operation == '-':
@@ -727,19 +1281,51 @@ class IMAPFolder(BaseFolder):
         if not len(uidlist):
             return
 
-        self.addmessagesflags_noconvert(uidlist, set('T'))
-        imapobj = self.imapserver.acquireconnection()
-        try:
+        # deleted together with all others by commitdeletes()
+        for uid in uidlist:
+            del self.messagelist[uid]
+        self._pendingdeletes.extend(uidlist)
+
+    def _commitdeletes(self):
+        """Delete all messages deletemessages() has been called for
+
+        They are marked \\Deleted with one UID STORE +FLAGS.SILENT per
+        sequence set. If expunging is enabled, servers supporting
+        UIDPLUS (RFC 4315) expunge just them with UID EXPUNGE, so
+        messages other clients marked \\Deleted are left alone. Other
+        servers get a full EXPUNGE. The STOREs and the UID EXPUNGEs are
+        pipelined."""
+        if not self._pendingdeletes:
+            return
+        uidlist = sorted(set(self._pendingdeletes))
+        uidseqs = imaputil.uid_sequences(uidlist, MAXSEQUENCELENGTH)
+        def delete(imapobj):
             try:
                 imapobj.select(self.getfullname())
             except imapobj.readonly:
                 self.ui.deletereadonly(self, uidlist)
                 return
-            if self.expunge:
-                assert(imapobj.expunge()[0] == 'OK')
-        finally:
-            self.imapserver.releaseconnection(imapobj)
-        for uid in uidlist:
-            del self.messagelist[uid]
+            pipeline = imapobj.pipeline()
+            for uidseq in uidseqs:
+                pipeline.queue('uid', 'store', uidseq, '+FLAGS.SILENT',
+                               imaputil.flagsmaildir2imap(set('T')))
+            for typ, dat in pipeline.wait():
+                assert typ == 'OK', 'Error with store: ' + '. '.join(dat)
+            if not self.expunge:
+                return
+            # The flags need to be stored before expunging, so this
+            # can't be part of the same pipeline.
+            if 'UIDPLUS' in imapobj.capabilities:
+                pipeline = imapobj.pipeline()
+                for uidseq in uidseqs:
+                    pipeline.queue('uid', 'expunge', uidseq)
+                results = pipeline.wait()
+            else:
+                results = [imapobj.expunge()]
+            for typ, dat in results:
+                assert typ == 'OK', 'Error with expunge: ' + '. '.join(dat)
+        # Keep the deletes until they succeeded, so they can be retried
+        self.imapserver.withconnection(delete, self.getfullname())
+        self._pendingdeletes = []
 
 
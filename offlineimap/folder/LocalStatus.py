@@ -16,10 +16,18 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from .Base import BaseFolder
+from .MessageList import MessageList
 import os
 import threading
 
-magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
+magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 2"
+"""First line of a status file.
+
+A FORMAT 1 file is a snapshot of 'uid:flags' lines. A FORMAT 2 file
+starts with the same kind of snapshot, which may be followed by journal
+records appended since the last compaction: 'uid:flags' adds or updates
+a message and '-uid' removes it."""
+magicline_v1 = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
 
 
 class LocalStatusFolder(BaseFolder):
@@ -27,11 +35,16 @@ class LocalStatusFolder(BaseFolder):
         self.sep = '.' #needs to be set before super.__init__()
         super(LocalStatusFolder, self).__init__(name, repository)
         self.filename = os.path.join(self.getroot(), self.getfolderbasename())
-        self.messagelist = {}
+        self.messagelist = MessageList()
         self.savelock = threading.Lock()
         self.doautosave = self.config.getdefaultboolean("general", "fsync",
                                                         False)
         """Should we perform fsyncs as often as possible?"""
+        self._journal = None
+        """File object we append journal records to (opened on demand)"""
+        self._journalrecords = None
+        """Number of journal records since the last snapshot. None if
+        the file needs to be rewritten before anything can be appended"""
 
     def storesmessages(self):
         return 0
@@ -52,58 +65,134 @@ class LocalStatusFolder(BaseFolder):
         return self.filename
 
     def deletemessagelist(self):
-        if not self.isnewfolder():
-            os.unlink(self.filename)
+        self.savelock.acquire()
+        try:
+            self._closejournal()
+            self._journalrecords = None
+            if not self.isnewfolder():
+                os.unlink(self.filename)
+        finally:
+            self.savelock.release()
 
-    def cachemessagelist(self):
-        if self.isnewfolder():
-            self.messagelist = {}
-            return
-        file = open(self.filename, "rt")
-        self.messagelist = {}
-        line = file.readline().strip()
-        if not line:
-            # The status file is empty - should not have happened,
-            # but somehow did.
-            errstr = "Cache file '%s' is empty. Closing..." % self.filename
-            self.ui.warn(errstr)
-            file.close()
-            return
-        assert(line == magicline)
-        for line in file.xreadlines():
-            line = line.strip()
-            try:
-                uid, flags = line.split(':')
-                uid = long(uid)
-                flags = set(flags)
-            except ValueError as e:
-                errstr = "Corrupt line '%s' in cache file '%s'" % \
-                    (line, self.filename)
+    def readstatusfile(self, filename):
+        """Read a status file, replaying any journal records in it
+
+        :returns: (messagelist, records) with records being the number
+            of journal records read. records is None if the file needs
+            to be rewritten before appending to it (old file format or
+            a truncated final record)."""
+        messagelist = MessageList()
+        file = open(filename, "rt")
+        try:
+            line = file.readline().strip()
+            if not line:
+                # The status file is empty - should not have happened,
+                # but somehow did.
+                errstr = "Cache file '%s' is empty. Closing..." % filename
                 self.ui.warn(errstr)
-                raise ValueError(errstr)
-            self.messagelist[uid] = {'uid': uid, 'flags': flags}
-        file.close()
+                return messagelist, None
+            assert(line in (magicline, magicline_v1))
+            records = 0 if line == magicline else None
+            lines = 0
+            for line in file:
+                if not line.endswith('\n'):
+                    # A crash while appending the last record. It was
+                    # never acknowledged, so we can safely drop it.
+                    self.ui.warn("Ignoring truncated record '%s' in cache "
+                                 "file '%s'" % (line, filename))
+                    records = None
+                    break
+                line = line.strip()
+                try:
+                    if line.startswith('-'):
+                        messagelist.pop(long(line[1:]), None)
+                    else:
+                        uid, flags = line.split(':')
+                        uid = long(uid)
+                        messagelist[uid] = {'uid': uid, 'flags': set(flags)}
+                except ValueError as e:
+                    errstr = "Corrupt line '%s' in cache file '%s'" % \
+                        (line, filename)
+                    self.ui.warn(errstr)
+                    raise ValueError(errstr)
+                lines += 1
+            if records is not None:
+                # every line beyond the snapshot size is a journal record
+                records = lines - len(messagelist)
+        finally:
+            file.close()
+        return messagelist, records
 
-    def save(self):
+    def cachemessagelist(self):
         self.savelock.acquire()
         try:
-            file = open(self.filename + ".tmp", "wt")
-            file.write(magicline + "\n")
-            for msg in self.messagelist.values():
-                flags = msg['flags']
-                flags = ''.join(sorted(flags))
-                file.write("%s:%s\n" % (msg['uid'], flags))
-            file.flush()
-            if self.doautosave:
-                os.fsync(file.fileno())
-            file.close()
-            os.rename(self.filename + ".tmp", self.filename)
+            self._closejournal()
+            self._journalrecords = None
+            self.messagelist = MessageList()
+            if self.isnewfolder():
+                return
+            self.messagelist, self._journalrecords = \
+                self.readstatusfile(self.filename)
+        finally:
+            self.savelock.release()
+
+    def _closejournal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _compact(self):
+        """Write a fresh snapshot of self.messagelist, dropping the journal
+
+        Needs to be called with self.savelock held."""
+        self._closejournal()
+        file = open(self.filename + ".tmp", "wt")
+        file.write(magicline + "\n")
+        for uid, flags in self.messagelist.iterflags():
+            flags = ''.join(sorted(flags))
+            file.write("%s:%s\n" % (uid, flags))
+        file.flush()
+        if self.doautosave:
+            os.fsync(file.fileno())
+        file.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+        if self.doautosave:
+            fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        self._journalrecords = 0
+
+    def _appendrecord(self, record):
+        """Append a journal record, compacting the journal when needed
 
+        The record must already be reflected in self.messagelist.
+        Compaction happens once the journal has grown as large as the
+        snapshot, which keeps the cost per change amortized O(1)."""
+        self.savelock.acquire()
+        try:
+            if self._journalrecords is None or \
+                    self._journalrecords >= max(1000, len(self.messagelist)):
+                self._compact()
+                return
+            if self._journal is None:
+                self._journal = open(self.filename, "at")
+            self._journal.write(record)
+            self._journal.flush()
             if self.doautosave:
-                fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
-                os.fsync(fd)
-                os.close(fd)
+                os.fsync(self._journal.fileno())
+            self._journalrecords += 1
+        finally:
+            self.savelock.release()
 
+    def save(self):
+        """Fold all journal records into a fresh snapshot"""
+        self.savelock.acquire()
+        try:
+            if self._journalrecords != 0:
+                self._compact()
+            else:
+                self._closejournal()
         finally:
             self.savelock.release()
 
@@ -125,18 +214,24 @@ class LocalStatusFolder(BaseFolder):
             return uid
 
         self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
-        self.save()
+        self._appendrecord("%s:%s\n" % (uid, ''.join(sorted(flags))))
         return uid
 
     def getmessageflags(self, uid):
-        return self.messagelist[uid]['flags']
+        return self.messagelist.getmessageflags(uid)
 
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
 
     def savemessageflags(self, uid, flags):
         self.messagelist[uid]['flags'] = flags
-        self.save()
+        self._appendrecord("%s:%s\n" % (uid, ''.join(sorted(flags))))
+
+    def savemessagesflags(self, uidflags):
+        for uid, flags in uidflags.items():
+            self.messagelist[uid]['flags'] = flags
+        self._appendrecord(''.join(["%s:%s\n" % (uid, ''.join(sorted(flags)))
+                                    for uid, flags in uidflags.items()]))
 
     def deletemessage(self, uid):
         self.deletemessages([uid])
@@ -149,4 +244,4 @@ class LocalStatusFolder(BaseFolder):
 
         for uid in uidlist:
             del(self.messagelist[uid])
-        self.save()
+        self._appendrecord(''.join(["-%s\n" % uid for uid in uidlist]))
@@ -16,8 +16,10 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 import os.path
 import re
+import time
 from threading import Lock
 from .LocalStatus import LocalStatusFolder
+from .MessageList import MessageList
 try:
     import sqlite3 as sqlite
 except:
@@ -46,9 +48,23 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         super(LocalStatusSQLiteFolder, self).__init__(name, repository)       
         # dblock protects against concurrent writes in same connection
         self._dblock = Lock()
+        account = repository.account
+        self._synchronous = account.getconf('status_sqlite_synchronous',
+                                            'normal').upper()
+        if not self._synchronous in ('OFF', 'NORMAL', 'FULL'):
+            raise SyntaxWarning("Unknown status_sqlite_synchronous '%s' for "
+                                "account '%s'" % (self._synchronous,
+                                                  account.name))
+        self._batchsize = account.getconfint('status_sqlite_batchsize', 100)
+        """Commit after this many writes..."""
+        self._batchtime = account.getconffloat('status_sqlite_batchtime', 10)
+        """...or if the oldest uncommitted write is this many seconds old"""
+        self._pending = 0
+        """Number of writes in the currently open transaction"""
+        self._pendingsince = None
         #Try to establish connection, no need for threadsafety in __init__
         try:
-            self.connection = sqlite.connect(self.filename, check_same_thread = False)
+            self.connect()
         except NameError:
             # sqlite import had failed
             raise UserWarning('SQLite backend chosen, but no sqlite python '
@@ -93,7 +109,12 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                     else:
                         cursor = self.connection.execute(sql, vars)
                 success = True
-                self.connection.commit()
+                if not self._pending:
+                    self._pendingsince = time.time()
+                self._pending += 1
+                if self._pending >= self._batchsize or \
+                        time.time() - self._pendingsince >= self._batchtime:
+                    self._commit()
             except sqlite.OperationalError as e:
                 if e.args[0] == 'cannot commit - no transaction is active':
                     pass
@@ -106,13 +127,38 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                 self._dblock.release()
         return cursor
 
-    def upgrade_db(self, from_ver):
-        """Upgrade the sqlite format from version 'from_ver' to current"""
+    def connect(self):
+        """(Re)open self.connection, closing the old one if needed
 
+        The db runs in WAL journal mode, so a commit does not need to
+        rewrite the db file and is only fsync'ed as configured via
+        status_sqlite_synchronous."""
         if hasattr(self, 'connection'):
             self.connection.close() #close old connections first
         self.connection = sqlite.connect(self.filename,
                                          check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=%s' % self._synchronous)
+
+    def _commit(self):
+        """Commit the open transaction. Needs self._dblock to be held"""
+        self.connection.commit()
+        self._pending = 0
+        self._pendingsince = None
+
+    def commit(self):
+        """Commit all pending writes to disk"""
+        self._dblock.acquire()
+        try:
+            if self._pending:
+                self._commit()
+        finally:
+            self._dblock.release()
+
+    def upgrade_db(self, from_ver):
+        """Upgrade the sqlite format from version 'from_ver' to current"""
+
+        self.connect()
 
         if from_ver == 0:
             # from_ver==0: no db existent: plain text migration?
@@ -127,18 +173,12 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                 self.ui._msg('Migrating LocalStatus cache from plain text '
                              'to sqlite database for %s:%s' %\
                                  (self.repository, self))
-                file = open(plaintextfilename, "rt")
-                line = file.readline().strip()
-                data = []
-                for line in file.xreadlines():
-                    uid, flags = line.strip().split(':')
-                    uid = long(uid)
-                    flags = ''.join(sorted(flags))
-                    data.append((uid,flags))
+                messagelist, records = self.readstatusfile(plaintextfilename)
+                data = [(uid, ''.join(sorted(msg['flags'])))
+                        for uid, msg in messagelist.iteritems()]
                 self.connection.executemany('INSERT INTO status (id,flags) VALUES (?,?)',
                                        data)
                 self.connection.commit()
-                file.close()
                 os.rename(plaintextfilename, plaintextfilename + ".old")
         # Future version upgrades come here...
         # if from_ver <= 1: ... #upgrade from 1 to 2
@@ -148,9 +188,7 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         """Create a new db file"""
         self.ui._msg('Creating new Local Status db for %s:%s' \
                          % (self.repository, self))
-        if hasattr(self, 'connection'):
-            self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename, check_same_thread = False)
+        self.connect()
         self.connection.executescript("""
         CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
         INSERT INTO metadata VALUES('db_version', '1');
@@ -169,15 +207,16 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         self.sql_write('DELETE FROM status')
 
     def cachemessagelist(self):
-        self.messagelist = {}
-        cursor = self.connection.execute('SELECT id,flags from status')
+        self.messagelist = MessageList()
+        cursor = self.connection.execute('SELECT id,flags from status '
+                                         'ORDER BY id')
         for row in cursor:
                 flags = set(row[1])
                 self.messagelist[row[0]] = {'uid': row[0], 'flags': flags}
 
     def save(self):
-        #Noop in this backend
-        pass
+        """Commit any writes that are still batched up"""
+        self.commit()
 
     # Following some pure SQLite functions, where we chose to use
     # BaseFolder() methods instead. Doing those on the in-memory list is
@@ -240,6 +279,14 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         flags = ''.join(sorted(flags))
         self.sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
 
+    def savemessagesflags(self, uidflags):
+        """Update the flags of several messages with one executemany()"""
+        for uid, flags in uidflags.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        self.sql_write('UPDATE status SET flags=? WHERE id=?',
+                       [(''.join(sorted(flags)), uid)
+                        for uid, flags in uidflags.items()], True)
+
     def deletemessage(self, uid):
         if not uid in self.messagelist:
             return
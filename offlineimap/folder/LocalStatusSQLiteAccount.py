@@ -0,0 +1,281 @@
+# Local status cache virtual folder: one SQLite database per account
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os.path
+import time
+import threading
+from .LocalStatus import LocalStatusFolder
+from .MessageList import MessageList
+from offlineimap.ui import getglobalui
+try:
+    import sqlite3 as sqlite
+except:
+    pass #fail only if needed later on, not on import
+
+
+class AccountStatusDB(object):
+    """SQLite database holding the status of all folders of an account
+
+    All writes go through a single connection and are batched into
+    transactions, see :meth:`write`. Reads use one connection per
+    thread, so that folder threads can load their message lists
+    concurrently."""
+
+    #current version of our db format
+    cur_version = 1
+
+    def __init__(self, filename, account):
+        self.filename = filename
+        self.ui = getglobalui()
+        self._synchronous = account.getconf('status_sqlite_synchronous',
+                                            'normal').upper()
+        if not self._synchronous in ('OFF', 'NORMAL', 'FULL'):
+            raise SyntaxWarning("Unknown status_sqlite_synchronous '%s' for "
+                                "account '%s'" % (self._synchronous,
+                                                  account.name))
+        self._batchsize = account.getconfint('status_sqlite_batchsize', 100)
+        self._batchtime = account.getconffloat('status_sqlite_batchtime', 10)
+        self._pending = 0
+        self._pendingsince = None
+        # dblock serializes all use of the writer connection
+        self._dblock = threading.Lock()
+        self._local = threading.local()
+        try:
+            self._writer = sqlite.connect(self.filename,
+                                          check_same_thread = False)
+        except NameError:
+            # sqlite import had failed
+            raise UserWarning('SQLite backend chosen, but no sqlite python '
+                              'bindings available. Please install.')
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer.execute('PRAGMA synchronous=%s' % self._synchronous)
+        try:
+            self._writer.execute("SELECT value from metadata "
+                                 "WHERE key='db_version'")
+        except sqlite.DatabaseError:
+            self.create_db()
+        # Future version upgrades come here...
+
+    def create_db(self):
+        """Create the tables in a new db file"""
+        self.ui._msg('Creating new Local Status db %s' % self.filename)
+        self._writer.executescript("""
+        CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
+        INSERT INTO metadata VALUES('db_version', '1');
+        CREATE TABLE folders (id INTEGER PRIMARY KEY,
+                              name VARCHAR(256) UNIQUE NOT NULL);
+        CREATE TABLE status (folder INTEGER NOT NULL, id INTEGER NOT NULL,
+                             flags VARCHAR(50), PRIMARY KEY (folder, id));
+        """)
+        self._writer.commit()
+
+    def getconnection(self):
+        """Return the current thread's connection for reading"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite.connect(self.filename)
+            self._local.connection = connection
+        return connection
+
+    def write(self, sql, vars=None, executemany=False):
+        """Execute some SQL on the writer connection, retrying if locked
+
+        The transaction is committed once status_sqlite_batchsize
+        writes are pending or the oldest pending write is older than
+        status_sqlite_batchtime seconds. Call :meth:`commit` to commit
+        earlier.
+
+        :param sql: the SQL string passed to execute()
+        :param vars: the variable values to `sql`
+        :param executemany: bool indicating whether we want to
+            perform conn.executemany() or conn.execute().
+        :returns: the Cursor() or raises an Exception"""
+        while True:
+            self._dblock.acquire()
+            try:
+                if executemany:
+                    cursor = self._writer.executemany(sql, vars)
+                else:
+                    cursor = self._writer.execute(sql, vars or ())
+                if not self._pending:
+                    self._pendingsince = time.time()
+                self._pending += 1
+                if self._pending >= self._batchsize or \
+                        time.time() - self._pendingsince >= self._batchtime:
+                    self._commit()
+                return cursor
+            except sqlite.OperationalError as e:
+                if e.args[0] != 'database is locked':
+                    raise
+                self.ui.debug('', "Locked sqlite database, retrying.")
+            finally:
+                self._dblock.release()
+
+    def _commit(self):
+        """Commit the open transaction. Needs self._dblock to be held"""
+        self._writer.commit()
+        self._pending = 0
+        self._pendingsince = None
+
+    def commit(self):
+        """Commit all pending writes to disk"""
+        self._dblock.acquire()
+        try:
+            if self._pending:
+                self._commit()
+        finally:
+            self._dblock.release()
+
+    def getfolderid(self, name):
+        """Return the id of folder `name` or None if it is unknown"""
+        cursor = self.getconnection().execute(
+            'SELECT id FROM folders WHERE name=?', (name,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def addfolder(self, name, data):
+        """Add folder `name` with initial status data
+
+        :param data: list of (uid, flags) tuples, flags being a string
+        :returns: the id of the new folder"""
+        self._dblock.acquire()
+        try:
+            cursor = self._writer.execute(
+                'SELECT id FROM folders WHERE name=?', (name,))
+            row = cursor.fetchone()
+            if row: # someone beat us to it
+                return row[0]
+            cursor = self._writer.execute(
+                'INSERT INTO folders (name) VALUES (?)', (name,))
+            folderid = cursor.lastrowid
+            self._writer.executemany(
+                'INSERT INTO status (folder,id,flags) VALUES (?,?,?)',
+                [(folderid, uid, flags) for (uid, flags) in data])
+            self._commit()
+            return folderid
+        finally:
+            self._dblock.release()
+
+    def getfoldernames(self):
+        """Return the names of all folders in the db"""
+        cursor = self.getconnection().execute('SELECT name FROM folders')
+        return [row[0] for row in cursor]
+
+
+class LocalStatusSQLiteAccountFolder(LocalStatusFolder):
+    """LocalStatus backend storing all folders in one SQLite db per account
+
+    The :class:`AccountStatusDB` is shared by all folders of the
+    repository. When a folder is first used, its status is migrated
+    from the per-folder sqlite or plain text files if they exist."""
+
+    def __init__(self, name, repository):
+        super(LocalStatusSQLiteAccountFolder, self).__init__(name, repository)
+        self.db = repository.getstatusdb()
+        self.filename = self.db.filename
+        self.folderid = self.db.getfolderid(self.getfolderbasename())
+        if self.folderid is None:
+            self.folderid = self.db.addfolder(self.getfolderbasename(),
+                                              self._getmigrationdata())
+
+    def _getmigrationdata(self):
+        """Return the status of this folder as kept by the per-folder
+        backends as list of (uid, flags) tuples"""
+        basename = self.getfolderbasename()
+        metadir = self.repository.account.getaccountmeta()
+        filename = os.path.join(metadir, 'LocalStatus-sqlite', basename)
+        if os.path.exists(filename):
+            self.ui._msg('Migrating LocalStatus cache from per-folder sqlite '
+                         'database to account database for %s:%s' %
+                         (self.repository, self))
+            connection = sqlite.connect(filename)
+            try:
+                return connection.execute('SELECT id,flags FROM status')\
+                    .fetchall()
+            finally:
+                connection.close()
+        filename = os.path.join(metadir, 'LocalStatus', basename)
+        if os.path.exists(filename):
+            self.ui._msg('Migrating LocalStatus cache from plain text '
+                         'to account database for %s:%s' %
+                         (self.repository, self))
+            messagelist, records = self.readstatusfile(filename)
+            return [(uid, ''.join(sorted(msg['flags'])))
+                    for uid, msg in messagelist.iteritems()]
+        return []
+
+    def deletemessagelist(self):
+        """delete all messages of this folder in the db"""
+        self.db.write('DELETE FROM status WHERE folder=?', (self.folderid,))
+        self.messagelist = MessageList()
+
+    def cachemessagelist(self):
+        # reader connections only see committed data
+        self.db.commit()
+        self.messagelist = MessageList()
+        cursor = self.db.getconnection().execute(
+            'SELECT id,flags FROM status WHERE folder=? ORDER BY id',
+            (self.folderid,))
+        for row in cursor:
+            self.messagelist[row[0]] = {'uid': row[0], 'flags': set(row[1])}
+
+    def save(self):
+        """Commit any writes that are still batched up"""
+        self.db.commit()
+
+    def savemessage(self, uid, content, flags, rtime):
+        """Writes a new message, with the specified uid.
+
+        See folder/Base for detail. Note that savemessage() does not
+        check against dryrun settings, so you need to ensure that
+        savemessage is never called in a dryrun mode."""
+        if uid < 0:
+            # We cannot assign a uid.
+            return uid
+
+        if self.uidexists(uid):     # already have it
+            self.savemessageflags(uid, flags)
+            return uid
+
+        self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+        flags = ''.join(sorted(flags))
+        self.db.write('INSERT INTO status (folder,id,flags) VALUES (?,?,?)',
+                      (self.folderid, uid, flags))
+        return uid
+
+    def savemessageflags(self, uid, flags):
+        self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        flags = ''.join(sorted(flags))
+        self.db.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                      (flags, self.folderid, uid))
+
+    def savemessagesflags(self, uidflags):
+        for uid, flags in uidflags.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        self.db.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                      [(''.join(sorted(flags)), self.folderid, uid)
+                       for uid, flags in uidflags.items()], True)
+
+    def deletemessages(self, uidlist):
+        """Delete list of UIDs from status cache"""
+        # Weed out ones not in self.messagelist
+        uidlist = [uid for uid in uidlist if uid in self.messagelist]
+        if not len(uidlist):
+            return
+        self.db.write('DELETE FROM status WHERE folder=? AND id=?',
+                      [(self.folderid, uid) for uid in uidlist], True)
+        for uid in uidlist:
+            del(self.messagelist[uid])
@@ -19,8 +19,12 @@ import socket
 import time
 import re
 import os
+import marshal
+from itertools import izip
 from .Base import BaseFolder
+from .MessageList import MessageList
 from threading import Lock
+from offlineimap import imaputil
 
 try:
     from hashlib import md5
@@ -32,12 +36,22 @@ try: # python 2.6 has set() built in
 except NameError:
     from sets import Set as set
 
+try: # python 3.5 has scandir built in
+    from os import scandir
+except ImportError:
+    try: # backport from PyPI
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from offlineimap import OfflineImapError
 
 # Find the UID in a message filename
 re_uidmatch = re.compile(',U=(\d+)')
 # Find a numeric timestamp in a string (filename prefix)
 re_timestampmatch = re.compile('(\d+)');
+# Format version of the Maildir scan cache files
+scancacheversion = 1
 
 timeseq = 0
 lasttime = 0
@@ -58,6 +72,23 @@ def gettimeseq():
     finally:
         timelock.release()
 
+def listsubdirs(path):
+    """Return the names of the directories in path
+
+    With scandir, no stat() per entry is needed on file systems that
+    report the entry type along with the name."""
+    if scandir is None:
+        return [name for name in os.listdir(path)
+                if os.path.isdir(os.path.join(path, name))]
+    return [entry.name for entry in scandir(path) if entry.is_dir()]
+
+def listfilesizes(path):
+    """Return (name, size) tuples for the entries of path"""
+    if scandir is None:
+        return [(name, os.path.getsize(os.path.join(path, name)))
+                for name in os.listdir(path)]
+    return [(entry.name, entry.stat().st_size) for entry in scandir(path)]
+
 class MaildirFolder(BaseFolder):
     def __init__(self, root, name, sep, repository):
         self.sep = sep # needs to be set before super().__init__
@@ -65,6 +96,8 @@ class MaildirFolder(BaseFolder):
         self.dofsync = self.config.getdefaultboolean("general", "fsync", True)
         self.root = root
         self.messagelist = None
+        # (uid, filename) of deleted messages, see commitdeletes()
+        self._pendingdeletes = []
         # check if we should use a different infosep to support Win file systems
         self.wincompatible = self.config.getdefaultboolean(
             "Account "+self.accountname, "maildir-windows-compatible", False)
@@ -145,60 +178,119 @@ class MaildirFolder(BaseFolder):
             flags = set((c for c in flagmatch.group(1) if not c.islower()))
         return prefix, uid, fmd5, flags
 
+    def _getscancachefilename(self):
+        return os.path.join(self.repository.getscancachedir(),
+                            self.getfolderbasename())
+
+    def _loadscancache(self):
+        """Load the directory listings saved by :meth:`_savescancache`
+
+        :returns: dict mapping 'new' and 'cur' to (mtime, entries), with
+            entries being a dict of filename: (uid, flags), flags as a
+            string. Empty if there is no (usable) cache."""
+        filename = self._getscancachefilename()
+        if not os.path.exists(filename):
+            return {}
+        file = open(filename, 'rb')
+        try:
+            try:
+                version, infosep, cache = marshal.load(file)
+            except (EOFError, ValueError, TypeError):
+                self.ui.warn("Ignoring corrupt Maildir scan cache '%s'" %
+                             filename, minor = 1)
+                return {}
+        finally:
+            file.close()
+        if version != scancacheversion or infosep != self.infosep:
+            return {}
+        return cache
+
+    def _savescancache(self, cache):
+        """Save the directory listings of new/ and cur/
+
+        :param cache: dict as returned by :meth:`_loadscancache`"""
+        filename = self._getscancachefilename()
+        file = open(filename + '.tmp', 'wb')
+        marshal.dump((scancacheversion, self.infosep, cache), file)
+        file.close()
+        os.rename(filename + '.tmp', filename)
+
     def _scanfolder(self):
         """Cache the message list from a Maildir.
 
+        Unless maxage or maxsize are used, the parsed listing of new/
+        and cur/ is cached on disk together with their mtimes. A
+        directory whose mtime did not change since is not listed again,
+        and in one that did, only the names not in the cache get parsed.
+
         Maildir flags are: R (replied) S (seen) T (trashed) D (draft) F
         (flagged).
-        :returns: dict that can be used as self.messagelist"""
+        :returns: MessageList that can be used as self.messagelist"""
         maxage = self.config.getdefaultint("Account " + self.accountname,
                                            "maxage", None)
         maxsize = self.config.getdefaultint("Account " + self.accountname,
                                             "maxsize", None)
-        retval = {}
-        files = []
+        usecache = self.repository.getscancachedir() is not None and \
+            not maxage and not maxsize
+        cache = self._loadscancache() if usecache else {}
+        retval = []
+        changed = False
         nouidcounter = -1          # Messages without UIDs get negative UIDs.
         for dirannex in ['new', 'cur']:
             fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend((dirannex, filename) for
-                         filename in os.listdir(fulldirname))
-
-        for dirannex, filename in files:
-            # We store just dirannex and filename, ie 'cur/123...'
-            filepath = os.path.join(dirannex, filename)
-            # check maxage/maxsize if this message should be considered
-            if maxage and not self._iswithinmaxage(filename, maxage):
-                continue
-            if maxsize and (os.path.getsize(os.path.join(
-                        self.getfullname(), filepath)) > maxsize):
-                continue
-
-            (prefix, uid, fmd5, flags) = self._parse_filename(filename)
-            if uid is None: # assign negative uid to upload it.
-                uid = nouidcounter
-                nouidcounter -= 1
-            else:                       # It comes from our folder.
-                uidmatch = re_uidmatch.search(filename)
-                uid = None
-                if not uidmatch:
+            # stat before listing, so changes while listing are noticed
+            mtime = os.path.getmtime(fulldirname)
+            cachedmtime, known = cache.get(dirannex, (None, {}))
+            if mtime == cachedmtime:
+                entries = known
+            else:
+                changed = True
+                entries = {}
+                if maxsize:
+                    files = listfilesizes(fulldirname)
+                else:
+                    files = [(name, None) for name in os.listdir(fulldirname)]
+                for filename, size in files:
+                    if filename in known:
+                        entries[filename] = known[filename]
+                        continue
+                    # check maxage/maxsize if this message should be considered
+                    if maxage and not self._iswithinmaxage(filename, maxage):
+                        continue
+                    if maxsize and size > maxsize:
+                        continue
+                    (prefix, uid, fmd5, flags) = self._parse_filename(filename)
+                    entries[filename] = (uid, ''.join(sorted(flags)))
+                if time.time() - mtime < 2:
+                    # The directory might change again within the mtime
+                    # granularity, don't trust the cached listing.
+                    mtime = -1
+            cache[dirannex] = (mtime, entries)
+
+            dirprefix = os.path.join(dirannex, '')
+            for filename, (uid, flags) in entries.iteritems():
+                if uid is None: # assign negative uid to upload it.
                     uid = nouidcounter
                     nouidcounter -= 1
-                else:
-                    uid = long(uidmatch.group(1))
-            # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
-            retval[uid] = {'flags': flags, 'filename': filepath}
-        return retval
+                # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
+                retval.append((uid, flags, dirprefix + filename))
+        if usecache and changed:
+            self._savescancache(cache)
+        retval.sort()
+        return MessageList((uid, {'flags': flags, 'filename': filename})
+                           for uid, flags, filename in retval)
 
     def quickchanged(self, statusfolder):
         """Returns True if the Maildir has changed"""
         self.cachemessagelist()
         # Folder has different uids than statusfolder => TRUE
-        if sorted(self.getmessageuidlist()) != \
-                sorted(statusfolder.getmessageuidlist()):
+        if self.getmessagecount() != statusfolder.getmessagecount():
             return True
-        # Also check for flag changes, it's quick on a Maildir 
-        for (uid, message) in self.getmessagelist().iteritems():
-            if message['flags'] != statusfolder.getmessageflags(uid):
+        # Also check for flag changes, it's quick on a Maildir
+        # Same number of messages, so the sorted lists must match
+        for mine, status in izip(self.getmessagelist().iterflags(),
+                             statusfolder.getmessagelist().iterflags()):
+            if mine != status:
                 return True
         return False  #Nope, nothing changed
 
@@ -210,9 +302,17 @@ class MaildirFolder(BaseFolder):
         return self.messagelist
 
     def getmessage(self, uid):
-        """Return the content of the message"""
+        """Return the content of the message
+
+        Messages bigger than the streamthreshold of the repository are
+        returned as open file, which the caller closes once it has been
+        saved (see imaputil.closemessage()). An IMAP destination
+        converts their line ends while uploading them."""
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
+        threshold = self.repository.getstreamthreshold()
+        if threshold and os.path.getsize(filepath) > threshold:
+            return open(filepath, 'rb')
         file = open(filepath, 'rt')
         retval = file.read()
         file.close()
@@ -272,7 +372,16 @@ class MaildirFolder(BaseFolder):
                 raise
 
         file = os.fdopen(fd, 'wt')
-        file.write(content)
+        if imaputil.isliteralfile(content):
+            # spooled to disk, still with the CRLF line ends of IMAP
+            for chunk in imaputil.linechunks(content):
+                file.write(chunk)
+        elif imaputil.ismessagefile(content):
+            # e.g. from another Maildir, copy it as it is
+            for chunk in imaputil.messagechunks(content):
+                file.write(chunk)
+        else:
+            file.write(content)
         # Make sure the data hits the disk
         file.flush()
         if self.dofsync:
@@ -290,7 +399,7 @@ class MaildirFolder(BaseFolder):
         return uid
 
     def getmessageflags(self, uid):
-        return self.messagelist[uid]['flags']
+        return self.messagelist.getmessageflags(uid)
 
     def savemessageflags(self, uid, flags):
         """Sets the specified message's flags to the given set.
@@ -357,20 +466,52 @@ class MaildirFolder(BaseFolder):
         :return: Nothing, or an Exception if UID but no corresponding file
                  found.
         """
-        if not self.uidexists(uid):
-            return
+        self.deletemessages([uid])
 
-        filename = self.messagelist[uid]['filename']
-        filepath = os.path.join(self.getfullname(), filename)
+    def deletemessages(self, uidlist):
+        """Unlinks message files from the Maildir
+
+        The files are unlinked together by commitdeletes()."""
+        for uid in uidlist:
+            if not self.uidexists(uid):
+                continue
+            self._pendingdeletes.append((uid,
+                                         self.messagelist[uid]['filename']))
+            del(self.messagelist[uid])
+
+    def _commitdeletes(self):
+        """Unlink the files of all deleted messages
+
+        The directories they were in are fsync'ed once afterwards, if
+        fsync is enabled. Messages that could not be deleted are kept
+        for the next call."""
+        if not self._pendingdeletes:
+            return
+        newmsglist = None
+        dirs = set()
+        done = 0
         try:
-            os.unlink(filepath)
-        except OSError:
-            # Can't find the file -- maybe already deleted?
-            newmsglist = self._scanfolder()
-            if uid in newmsglist:       # Nope, try new filename.
-                filename = newmsglist[uid]['filename']
+            for uid, filename in self._pendingdeletes:
                 filepath = os.path.join(self.getfullname(), filename)
-                os.unlink(filepath)
-            # Yep -- return.
-        del(self.messagelist[uid])
+                try:
+                    os.unlink(filepath)
+                except OSError:
+                    # Can't find the file -- maybe already deleted?
+                    if newmsglist is None:
+                        newmsglist = self._scanfolder()
+                    if uid in newmsglist:
+                        # Nope, try new filename.
+                        filename = newmsglist[uid]['filename']
+                        filepath = os.path.join(self.getfullname(), filename)
+                        os.unlink(filepath)
+                done += 1
+                dirs.add(os.path.dirname(filepath))
+        finally:
+            # keep the ones not deleted yet
+            del self._pendingdeletes[:done]
+        if self.dofsync:
+            for dirpath in dirs:
+                fd = os.open(dirpath, os.O_RDONLY)
+                os.fsync(fd)
+                os.close(fd)
         
@@ -0,0 +1,446 @@
+# Compact message list shared by the folder backends
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+from array import array
+from bisect import bisect_left
+from itertools import izip
+from threading import Lock
+
+# Maildir flags that are stored as bits, all others are kept in a dict
+FLAGS = 'DFPRST'
+_FLAGBITS = dict((flag, 1 << i) for i, flag in enumerate(FLAGS))
+_FLAGMASK = (1 << len(FLAGS)) - 1
+_FLAGSETS = [frozenset(flag for flag in FLAGS if mask & _FLAGBITS[flag])
+             for mask in xrange(_FLAGMASK + 1)]
+_EXTRA = 0x40   # message has flags in self._extra
+_DELETED = 0x80 # slot is unused until the next merge
+
+# Don't merge fewer new messages than this into the arrays
+MERGE_MIN = 1024
+
+_MISSING = object()
+
+# IMAP UIDs go up to 2**32 - 1 and local ones are negative, which fits
+# into a C long only where that has 64 bits. Elsewhere (e.g. Windows or
+# 32 bit systems) fall back to a list.
+if array('l').itemsize >= 8:
+    def _uidarray():
+        return array('l')
+else:
+    _uidarray = list
+
+
+def _encodeflags(flags):
+    """:returns: (bitmask, frozenset of the flags without a bit or None)"""
+    mask = 0
+    extra = None
+    for flag in flags or ():
+        bit = _FLAGBITS.get(flag)
+        if bit is None:
+            extra = (extra or set())
+            extra.add(flag)
+        else:
+            mask |= bit
+    if extra:
+        return mask | _EXTRA, frozenset(extra)
+    return mask, None
+
+
+class MessageList(object):
+    """Mapping of UIDs to messages, stored compactly
+
+    Behaves like the dict of {'uid': uid, 'flags': set(...), ...}
+    dicts the backends used to keep, but without a dict and a set per
+    message: UIDs are kept in a sorted array, flags as a bitmask byte
+    and any other key (e.g. 'time', 'filename', 'size') in a list
+    parallel to the UIDs. Indexing returns a :class:`Message` view,
+    so message['flags'] always is a new set and changes have to be
+    assigned, e.g. ml[uid]['flags'] = flags.
+
+    New messages with a higher UID than all others are appended right
+    away, others are collected in a small dict and merged in once that
+    grows. Deleted messages leave an unused slot until the next merge.
+
+    Instance variables (self.):
+      _uids: sorted array (or list) of UIDs
+      _flags: bytearray of flag bitmasks, parallel to _uids
+      _columns: dict mapping other keys to lists parallel to _uids
+      _extra: dict mapping UIDs to flags without a bit in FLAGS
+      _pending: dict of messages not merged into the arrays yet
+      _count: number of used slots in the arrays"""
+
+    def __init__(self, messages=None):
+        """
+        :param messages: dict or iterable of (uid, message) pairs to
+            start with, message being a dict. Pass them sorted by UID
+            to avoid keeping them all in memory at once."""
+        self._lock = Lock()
+        self._uids = _uidarray()
+        self._flags = bytearray()
+        self._columns = {}
+        self._extra = {}
+        self._pending = {}
+        self._count = 0
+        if isinstance(messages, dict):
+            messages = sorted(messages.iteritems())
+        for uid, msg in messages or ():
+            self._set(uid, msg)
+        self._merge()
+
+    def _find(self, uid):
+        """:returns: the index of the used slot for uid or -1"""
+        if not self._uids or uid > self._uids[-1]:
+            return -1
+        i = bisect_left(self._uids, uid)
+        if i < len(self._uids) and self._uids[i] == uid and \
+                not self._flags[i] & _DELETED:
+            return i
+        return -1
+
+    def _append(self, uid, msg):
+        """Append a message, its UID must be higher than all others"""
+        columns = self._columns
+        for key in msg:
+            if key not in columns and key != 'uid' and key != 'flags':
+                columns[key] = [_MISSING] * len(self._uids)
+        for key, column in columns.iteritems():
+            column.append(msg.get(key, _MISSING))
+        mask, extra = _encodeflags(msg.get('flags'))
+        self._uids.append(uid)
+        self._flags.append(mask)
+        if extra:
+            self._extra[uid] = extra
+        self._count += 1
+
+    def _merge(self):
+        """Merge self._pending into the arrays, dropping unused slots"""
+        pending = self._pending
+        uids, flags, columns = self._uids, self._flags, self._columns
+        if self._count == len(uids):
+            if not pending:
+                return
+            if not uids or min(pending) > uids[-1]:
+                self._pending = {}
+                for uid in sorted(pending):
+                    self._append(uid, pending[uid])
+                return
+        self._pending = {}
+        keys = set(columns)
+        for msg in pending.itervalues():
+            keys.update(msg)
+        keys.difference_update(('uid', 'flags'))
+        self._uids = _uidarray()
+        self._flags = bytearray()
+        self._columns = dict((key, []) for key in keys)
+        self._count = 0
+        merged = [(uids[i], i) for i in xrange(len(uids))
+                  if not flags[i] & _DELETED]
+        merged.extend((uid, -1) for uid in pending)
+        merged.sort()
+        for uid, i in merged:
+            if i < 0:
+                self._append(uid, pending[uid])
+                continue
+            self._uids.append(uid)
+            self._flags.append(flags[i])
+            for key, column in self._columns.iteritems():
+                column.append(columns[key][i] if key in columns else _MISSING)
+            self._count += 1
+
+    def _set(self, uid, msg):
+        if not self._pending and (not self._uids or uid > self._uids[-1]):
+            self._append(uid, msg)
+            return
+        i = self._find(uid)
+        if i < 0:
+            self._pending[uid] = dict(msg)
+            if len(self._pending) > max(MERGE_MIN, self._count >> 3):
+                self._merge()
+            return
+        self._setflags(i, uid, msg.get('flags'))
+        for key in msg:
+            if key not in ('uid', 'flags') and key not in self._columns:
+                self._columns[key] = [_MISSING] * len(self._uids)
+        for key, column in self._columns.iteritems():
+            column[i] = msg.get(key, _MISSING)
+
+    def _setflags(self, i, uid, flags):
+        mask, extra = _encodeflags(flags)
+        self._flags[i] = mask
+        if extra:
+            self._extra[uid] = extra
+        else:
+            self._extra.pop(uid, None)
+
+    def _getflags(self, i, uid):
+        flags = set(_FLAGSETS[self._flags[i] & _FLAGMASK])
+        if self._flags[i] & _EXTRA:
+            flags.update(self._extra[uid])
+        return flags
+
+    def _delete(self, uid):
+        if uid in self._pending:
+            del self._pending[uid]
+            return
+        i = self._find(uid)
+        if i < 0:
+            raise KeyError(uid)
+        self._flags[i] = _DELETED
+        self._extra.pop(uid, None)
+        for column in self._columns.itervalues():
+            column[i] = _MISSING
+        self._count -= 1
+        if len(self._uids) - self._count > max(MERGE_MIN, self._count):
+            self._merge()
+
+    def getfield(self, uid, key, default=_MISSING):
+        """Return the value of key for the message with uid
+
+        :raises KeyError: if there is no such message or it has no such
+            key and no default was given"""
+        self._lock.acquire()
+        try:
+            msg = self._pending.get(uid)
+            if msg is not None:
+                if key == 'uid':
+                    return uid
+                value = msg.get(key, _MISSING)
+                if key == 'flags' and value is not _MISSING:
+                    value = set(value or ())
+            else:
+                i = self._find(uid)
+                if i < 0:
+                    raise KeyError(uid)
+                if key == 'uid':
+                    return uid
+                if key == 'flags':
+                    return self._getflags(i, uid)
+                column = self._columns.get(key)
+                value = _MISSING if column is None else column[i]
+        finally:
+            self._lock.release()
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    def setfield(self, uid, key, value):
+        """Set key of the message with uid to value"""
+        self._lock.acquire()
+        try:
+            msg = self._pending.get(uid)
+            if msg is not None:
+                msg[key] = value
+                return
+            i = self._find(uid)
+            if i < 0:
+                raise KeyError(uid)
+            if key == 'flags':
+                self._setflags(i, uid, value)
+            elif key != 'uid':
+                if key not in self._columns:
+                    self._columns[key] = [_MISSING] * len(self._uids)
+                self._columns[key][i] = value
+        finally:
+            self._lock.release()
+
+    def _getmessage(self, uid):
+        """:returns: the message with uid as dict, without locking"""
+        msg = self._pending.get(uid)
+        if msg is not None:
+            msg = dict(msg)
+            msg['flags'] = set(msg.get('flags') or ())
+        else:
+            i = self._find(uid)
+            if i < 0:
+                raise KeyError(uid)
+            msg = {'flags': self._getflags(i, uid)}
+            for key, column in self._columns.iteritems():
+                if column[i] is not _MISSING:
+                    msg[key] = column[i]
+        msg['uid'] = uid
+        return msg
+
+    def getmessage(self, uid):
+        """:returns: a copy of the message with uid as dict"""
+        self._lock.acquire()
+        try:
+            return self._getmessage(uid)
+        finally:
+            self._lock.release()
+
+    def uidexists(self, uid):
+        """Returns True if uid exists"""
+        self._lock.acquire()
+        try:
+            return uid in self._pending or self._find(uid) >= 0
+        finally:
+            self._lock.release()
+
+    def getmessageflags(self, uid):
+        """Returns the flags for the message with uid as a new set"""
+        return self.getfield(uid, 'flags')
+
+    def keys(self):
+        """:returns: a sorted list of all UIDs"""
+        self._lock.acquire()
+        try:
+            if self._count == len(self._uids):
+                uids = list(self._uids)
+            else:
+                uids = [uid for uid, mask in zip(self._uids, self._flags)
+                        if not mask & _DELETED]
+            if self._pending:
+                uids.extend(self._pending)
+                uids.sort()
+            return uids
+        finally:
+            self._lock.release()
+
+    def iterflags(self):
+        """Yields (uid, frozenset of flags) for all messages, sorted by UID
+
+        Quicker than looking at the messages one by one. Works on a
+        copy of the arrays, so the list may be changed meanwhile."""
+        self._lock.acquire()
+        try:
+            if self._pending:
+                self._merge()
+            uids = self._uids[:]
+            masks = self._flags[:]
+            extra = self._extra.copy()
+        finally:
+            self._lock.release()
+        for uid, mask in izip(uids, masks):
+            if mask & _DELETED:
+                continue
+            flags = _FLAGSETS[mask & _FLAGMASK]
+            if mask & _EXTRA:
+                flags = flags | extra[uid]
+            yield (uid, flags)
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for uid in self.keys():
+            yield Message(self, uid)
+
+    def iteritems(self):
+        for uid in self.keys():
+            yield (uid, Message(self, uid))
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __len__(self):
+        return self._count + len(self._pending)
+
+    def __contains__(self, uid):
+        return self.uidexists(uid)
+
+    def __getitem__(self, uid):
+        if not self.uidexists(uid):
+            raise KeyError(uid)
+        return Message(self, uid)
+
+    def get(self, uid, default=None):
+        if not self.uidexists(uid):
+            return default
+        return Message(self, uid)
+
+    def __setitem__(self, uid, msg):
+        if isinstance(msg, Message):
+            msg = msg.copy()
+        self._lock.acquire()
+        try:
+            self._set(uid, msg)
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, uid):
+        self._lock.acquire()
+        try:
+            self._delete(uid)
+        finally:
+            self._lock.release()
+
+    def pop(self, uid, default=_MISSING):
+        """Remove the message with uid
+
+        :returns: a copy of the message as dict, or default"""
+        self._lock.acquire()
+        try:
+            try:
+                msg = self._getmessage(uid)
+            except KeyError:
+                if default is _MISSING:
+                    raise
+                return default
+            self._delete(uid)
+            return msg
+        finally:
+            self._lock.release()
+
+
+class Message(object):
+    """View of one message in a :class:`MessageList`
+
+    Reading and assigning keys goes straight to the message list."""
+
+    __slots__ = ('messagelist', 'uid')
+
+    def __init__(self, messagelist, uid):
+        self.messagelist = messagelist
+        self.uid = uid
+
+    def __getitem__(self, key):
+        return self.messagelist.getfield(self.uid, key)
+
+    def __setitem__(self, key, value):
+        self.messagelist.setfield(self.uid, key, value)
+
+    def get(self, key, default=None):
+        return self.messagelist.getfield(self.uid, key, default)
+
+    def copy(self):
+        return self.messagelist.getmessage(self.uid)
+
+    def keys(self):
+        return self.copy().keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key in self.copy()
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.copy())
@@ -15,7 +15,10 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 from threading import Lock
+from .Base import BaseFolder
 from .IMAP import IMAPFolder
+from .MessageList import MessageList
+from offlineimap import OfflineImapError
 import os.path
 
 class MappedIMAPFolder(IMAPFolder):
@@ -121,6 +124,12 @@ class MappedIMAPFolder(IMAPFolder):
         finally:
             self.maplock.release()
 
+    def save_quickstatus(self):
+        self._mb.save_quickstatus()
+
+    def _commitdeletes(self):
+        self._mb.commitdeletes()
+
     def uidexists(self, ruid):
         """Checks if the (remote) UID exists in this Folder"""
         # This implementation overrides the one in BaseFolder, as it is
@@ -141,12 +150,33 @@ class MappedIMAPFolder(IMAPFolder):
         # much more efficient for the mapped case.
         return len(self.r2l)
 
+    def iterflags(self):
+        """Yields (remote uid, flags) for all messages, sorted by UID
+
+        Maps the flags of the backend's message list, without copying
+        each message like getmessagelist() does.  You must call
+        cachemessagelist() before calling this function!"""
+        items = []
+        self.maplock.acquire()
+        try:
+            l2r = self.l2r
+            for luid, flags in self._mb.getmessagelist().iterflags():
+                ruid = l2r.get(luid)
+                # see getmessagelist() for why a message may be unmapped
+                if ruid is not None:
+                    items.append((ruid, flags))
+        finally:
+            self.maplock.release()
+        items.sort()
+        return iter(items)
+
     def getmessagelist(self):
         """Gets the current message list. This function's implementation
-        is quite expensive for the mapped UID case.  You must call
+        is quite expensive for the mapped UID case, use iterflags() or
+        getmessageuidlist() where they do.  You must call
         cachemessagelist() before calling this function!"""
 
-        retval = {}
+        retval = []
         localhash = self._mb.getmessagelist()
         self.maplock.acquire()
         try:
@@ -160,9 +190,10 @@ class MappedIMAPFolder(IMAPFolder):
                     # just ignore it.
                     continue
                 value = value.copy()
-                value['uid'] = self.l2r[value['uid']]
-                retval[key] = value
-            return retval
+                value['uid'] = key
+                retval.append((key, value))
+            retval.sort()
+            return MessageList(retval)
         finally:
             self.maplock.release()
 
@@ -170,6 +201,12 @@ class MappedIMAPFolder(IMAPFolder):
         """Returns the content of the specified message."""
         return self._mb.getmessage(self.r2l[uid])
 
+    def getmessages(self, uids):
+        """Yields (uid, content) tuples for the messages in uids"""
+        for luid, content in self._mb.getmessages(self._uidlist(self.r2l,
+                                                                uids)):
+            yield (self.l2r[luid], content)
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -215,6 +252,40 @@ class MappedIMAPFolder(IMAPFolder):
             self.maplock.release()
         return uid
 
+    def savemessages(self, messages):
+        """Save several messages, mapping the uids as savemessage() does
+
+        New messages are passed on to the backend in one go, so they
+        can be uploaded with a single MULTIAPPEND."""
+        new = [(uid, content, flags, rtime) for (uid, content, flags, rtime)
+               in messages if uid > 0 and not uid in self.r2l]
+        if len(new) < 2:
+            return BaseFolder.savemessages(self, messages)
+        # the backend reports each message it saves
+        newluids = self._mb.savemessages([(-1, content, flags, rtime) for
+                                          (uid, content, flags, rtime) in new])
+        self.maplock.acquire()
+        try:
+            for (uid, content, flags, rtime), newluid in zip(new, newluids):
+                if newluid < 1:
+                    continue
+                self.diskl2r[newluid] = uid
+                self.diskr2l[uid] = newluid
+                self.l2r[newluid] = uid
+                self.r2l[uid] = newluid
+            self._savemaps(dolock = 0)
+        finally:
+            self.maplock.release()
+        for newluid in newluids:
+            if newluid < 1:
+                raise ValueError("Backend could not find uid for message, "
+                                 "returned %s" % newluid)
+        # all other messages are handled as usual
+        saved = set([uid for (uid, content, flags, rtime) in new])
+        return [uid if uid in saved else
+                self.savemessage(uid, content, flags, rtime)
+                for (uid, content, flags, rtime) in messages]
+
     def getmessageflags(self, uid):
         return self._mb.getmessageflags(self.r2l[uid])
 
@@ -229,6 +300,14 @@ class MappedIMAPFolder(IMAPFolder):
         dryrun mode."""
         self._mb.savemessageflags(self.r2l[uid], flags)
 
+    def savemessagesflags(self, uidflags):
+        self._mb.savemessagesflags(dict(zip(
+            self._uidlist(self.r2l, uidflags.keys()), uidflags.values())))
+
+    def changemessagesflags(self, uidchanges):
+        self._mb.changemessagesflags(dict(zip(
+            self._uidlist(self.r2l, uidchanges.keys()), uidchanges.values())))
+
     def addmessageflags(self, uid, flags):
         self._mb.addmessageflags(self.r2l[uid], flags)
 
@@ -44,7 +44,7 @@ __author__ = "Piers Lauder <piers@janeelix.com>"
 __URL__ = "http://imaplib2.sourceforge.net"
 __license__ = "Python License"
 
-import binascii, errno, os, Queue, random, re, select, socket, sys, time, threading, zlib
+import binascii, errno, os, Queue, random, re, select, socket, sys, tempfile, time, threading, zlib
 
 select_module = select
 
@@ -59,6 +59,7 @@ IDLE_TIMEOUT_RESPONSE = '* IDLE TIMEOUT\r\n'
 IDLE_TIMEOUT = 60*29                            # Don't stay in IDLE state longer
 READ_POLL_TIMEOUT = 30                          # Without this timeout interrupted network connections can hang reader
 READ_SIZE = 32768                               # Consume all available in socket
+LITERAL_READ_SIZE = 1048576                     # Read size while receiving a literal
 
 DFLT_DEBUG_BUF_LVL = 3                          # Level above which the logging output goes directly to stderr
 
@@ -275,6 +276,7 @@ class IMAP4(object):
 
     continuation_cre = re.compile(r'\+( (?P<data>.*))?')
     literal_cre = re.compile(r'.*{(?P<size>\d+)}$')
+    literal_line_cre = re.compile(r'{(?P<size>\d+)}\r\n\Z')
     mapCRLF_cre = re.compile(r'\r\n|\r|\n')
         # Need to quote "atom-specials" :-
         #   "(" / ")" / "{" / SP / 0x00 - 0x1f / 0x7f / "%" / "*" / DQUOTE / "\" / "]"
@@ -290,6 +292,7 @@ class IMAP4(object):
 
         self.state = NONAUTH            # IMAP4 protocol state
         self.literal = None             # A literal argument to a command
+        self.literal_spool_size = None  # Spool bigger literals to a file
         self.tagged_commands = {}       # Tagged commands awaiting response
         self.untagged_responses = []    # [[typ: [data, ...]], ...]
         self.mailbox = None             # Current mailbox selected
@@ -302,6 +305,12 @@ class IMAP4(object):
         self._accumulated_data = []     # Message data accumulated so far
         self._literal_expected = None   # Message data descriptor
 
+        self._line_part = ''            # Reader: incomplete line received
+        self._literal_left = 0          # Reader: literal bytes still to come
+        self._literal_parts = []        # Reader: literal data received
+        self._literal_file = None       # Reader: file literal is spooled to
+        self._literal_response = False  # Reader: last line announced literal
+
         self.compressor = None          # COMPRESS/DEFLATE if not None
         self.decompressor = None
 
@@ -603,7 +612,11 @@ class IMAP4(object):
             date_time = Time2Internaldate(date_time)
         else:
             date_time = None
-        self.literal = self.mapCRLF_cre.sub(CRLF, message)
+        if hasattr(message, 'read'):
+            # File object, line ends must be CRLF already
+            self.literal = message
+        else:
+            self.literal = self.mapCRLF_cre.sub(CRLF, message)
         try:
             return self._simple_command(name, mailbox, flags, date_time, **kw)
         finally:
@@ -1304,6 +1317,10 @@ class IMAP4(object):
             if isinstance(literal, basestring):
                 literator = None
                 data = '%s {%s}' % (data, len(literal))
+            elif hasattr(literal, 'read'):
+                literator = None
+                literal = _FileLiteral(literal)
+                data = '%s {%s}' % (data, len(literal))
             else:
                 literator = literal
 
@@ -1344,7 +1361,10 @@ class IMAP4(object):
                 crqb = self._request_push(tag='continuation')
 
             if __debug__: self._log(4, 'write literal size %s' % len(literal))
-            crqb.data = '%s%s' % (literal, CRLF)
+            if isinstance(literal, _FileLiteral):
+                crqb.data = literal
+            else:
+                crqb.data = '%s%s' % (literal, CRLF)
             self.ouq.put(crqb)
 
             if literator is None:
@@ -1449,6 +1469,11 @@ class IMAP4(object):
     def _put_response(self, resp):
 
         if self._expecting_data > 0:
+            if not isinstance(resp, basestring):
+                # Literal spooled to a file by the reader
+                self._expecting_data = 0
+                self._accumulated_data.append(resp)
+                return
             rlen = len(resp)
             dlen = min(self._expecting_data, rlen)
             self._expecting_data -= dlen
@@ -1460,7 +1485,11 @@ class IMAP4(object):
 
         if self._accumulated_data:
             typ, dat = self._literal_expected
-            self._append_untagged(typ, (dat, ''.join(self._accumulated_data)))
+            if len(self._accumulated_data) == 1:
+                literal = self._accumulated_data[0]
+            else:
+                literal = ''.join(self._accumulated_data)
+            self._append_untagged(typ, (dat, literal))
             self._accumulated_data = []
 
         # Protocol mandates all lines terminated by CRLF
@@ -1670,7 +1699,7 @@ class IMAP4(object):
                 if __debug__: self._log(1, 'inq None - terminating')
                 break
 
-            if not isinstance(line, basestring):
+            if isinstance(line, tuple):
                 typ, val = line
                 break
 
@@ -1702,6 +1731,77 @@ class IMAP4(object):
         if __debug__: self._log(1, 'finished')
 
 
+    def _get_read_size(self):
+
+        # Read literals in big chunks, they don't need to be split into lines.
+
+        if self._literal_left > self.read_size:
+            return min(self._literal_left, LITERAL_READ_SIZE)
+        return self.read_size
+
+
+    def _put_data(self, data):
+
+        # Split data received into lines for the handler thread.
+        # Literals are passed on as one string each, without looking
+        # for lines in them: their data is collected as received and
+        # joined once. Literals bigger than literal_spool_size are
+        # written to a temporary file instead, which is passed on in
+        # place of the string. Returns True if the reader should terminate.
+
+        terminate = False
+        start, dlen = 0, len(data)
+        while start < dlen:
+            if self._literal_left:
+                size = min(self._literal_left, dlen - start)
+                if start == 0 and size == dlen:
+                    part = data
+                else:
+                    part = data[start:start+size]
+                if self._literal_file is not None:
+                    self._literal_file.write(part)
+                else:
+                    self._literal_parts.append(part)
+                start += size
+                self._literal_left -= size
+                if not self._literal_left:
+                    if self._literal_file is not None:
+                        literal, self._literal_file = self._literal_file, None
+                        literal.seek(0)
+                        if __debug__: self._log(4, '< literal spooled to file')
+                    else:
+                        literal = ''.join(self._literal_parts)
+                        self._literal_parts = []
+                        if __debug__: self._log(4, '< literal of %s bytes' % len(literal))
+                    self.inq.put(literal)
+                continue
+            stop = data.find('\n', start)
+            if stop < 0:
+                self._line_part += data[start:]
+                break
+            stop += 1
+            self._line_part, start, line = \
+                '', stop, self._line_part + data[start:stop]
+            if __debug__: self._log(4, '< %s' % line)
+            self.inq.put(line)
+            if self.TerminateReader:
+                terminate = True
+            # Only untagged responses, and the rest of a response
+            # following a literal, can announce a literal.
+            mo = None
+            if self._literal_response or line.startswith('* '):
+                mo = self.literal_line_cre.search(line)
+            if mo is not None:
+                self._literal_left = int(mo.group('size'))
+                self._literal_response = True
+                if self.literal_spool_size is not None and \
+                        self._literal_left > self.literal_spool_size:
+                    self._literal_file = tempfile.TemporaryFile()
+            else:
+                self._literal_response = False
+        return terminate
+
+
     if hasattr(select_module, "poll"):
 
       def _reader(self):
@@ -1718,8 +1818,6 @@ class IMAP4(object):
             }
             return ' '.join([PollErrors[s] for s in PollErrors.keys() if (s & state)])
 
-        line_part = ''
-
         poll = select.poll()
 
         poll.register(self.read_fd, select.POLLIN)
@@ -1742,8 +1840,7 @@ class IMAP4(object):
                 fd,state = r[0]
 
                 if state & select.POLLIN:
-                    data = self.read(self.read_size)            # Drain ssl buffer if present
-                    start = 0
+                    data = self.read(self._get_read_size())     # Drain ssl buffer if present
                     dlen = len(data)
                     if __debug__: self._log(5, 'rcvd %s' % dlen)
                     if dlen == 0:
@@ -1754,18 +1851,8 @@ class IMAP4(object):
                         continue                                # Try again
                     rxzero = 0
 
-                    while True:
-                        stop = data.find('\n', start)
-                        if stop < 0:
-                            line_part += data[start:]
-                            break
-                        stop += 1
-                        line_part, start, line = \
-                            '', stop, line_part + data[start:stop]
-                        if __debug__: self._log(4, '< %s' % line)
-                        self.inq.put(line)
-                        if self.TerminateReader:
-                            terminate = True
+                    if self._put_data(data):
+                        terminate = True
 
                 if state & ~(select.POLLIN):
                     raise IOError(poll_error(state))
@@ -1793,8 +1880,6 @@ class IMAP4(object):
 
         if __debug__: self._log(1, 'starting using select')
 
-        line_part = ''
-
         rxzero = 0
         terminate = False
 
@@ -1809,8 +1894,7 @@ class IMAP4(object):
                 if not r:                                       # Timeout
                     continue
 
-                data = self.read(self.read_size)                # Drain ssl buffer if present
-                start = 0
+                data = self.read(self._get_read_size())         # Drain ssl buffer if present
                 dlen = len(data)
                 if __debug__: self._log(5, 'rcvd %s' % dlen)
                 if dlen == 0:
@@ -1821,18 +1905,8 @@ class IMAP4(object):
                     continue                                    # Try again
                 rxzero = 0
 
-                while True:
-                    stop = data.find('\n', start)
-                    if stop < 0:
-                        line_part += data[start:]
-                        break
-                    stop += 1
-                    line_part, start, line = \
-                        '', stop, line_part + data[start:stop]
-                    if __debug__: self._log(4, '< %s' % line)
-                    self.inq.put(line)
-                    if self.TerminateReader:
-                        terminate = True
+                if self._put_data(data):
+                    terminate = True
             except:
                 reason = 'socket error: %s - %s' % sys.exc_info()[:2]
                 if __debug__:
@@ -1860,7 +1934,11 @@ class IMAP4(object):
                 break   # Outq flushed
 
             try:
-                self.send(rqb.data)
+                if isinstance(rqb.data, _FileLiteral):
+                    for data in rqb.data:
+                        self.send(data)
+                else:
+                    self.send(rqb.data)
                 if __debug__: self._log(4, '> %s' % rqb.data)
             except:
                 reason = 'socket error: %s - %s' % sys.exc_info()[:2]
@@ -2191,6 +2269,33 @@ class _IdleCont(object):
 
 
 
+class _FileLiteral(object):
+
+    """Literal read from a file object by the writer thread,
+    in chunks of LITERAL_READ_SIZE bytes, followed by CRLF."""
+
+    def __init__(self, file):
+        self.file = file
+        file.seek(0, 2)
+        self.size = file.tell()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self.file.seek(0)
+        while True:
+            data = self.file.read(LITERAL_READ_SIZE)
+            if not data:
+                break
+            yield data
+        yield CRLF
+
+    def __str__(self):
+        return '<literal of %s bytes>' % self.size
+
+
+
 MonthNames = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
                 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
@@ -26,11 +26,26 @@ import threading
 from hashlib import sha1
 
 from offlineimap.ui import getglobalui
-from offlineimap import OfflineImapError
+from offlineimap import OfflineImapError, imaputil
 from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, zlib, IMAP4_PORT, InternalDate, Mon2num
+from offlineimap.imaplib2 import Commands, AUTH, SELECTED
+
+# imaplib2 does not know NOTIFY (RFC 5465)
+Commands.setdefault('NOTIFY', ((AUTH, SELECTED), False))
 
 
 class UsefulIMAPMixIn(object):
+    enabled = ()
+    """Tuple of extensions the server confirmed with ENABLED (RFC 5161)"""
+    compressionlevel = zlib.Z_DEFAULT_COMPRESSION
+    """zlib level used after enable_compression()"""
+    # bytes as seen by imaplib2, and as sent over the wire, which
+    # differs once COMPRESS=DEFLATE is active
+    bytesin = bytesout = wirebytesin = wirebytesout = 0
+    throttlehandler = None
+    """Called with the response text when the server refuses a command
+    because it throttles us, if set"""
+
     def getselectedfolder(self):
         if self.state == 'SELECTED':
             return self.mailbox
@@ -63,9 +78,257 @@ class UsefulIMAPMixIn(object):
             raise OfflineImapError(errstr, severity)
         return result
 
+    def _request_pop(self, name, data):
+        # completion of a tagged command
+        if self.throttlehandler is not None and name != 'continuation' and \
+                data[0] in ('NO', 'BAD') and data[1] and \
+                imaputil.isthrottled(data[1][-1] or ''):
+            self.throttlehandler(data[1][-1])
+        super(UsefulIMAPMixIn, self)._request_pop(name, data)
+
+    def start_compressing(self):
+        """Enable deflate compression (RFC 4978) at compressionlevel"""
+        self.decompressor = _CountingDecompressor(self)
+        self.compressor = _CountingCompressor(self, self.compressionlevel)
+
+    def read(self, size):
+        data = super(UsefulIMAPMixIn, self).read(size)
+        self._countread(data)
+        return data
+
+    def send(self, data):
+        self._countsend(data)
+        return super(UsefulIMAPMixIn, self).send(data)
+
+    def _countread(self, data):
+        self.bytesin += len(data)
+        if self.decompressor is None:
+            self.wirebytesin += len(data)
+
+    def _countsend(self, data):
+        self.bytesout += len(data)
+        if self.compressor is None:
+            self.wirebytesout += len(data)
+
+    def gettransferstats(self):
+        """:returns: dict with the number of bytes received ('in') and
+            sent ('out') on this connection, before compression, and
+            as transferred ('wirein', 'wireout')"""
+        return {'in': self.bytesin, 'out': self.bytesout,
+                'wirein': self.wirebytesin, 'wireout': self.wirebytesout}
+
+    def enable(self, *extensions):
+        """Enable IMAP extensions (e.g. QRESYNC) on this connection
+
+        Must be invoked in AUTHENTICATED state, ie after login but
+        before any SELECT.
+
+        :returns: tuple of extensions the server actually enabled"""
+        typ, dat = self.xatom('ENABLE', *extensions)
+        if typ == 'OK':
+            enabled = self._get_untagged_response('ENABLED')
+            if enabled:
+                self.enabled = tuple(' '.join(enabled).upper().split())
+        return self.enabled
+
+    def notify(self, mailboxes, events = ('MessageNew', 'MessageExpunge',
+                                          'FlagChange')):
+        """Ask for notifications about changes in mailboxes (RFC 5465)
+
+        The server reports changes with untagged STATUS responses, which
+        also end IDLE. An empty list of mailboxes turns notifications
+        off again.
+
+        :returns: (typ, [data]) as returned by xatom()"""
+        if not mailboxes:
+            return self.xatom('NOTIFY', 'NONE')
+        return self.xatom('NOTIFY', bytearray('SET (MAILBOXES (%s) (%s))' % (
+                    ' '.join([self._quote(m) for m in mailboxes]),
+                    ' '.join(events))))
+
+    def pipeline(self):
+        """:returns: a new :class:`IMAPPipeline` on this connection"""
+        return IMAPPipeline(self)
+
+    def multistatus(self, mailboxes, items):
+        """Get the STATUS of several mailboxes, pipelining the commands
+
+        :param items: status data items, e.g. '(MESSAGES UIDNEXT)'
+        :returns: dict mapping mailbox names to dicts of status items.
+            Mailboxes the server refused the STATUS of are left out."""
+        pipeline = self.pipeline()
+        for mailbox in mailboxes:
+            pipeline.queue('status', mailbox, items)
+        responses = []
+        for typ, dat in pipeline.wait():
+            if typ == 'OK':
+                responses.extend([r for r in dat if isinstance(r, basestring)])
+        return dict([imaputil.status2hash(r) for r in responses])
+
+    def multiappend(self, mailbox, messages):
+        """Append several messages with a single APPEND (RFC 3502)
+
+        Non-synchronizing literals are used if the server supports
+        LITERAL+, so that all messages are sent without waiting for
+        continuation responses.
+
+        :param messages: list of (flags, date_time, message) tuples.
+            flags and date_time need to be IMAP formatted or None,
+            message needs CRLF line endings.
+        :returns: (typ, [data]) as returned by append()"""
+        literalplus = 'LITERAL+' in self.capabilities
+        prefixes = []
+        for flags, date_time, message in messages:
+            prefixes.append(' '.join([x for x in (flags, date_time) if x] +
+                ['{%d%s}' % (len(message), '+' if literalplus else '')]))
+        if literalplus:
+            data = ' '.join(['%s\r\n%s' % (prefix, message) for
+                             prefix, (f, d, message) in zip(prefixes, messages)])
+        else:
+            # Each literal is followed by the prefix of the next message,
+            # the next literal is sent on the continuation response.
+            data = prefixes[0]
+            literals = iter([message + ' ' + prefix for (f, d, message), prefix
+                             in zip(messages, prefixes[1:])] +
+                            [messages[-1][2]])
+            self.literal = lambda resp, rqb: next(literals, None)
+        try:
+            return self._simple_command('APPEND', mailbox, _Verbatim(data))
+        finally:
+            self._release_state_change()
+
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
 
+class _Verbatim(object):
+    """Command argument imaplib2 sends as it is
+
+    imaplib2 quotes string arguments with special characters, but
+    passes other objects through str(), which returns the string itself
+    here rather than a copy like bytearray would need."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data
+
+class IMAPPipeline(object):
+    """Send several commands on one connection without waiting for replies
+
+    Commands are queued with :meth:`queue`, which returns immediately,
+    and :meth:`wait` collects all the results. So N commands cost about
+    one round trip instead of N. Only commands imaplib2 allows to run
+    concurrently (e.g. STATUS, FETCH, STORE, UID) may be pipelined; to
+    work on a mailbox, SELECT it before queueing commands.
+
+    Untagged responses of the same kind are handed to whichever command
+    completes first, e.g. the FETCH responses of several pipelined UID
+    STOREs. Only look at the combined data of all results in that case.
+
+    A pipeline is not reusable and must only be filled by one thread."""
+
+    def __init__(self, imapobj):
+        self.imapobj = imapobj
+        self.results = []
+        self.pending = 0
+        self.cond = threading.Condition(threading.Lock())
+
+    def queue(self, command, *args):
+        """Send command, e.g. queue('uid', 'STORE', '1:5', '+FLAGS', '\\Seen')
+
+        :returns: the index of its result in the list :meth:`wait`
+            returns"""
+        self.cond.acquire()
+        index = len(self.results)
+        self.results.append(None)
+        self.pending += 1
+        self.cond.release()
+        try:
+            getattr(self.imapobj, command)(*args, callback=self._callback,
+                                           cb_arg=index)
+        except Exception as e:
+            # imaplib2 may or may not have invoked the callback already
+            self._callback((None, index, (e.__class__, str(e))))
+            raise
+        return index
+
+    def _callback(self, args):
+        response, index, exc_data = args
+        self.cond.acquire()
+        try:
+            if self.results[index] is None:
+                if exc_data is None:
+                    self.results[index] = response
+                else:
+                    self.results[index] = exc_data
+                self.pending -= 1
+                if not self.pending:
+                    self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait(self):
+        """Wait for all queued commands to complete
+
+        :returns: list of (typ, [data]) in the order the commands were
+            queued. Commands failing with an imaplib2 error yield
+            ('BAD', [errormessage]).
+        :raises: the imaplib2 abort exception if the connection broke"""
+        self.cond.acquire()
+        try:
+            while self.pending:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        results = []
+        for result in self.results:
+            if isinstance(result[0], basestring):
+                results.append(result)
+            elif issubclass(result[0], self.imapobj.abort):
+                raise result[0](result[1])
+            else:
+                results.append(('BAD', [result[1]]))
+        return results
+
+
+class _CountingCompressor(object):
+    """Raw deflate compressor adding its output to imapobj.wirebytesout"""
+
+    def __init__(self, imapobj, level):
+        self.imapobj = imapobj
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    def compress(self, data):
+        data = self.compressor.compress(data)
+        self.imapobj.wirebytesout += len(data)
+        return data
+
+    def flush(self, mode=zlib.Z_FINISH):
+        data = self.compressor.flush(mode)
+        self.imapobj.wirebytesout += len(data)
+        return data
+
+
+class _CountingDecompressor(object):
+    """Raw deflate decompressor adding its input to imapobj.wirebytesin
+
+    imaplib2 passes unconsumed_tail in again, which is not counted."""
+
+    def __init__(self, imapobj):
+        self.imapobj = imapobj
+        self.decompressor = zlib.decompressobj(-15)
+
+    @property
+    def unconsumed_tail(self):
+        return self.decompressor.unconsumed_tail
+
+    def decompress(self, data, size=0):
+        if data is not self.decompressor.unconsumed_tail:
+            self.imapobj.wirebytesin += len(data)
+        return self.decompressor.decompress(data, size)
+
+
 class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
     """IMAP4 client class over a tunnel
 
@@ -101,16 +364,18 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
         Read at most 'size' bytes from remote."""
 
         if self.decompressor is None:
-            return os.read(self.read_fd, size)
-
-        if self.decompressor.unconsumed_tail:
-            data = self.decompressor.unconsumed_tail
+            data = os.read(self.read_fd, size)
         else:
-            data = os.read(self.read_fd, 8192)
-
-        return self.decompressor.decompress(data, size)
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            else:
+                data = os.read(self.read_fd, 8192)
+            data = self.decompressor.decompress(data, size)
+        self._countread(data)
+        return data
 
     def send(self, data):
+        self._countsend(data)
         if self.compressor is not None:
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
@@ -18,6 +18,10 @@
 from offlineimap import imaplibutil, imaputil, threadutil, OfflineImapError
 from offlineimap.ui import getglobalui
 from threading import Lock, BoundedSemaphore, Thread, Event, currentThread
+try:
+    from Queue import Queue
+except ImportError: # python3
+    from queue import Queue
 import offlineimap.accounts
 import hmac
 import socket
@@ -73,10 +77,24 @@ class IMAPServer:
         self.availableconnections = []
         self.assignedconnections = []
         self.lastowner = {}
+        # how often acquireconnection() found a connection that already
+        # had the requested mailbox selected
+        self.connectionhits = 0
+        self.connectionmisses = 0
+        # when connections were returned to the pool, for health checks
+        self.lastused = {}
+        self.healthcheckidle = repos.gethealthcheckidle()
+        self.healthcheckthread = None
+        self.healthcheckstop = None
+        self.retrycount = repos.getretrycount()
+        self.retrybackoff = repos.getretrybackoff()
+        # number of operations the server throttled, see withconnection()
+        self.throttlecount = 0
         self.semaphore = BoundedSemaphore(self.maxconnections)
         self.connectionlock = Lock()
         self.reference = repos.getreference()
         self.idlefolders = repos.getidlefolders()
+        self.watchfolders = repos.getwatchfolders()
         self.gss_step = self.GSS_STATE_STEP
         self.gss_vc = None
         self.gssapi = False
@@ -112,12 +130,219 @@ class IMAPServer:
         self.assignedconnections.remove(connection)
         # Don't reuse broken connections
         if connection.Terminate or drop_conn:
+            self.lastused.pop(connection, None)
+            self._logtransferstats(connection)
             connection.logout()
         else:
             self.availableconnections.append(connection)
+            self.lastused[connection] = time.time()
+            self._starthealthcheck()
         self.connectionlock.release()
         self.semaphore.release()
 
+    def _logtransferstats(self, imapobj):
+        stats = imapobj.gettransferstats()
+        self.ui.debug('imap', 'closing connection: received %(in)d bytes '
+                      '(%(wirein)d on the wire), sent %(out)d bytes '
+                      '(%(wireout)d on the wire)' % stats)
+
+    def _starthealthcheck(self):
+        """Start the thread checking idle pooled connections, if enabled
+
+        Must be called with connectionlock held."""
+        if not self.healthcheckidle or self.healthcheckthread is not None:
+            return
+        if getattr(currentThread(), 'healthcheck', False):
+            return # it is handing back a connection while being stopped
+        self.healthcheckstop = Event()
+        self.healthcheckthread = Thread(target=self._healthcheckloop,
+                                        args=(self.healthcheckstop,),
+                                        name='HealthCheck-%s' %
+                                        self.repos.getname())
+        self.healthcheckthread.setDaemon(True)
+        self.healthcheckthread.healthcheck = True
+        self.healthcheckthread.start()
+
+    def _stophealthcheck(self):
+        """Stop the health check thread, if running
+
+        Waits for it to hand back the connections it is checking, and
+        for a replacement connection it may be opening."""
+        self.connectionlock.acquire()
+        thread, stop = self.healthcheckthread, self.healthcheckstop
+        self.healthcheckthread = self.healthcheckstop = None
+        self.connectionlock.release()
+        if thread is None:
+            return
+        stop.set()
+        if thread is not currentThread():
+            thread.join()
+
+    def _idleconnections(self):
+        """Take the connections idle for healthcheckidle seconds out of
+        the pool
+
+        They hold a semaphore slot and count as assigned until they are
+        handed back, so the pool never exceeds maxconnections.  Must not
+        be called with connectionlock held."""
+        cutoff = time.time() - self.healthcheckidle
+        taken = []
+        with self.connectionlock:
+            for imapobj in list(self.availableconnections):
+                if self.lastused.get(imapobj, cutoff) > cutoff:
+                    continue
+                if not self.semaphore.acquire(False):
+                    break # all slots are in use, try again next time
+                self.availableconnections.remove(imapobj)
+                self.assignedconnections.append(imapobj)
+                taken.append(imapobj)
+        return taken
+
+    def _checkconnection(self, imapobj):
+        """Send a NOOP on imapobj
+
+        :returns: False if the connection is dead"""
+        try:
+            imapobj.noop()
+            return not imapobj.Terminate
+        except Exception as e:
+            self.ui.debug('imap', 'health check of idle connection failed: %s'
+                          % e)
+            return False
+
+    def _healthcheckloop(self, stop):
+        """Check the idle pooled connections until stop is set
+
+        Runs in its own thread, so acquireconnection() never waits for a
+        health check or a reconnect.  Connections that have been sitting
+        in the pool for healthcheckidle seconds are sent a NOOP and put
+        back, dead ones are logged out.  If that leaves the pool empty a
+        replacement is opened right away."""
+        while not stop.wait(self.healthcheckidle / 2.0):
+            dropped = 0
+            for imapobj in self._idleconnections():
+                if self._checkconnection(imapobj):
+                    self.releaseconnection(imapobj)
+                    continue
+                dropped += 1
+                with self.connectionlock:
+                    self.assignedconnections.remove(imapobj)
+                    self.lastused.pop(imapobj, None)
+                self.semaphore.release()
+                self._logtransferstats(imapobj)
+                try:
+                    imapobj.logout()
+                except Exception:
+                    pass
+            if not dropped or stop.isSet() or self.availableconnections:
+                continue
+            self.ui.debug('imap', 'health check: replacing %d dead '
+                          'connection(s)' % dropped)
+            try:
+                self.releaseconnection(self.acquireconnection())
+            except Exception as e:
+                # acquireconnection() will try again when it is needed
+                self.ui.debug('imap', 'health check: could not open a new '
+                              'connection: %s' % e)
+
+    def withconnection(self, func, mailbox=None, readonly=False):
+        """Run func(imapobj) on a pooled connection and return its result
+
+        If the connection breaks (imaplib2 abort or an OfflineImapError
+        of severity FOLDER_RETRY), it is dropped and func is run again on
+        another connection, up to retrycount times, pausing retrybackoff
+        seconds before the first retry and twice as long before each
+        following one. So func needs to do everything it relies on,
+        including the SELECT, itself.
+
+        Broken connections saying that the server throttles us are
+        counted in throttlecount, like throttled commands (see
+        :meth:`notethrottled`).
+
+        :param mailbox: see :meth:`acquireconnection`"""
+        retries_left = self.retrycount
+        delay = self.retrybackoff
+        while True:
+            imapobj = self.acquireconnection(mailbox, readonly)
+            try:
+                result = func(imapobj)
+            except imapobj.readonly:
+                self.releaseconnection(imapobj)
+                raise
+            except (imapobj.abort, OfflineImapError) as e:
+                if isinstance(e, OfflineImapError) and \
+                        e.severity != OfflineImapError.ERROR.FOLDER_RETRY:
+                    self.releaseconnection(imapobj)
+                    raise
+                if imaputil.isthrottled(str(e)):
+                    self.notethrottled()
+                self.releaseconnection(imapobj, True)
+                if not retries_left:
+                    raise
+                retries_left -= 1
+                self.ui.warn("Connection to server '%s' broke (%s), retrying "
+                             "in %g seconds" % (self.repos.getname(), e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+                continue
+            except:
+                self.releaseconnection(imapobj)
+                raise
+            self.releaseconnection(imapobj)
+            return result
+
+    def notethrottled(self, response=None):
+        """Count an operation the server throttled, see throttlecount"""
+        self.connectionlock.acquire()
+        self.throttlecount += 1
+        self.connectionlock.release()
+        if response is not None:
+            self.ui.debug('imap', "Server '%s' throttles us: %s" %
+                          (self.repos.getname(), response))
+
+    def prewarm(self):
+        """Open up to maxconnections connections up front
+
+        The first connection is opened on its own, so the password is
+        asked for at most once and the folder delimiter is known. The
+        others are opened and logged in in parallel, and all end up in
+        the pool. Failing to open one of the others is not fatal, it
+        will be retried when it's needed."""
+        self.connectionlock.acquire()
+        numconnections = self.maxconnections - len(self.assignedconnections)
+        self.connectionlock.release()
+        if numconnections < 1:
+            return
+        imapobjs = [self.acquireconnection()]
+
+        def connect(i):
+            try:
+                return self.acquireconnection()
+            except Exception as e:
+                self.ui.debug('imap', 'pre-warming connection %d failed: %s'
+                              % (i, e))
+                return None
+
+        try:
+            imapobjs += threadutil.parallelmap(connect,
+                range(1, numconnections), numconnections - 1)
+        finally:
+            for imapobj in imapobjs:
+                self.releaseconnection(imapobj)
+
+    def _findselected(self, mailbox, readonly):
+        """Remove and return an available connection on which mailbox is
+        selected in the given mode, or None
+
+        Needs to be called with the connectionlock held."""
+        for i in range(len(self.availableconnections) - 1, -1, -1):
+            tryobj = self.availableconnections[i]
+            if tryobj.getselectedfolder() == mailbox and \
+                    tryobj.is_readonly == readonly:
+                del(self.availableconnections[i])
+                return tryobj
+        return None
+
     def md5handler(self, response):
         challenge = response.strip()
         self.ui.debug('imap', 'md5handler: got challenge %s' % challenge)
@@ -158,11 +383,16 @@ class IMAPServer:
             response = ''
         return base64.b64decode(response)
 
-    def acquireconnection(self):
+    def acquireconnection(self, mailbox=None, readonly=False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        :param mailbox: the mailbox the caller is going to SELECT, if
+            any. A connection that has it selected in the same mode
+            (see readonly) is preferred, saving a SELECT round trip.
+        :param readonly: whether mailbox will be SELECTed read-only"""
 
         self.semaphore.acquire()
         self.connectionlock.acquire()
@@ -170,16 +400,22 @@ class IMAPServer:
         imapobj = None
 
         if len(self.availableconnections): # One is available.
-            # Try to find one that previously belonged to this thread
-            # as an optimization.  Start from the back since that's where
-            # they're popped on.
-            imapobj = None
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == curThread.ident:
-                    imapobj = tryobj
-                    del(self.availableconnections[i])
-                    break
+            if mailbox is not None:
+                imapobj = self._findselected(mailbox, readonly)
+                if imapobj:
+                    self.connectionhits += 1
+                else:
+                    self.connectionmisses += 1
+            if not imapobj:
+                # Otherwise try to find one that previously belonged to
+                # this thread as an optimization.  Start from the back
+                # since that's where they're popped on.
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if self.lastowner[tryobj] == curThread.ident:
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
             if not imapobj:
                 imapobj = self.availableconnections[0]
                 del(self.availableconnections[0])
@@ -187,7 +423,8 @@ class IMAPServer:
             self.lastowner[imapobj] = curThread.ident
             self.connectionlock.release()
             return imapobj
-        
+        elif mailbox is not None:
+            self.connectionmisses += 1
         self.connectionlock.release()   # Release until need to modify data
 
         """ Must be careful here that if we fail we should bail out gracefully
@@ -276,6 +513,24 @@ class IMAPServer:
             if dat != [None]:
                 imapobj.capabilities = tuple(dat[-1].upper().split())
 
+            imapobj.throttlehandler = self.notethrottled
+
+            # spool big literals, e.g. message bodies, to disk
+            if self.repos.getstreamthreshold():
+                imapobj.literal_spool_size = self.repos.getstreamthreshold()
+
+            if self.repos.getcompression() and \
+                    'COMPRESS=DEFLATE' in imapobj.capabilities:
+                imapobj.compressionlevel = self.repos.getcompressionlevel()
+                imapobj.enable_compression()
+
+            # QRESYNC lets us learn about expunged messages via VANISHED
+            if 'QRESYNC' in imapobj.capabilities and self.repos.getcondstore():
+                try:
+                    imapobj.enable('QRESYNC')
+                except imapobj.error as e:
+                    self.ui.debug('imap', "ENABLE QRESYNC failed: %s" % e)
+
             if self.delim == None:
                 listres = imapobj.list(self.reference, '""')[1]
                 if listres == [None] or listres == None:
@@ -365,6 +620,7 @@ class IMAPServer:
     def close(self):
         # Make sure I own all the semaphores.  Let the threads finish
         # their stuff.  This is a blocking method.
+        self._stophealthcheck()
         with self.connectionlock:
             # first, wait till all connections had been released.
             # TODO: won't work IMHO, as releaseconnection() also
@@ -372,10 +628,21 @@ class IMAPServer:
             # deadlock! Audit & check!
             threadutil.semaphorereset(self.semaphore, self.maxconnections)
             for imapobj in self.assignedconnections + self.availableconnections:
+                self._logtransferstats(imapobj)
                 imapobj.logout()
+            self.ui.debug('imap', 'connection pool: %d hits, %d misses for '
+                          'selected mailboxes' % (self.connectionhits,
+                                                  self.connectionmisses))
             self.assignedconnections = []
             self.availableconnections = []
             self.lastowner = {}
+            self.lastused = {}
+            # a connection released meanwhile may have started it again,
+            # it waits before taking any, so it finds the pool empty
+            if self.healthcheckstop is not None:
+                self.healthcheckstop.set()
+            self.healthcheckthread = None
+            self.healthcheckstop = None
             # reset kerberos state
             self.gss_step = self.GSS_STATE_STEP
             self.gss_vc = None
@@ -395,6 +662,13 @@ class IMAPServer:
             self.connectionlock.release()
 
             threads = []
+            if self.watchfolders:
+                watcher = WatchThread(self, self.watchfolders)
+                watcher.start()
+                threads.append(watcher)
+                # leave the watcher's connections and one for syncing
+                numconnections = min(numconnections, self.maxconnections -
+                                     self.repos.getwatchconnections() - 1)
             for i in range(numconnections):
                 self.ui.debug('imap', 'keepalive: processing connection %d of %d' % (i, numconnections))
                 if len(self.idlefolders) > i:
@@ -567,3 +841,200 @@ class IdleThread(object):
                 # another round and invoke actual syncing.
                 self.stop_sig.clear()
                 self.dosync()
+
+
+class WatchThread(object):
+    """Watch many folders for changes using few connections
+
+    If the server supports NOTIFY (RFC 5465), a single connection IDLEs
+    and the server reports changes in any of the folders with STATUS
+    responses. Otherwise the folders are polled with STATUS (MESSAGES,
+    UIDNEXT and HIGHESTMODSEQ if available) every watchinterval seconds,
+    split over watchconnections connections. The commands of one poll
+    are pipelined.
+
+    Folders that changed are synced one at a time by a separate thread,
+    so watching continues while syncing."""
+
+    def __init__(self, parent, folders):
+        self.parent = parent
+        self.folders = folders
+        self.stop_sig = Event()
+        self.wakeup = Event()
+        self.ui = getglobalui()
+        self.interval = parent.repos.getwatchinterval()
+        self.syncq = Queue()
+        self.pending = set()
+        self.lock = Lock()
+        self.threads = [Thread(target=self.watch), Thread(target=self.syncloop)]
+
+    def _startthread(self, thread):
+        thread.setDaemon(1)
+        thread.start()
+
+    def start(self):
+        for thread in self.threads:
+            self._startthread(thread)
+
+    def stop(self):
+        self.stop_sig.set()
+        self.wakeup.set()
+        self.syncq.put(None)
+
+    def join(self):
+        # poll threads might still be added while we wait
+        while self.threads:
+            self.threads.pop(0).join()
+
+    def stopped(self):
+        """Whether watching should end, on stop() or an abort"""
+        return self.stop_sig.isSet() or \
+            offlineimap.accounts.Account.abort_NOW_signal.is_set()
+
+    def queuesync(self, folder):
+        """Have folder synced by the sync thread unless it is queued already"""
+        self.lock.acquire()
+        try:
+            if folder in self.pending:
+                return
+            self.pending.add(folder)
+        finally:
+            self.lock.release()
+        self.ui.debug('imap', 'watch: folder %s changed' % folder)
+        self.syncq.put(folder)
+
+    def syncloop(self):
+        while True:
+            folder = self.syncq.get()
+            if folder is None or self.stopped():
+                break
+            self.lock.acquire()
+            self.pending.discard(folder)
+            self.lock.release()
+            self.dosync(folder)
+
+    def dosync(self, folder):
+        # syncfolder() skips the folder if e.g. the main sync is on it
+        account = self.parent.repos.account
+        remotefolder = account.remoterepos.getfolder(folder)
+        offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
+        ui = getglobalui()
+        ui.unregisterthread(currentThread()) #syncfolder registered the thread
+
+    def watch(self):
+        """Watch with NOTIFY if possible, start STATUS pollers otherwise"""
+        imapobj = self.parent.acquireconnection()
+        if not 'NOTIFY' in imapobj.capabilities:
+            self.parent.releaseconnection(imapobj)
+            self.startpollers()
+            return
+        while not self.stopped():
+            try:
+                self.notify(imapobj)
+            except (imapobj.abort, OfflineImapError) as e:
+                # connection dropped, get a new one and start over
+                self.ui.error(e, exc_info()[2])
+                self.parent.releaseconnection(imapobj, True)
+                self.stop_sig.wait(self.interval)
+                if self.stopped():
+                    return
+                imapobj = self.parent.acquireconnection()
+            except imapobj.error as e:
+                self.ui.warn("NOTIFY failed on server '%s', polling folders "
+                             "instead: %s" % (imapobj.identifier, e))
+                self.parent.releaseconnection(imapobj)
+                self.startpollers()
+                return
+            else:
+                self.parent.releaseconnection(imapobj)
+
+    def startpollers(self):
+        """Start watchconnections threads polling the folders"""
+        num = max(1, self.parent.repos.getwatchconnections())
+        for i in range(num):
+            thread = Thread(target=self.poll, args=(self.folders[i::num],))
+            self.threads.append(thread)
+            self._startthread(thread)
+
+    def notify(self, imapobj):
+        """IDLE until stopped, queueing syncs for the folders the server
+        reports changes in"""
+        def callback(args):
+            self.wakeup.set()
+
+        watched = set(self.folders)
+        # IDLE is only allowed with a mailbox selected. Changes in it
+        # are reported with the usual untagged responses rather than
+        # STATUS, see below.
+        imapobj.select('INBOX' if 'INBOX' in watched else self.folders[0],
+                       readonly=True)
+        selected = imapobj.getselectedfolder()
+        untagged = ('EXISTS', 'EXPUNGE', 'FETCH', 'RECENT')
+        for response in untagged:
+            # drop the ones sent by EXAMINE
+            imapobj.response(response)
+        imapobj.notify(self.folders)
+        try:
+            while not self.stopped():
+                self.wakeup.clear()
+                if 'IDLE' in imapobj.capabilities:
+                    imapobj.idle(callback=callback)
+                # Wake up every watchinterval seconds anyway, in case we
+                # are aborted or the connection drops without imaplib2
+                # invoking the callback.
+                self.wakeup.wait(self.interval)
+                if self.stopped():
+                    break
+                if imapobj.Terminate:
+                    raise imapobj.abort('connection closed while watching')
+                # End IDLE (if still active), collect pending responses
+                imapobj.noop()
+                typ, statuses = imapobj.response('STATUS')
+                for status in statuses:
+                    if not isinstance(status, basestring):
+                        continue
+                    folder = imaputil.dequote(imaputil.imapsplit(status)[0])
+                    if folder in watched:
+                        self.queuesync(folder)
+                # changes in the selected folder come as usual responses
+                for response in untagged:
+                    typ, data = imapobj.response(response)
+                    if data != [None]:
+                        self.queuesync(selected)
+        finally:
+            if not imapobj.Terminate:
+                imapobj.notify([])
+
+    def poll(self, folders):
+        """Poll folders with STATUS, queueing syncs for changed ones"""
+        last = {}
+        while not self.stopped():
+            imapobj = self.parent.acquireconnection()
+            try:
+                statuses = self.status(imapobj, folders)
+            except (imapobj.abort, OfflineImapError) as e:
+                self.ui.error(e, exc_info()[2])
+                self.parent.releaseconnection(imapobj, True)
+            else:
+                self.parent.releaseconnection(imapobj)
+                for folder, status in statuses.iteritems():
+                    if folder in last and last[folder] != status:
+                        self.queuesync(folder)
+                    last[folder] = status
+            self.stop_sig.wait(self.interval)
+
+    def status(self, imapobj, folders):
+        """Get the STATUS of folders, sending all commands at once
+
+        :returns: dict mapping folder names to dicts of status items"""
+        if 'CONDSTORE' in imapobj.capabilities:
+            items = '(MESSAGES UIDNEXT HIGHESTMODSEQ)'
+        else:
+            items = '(MESSAGES UIDNEXT)'
+        retval = imapobj.multistatus(folders, items)
+        missing = [folder for folder in folders if not folder in retval]
+        if missing:
+            # e.g. deleted folders. Report them, but watch the others.
+            self.ui.warn("STATUS failed while watching folders %s" % missing,
+                         minor = 1)
+        return retval
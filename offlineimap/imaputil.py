@@ -16,8 +16,10 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+import os
 import re
 import string
+import tempfile
 from offlineimap.ui import getglobalui
 
 
@@ -77,6 +79,14 @@ def flags2hash(flags):
     {'FLAGS': '(\\Seen Old)', 'UID': '4807'}"""
     return options2hash(flagsplit(flags))
 
+def status2hash(response):
+    """Converts an untagged STATUS response to a (mailbox, hash) tuple
+
+    E.g. '"Sent Items" (MESSAGES 3 UIDNEXT 8)' leads to
+    ('Sent Items', {'MESSAGES': '3', 'UIDNEXT': '8'})"""
+    mailbox, items = imapsplit(response)[:2]
+    return dequote(mailbox), flags2hash(items)
+
 def imapsplit(imapstring):
     """Takes a string from an IMAP conversation and returns a list containing
     its components.  One example string is:
@@ -218,3 +228,151 @@ def uid_sequence(uidlist):
 
     retval.append(getrange(start, end)) # Add final range/item
     return ",".join(retval)
+
+def uid_sequences(uidlist, maxlength):
+    """Collapse UID lists into sequence sets of at most maxlength chars
+
+    Like :func:`uid_sequence`, but the sequence set is split into
+    several ones, so that commands using them don't get too long.
+    :returns: list of sequence set strings"""
+    retval, current = [], ''
+    for item in uid_sequence(uidlist).split(','):
+        if current and len(current) + len(item) + 1 > maxlength:
+            retval.append(current)
+            current = ''
+        current = current + ',' + item if current else item
+    if current:
+        retval.append(current)
+    return retval
+
+def uid_sequence_expand(sequence):
+    """Expand an IMAP sequence set into a list of UIDs
+
+    "1:3,10" will return [1, 2, 3, 10]. This is the reverse of
+    :func:`uid_sequence`. '*' is not supported.
+    :returns: list of UIDs as longs"""
+    retval = []
+    for item in sequence.split(','):
+        if ':' in item:
+            start, end = sorted([long(x) for x in item.split(':', 1)])
+            retval.extend(range(start, end + 1))
+        elif item:
+            retval.append(long(item))
+    return retval
+
+# Response codes and texts servers use when they throttle a client
+throttled_re = re.compile(r"\[(THROTTLED|UNAVAILABLE|LIMIT)\]|throttl|"
+                          r"rate.?limit|too many (requests|commands)|"
+                          r"try again later", re.IGNORECASE)
+
+def isthrottled(response):
+    """Whether a server response or error message says that the server
+    throttles us"""
+    return throttled_re.search(response) is not None
+
+# Big messages are passed around as file objects rather than strings,
+# and read or written in chunks of this size.
+MESSAGE_CHUNK_SIZE = 1048576
+
+crlf_re = re.compile("(?<!\r)\n")
+
+def ismessagefile(content):
+    """Whether message content is a file object rather than a string"""
+    return hasattr(content, 'read')
+
+class LiteralFile(object):
+    """A message literal that imaplib2 spooled to a file
+
+    Works like the file object it wraps. Unlike message strings and
+    message files of other backends, its line ends are still CRLF as
+    sent by the server."""
+
+    def __init__(self, file):
+        self._file = file
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+def isliteralfile(content):
+    """Whether message content is a :class:`LiteralFile`"""
+    return isinstance(content, LiteralFile)
+
+def closemessage(content):
+    """Close message content if it is a file, once it has been saved
+
+    Does nothing for strings (and None)."""
+    if ismessagefile(content):
+        content.close()
+
+def messagesize(content):
+    """Size of message content in bytes, string or file object"""
+    if ismessagefile(content):
+        return os.fstat(content.fileno()).st_size
+    return len(content)
+
+def messagechunks(content):
+    """Yield message content in chunks, starting at its beginning
+
+    A string is yielded as is, a file object is read in chunks of
+    MESSAGE_CHUNK_SIZE bytes."""
+    if not ismessagefile(content):
+        yield content
+        return
+    content.seek(0)
+    while True:
+        chunk = content.read(MESSAGE_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+def linechunks(content, crlf=False):
+    """Yield message content in chunks, converting line ends
+
+    :param crlf: convert LF to CRLF if True, CRLF to LF otherwise"""
+    hold = ''
+    for chunk in messagechunks(content):
+        chunk = hold + chunk
+        hold = ''
+        # a CR at the end of a chunk may start a CRLF
+        if chunk.endswith('\r'):
+            chunk, hold = chunk[:-1], '\r'
+        if crlf:
+            yield crlf_re.sub("\r\n", chunk)
+        else:
+            yield chunk.replace("\r\n", "\n")
+    if hold:
+        yield hold
+
+def spoolmessage(chunks):
+    """Write chunks to a temporary file
+
+    :returns: the file object, positioned at its beginning"""
+    spool = tempfile.TemporaryFile()
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def messagecrlf(content):
+    """Convert the line ends of message content from LF to CRLF
+
+    Strings are converted in one go, file objects chunk by chunk
+    into a new temporary file. Literal files are returned as they are."""
+    if isliteralfile(content):
+        return content
+    if ismessagefile(content):
+        return spoolmessage(linechunks(content, True))
+    return crlf_re.sub("\r\n", content)
+
+def messageheaders(content):
+    """Read the header lines of a message file, up to and including
+    the empty line separating them from the body
+
+    The file is left positioned right after the headers."""
+    content.seek(0)
+    headers = []
+    for line in iter(content.readline, ''):
+        headers.append(line)
+        if line in ("\r\n", "\n"):
+            break
+    return ''.join(headers)
@@ -291,6 +291,13 @@ class OfflineImap:
                     threadutil.initInstanceLimit(instancename,
                         config.getdefaultint('Repository ' + reposname,
                                                   'maxconnections', 2))
+            if not options.singlethreading and \
+                    config.getdefaultboolean('Repository ' + reposname,
+                                             'adaptiveconnections', False):
+                threadutil.initAdaptiveLimit("MSGCOPY_" + reposname,
+                    config.getdefaultint('Repository ' + reposname,
+                                         'minconnections', 1),
+                    threadutil.getInstanceLimit("MSGCOPY_" + reposname))
         self.config = config
         return (options, args)
 
@@ -136,6 +136,11 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         'readonly' or by using the 'createfolders' setting."""  
         return self._readonly or self.getconfboolean('createfolders', True)
 
+    def getstreamthreshold(self):
+        """Messages bigger than this many bytes are passed around as
+        temporary or Maildir files rather than strings. 0 disables that."""
+        return self.getconfint('streamthreshold', 10 * 1024 * 1024)
+
     def makefolder(self, foldername):
         """Create a new folder"""
         raise NotImplementedError
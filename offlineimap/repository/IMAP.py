@@ -19,7 +19,7 @@ from offlineimap.repository.Base import BaseRepository
 from offlineimap import folder, imaputil, imapserver, OfflineImapError
 from offlineimap.folder.UIDMaps import MappedIMAPFolder
 from offlineimap.threadutil import ExitNotifyThread
-from threading import Event
+from threading import Event, Lock
 import os
 from sys import exc_info
 import netrc
@@ -33,6 +33,18 @@ class IMAPRepository(BaseRepository):
         self._host = None
         self.imapserver = imapserver.IMAPServer(self)
         self.folders = None
+        # HIGHESTMODSEQ caches live next to the UIDVALIDITY cache
+        self.modseqdir = os.path.join(os.path.dirname(self.getuiddir()),
+                                      'FolderModSeq')
+        if not os.path.exists(self.modseqdir):
+            os.mkdir(self.modseqdir, 0o700)
+        # folder STATUS as of the last sync, for quickchanged()
+        self.quickstatusdir = os.path.join(os.path.dirname(self.getuiddir()),
+                                           'FolderStatus')
+        if not os.path.exists(self.quickstatusdir):
+            os.mkdir(self.quickstatusdir, 0o700)
+        self._folderstatus = None
+        self._folderstatuslock = Lock()
         if self.getconf('sep', None):
             self.ui.info("The 'sep' setting is being ignored for IMAP "
                          "repository '%s' (it's autodetected)" % self)
@@ -64,13 +76,13 @@ class IMAPRepository(BaseRepository):
         self.imapserver.close()
 
     def getholdconnectionopen(self):
-        if self.getidlefolders():
+        if self.getidlefolders() or self.getwatchfolders():
             return 1
         return self.getconfboolean("holdconnectionopen", 0)
 
     def getkeepalive(self):
         num = self.getconfint("keepalive", 0)
-        if num == 0 and self.getidlefolders():
+        if num == 0 and (self.getidlefolders() or self.getwatchfolders()):
             return 29*60
         else:
             return num
@@ -185,14 +197,135 @@ class IMAPRepository(BaseRepository):
         localeval = self.localeval
         return localeval.eval(self.getconf('idlefolders', '[]'))
 
+    def getwatchfolders(self):
+        localeval = self.localeval
+        return localeval.eval(self.getconf('watchfolders', '[]'))
+
+    def getwatchconnections(self):
+        """Number of connections polling watchfolders with STATUS"""
+        return self.getconfint('watchconnections', 1)
+
+    def getwatchinterval(self):
+        """Seconds between two STATUS polls of a watched folder"""
+        return self.getconfint('watchinterval', 60)
+
     def getmaxconnections(self):
         num1 = len(self.getidlefolders())
+        if self.getwatchfolders():
+            # the watcher's connections plus one for syncing
+            num1 += self.getwatchconnections() + 1
         num2 = self.getconfint('maxconnections', 1)
         return max(num1, num2)
 
+    def getcompression(self):
+        """Whether to use COMPRESS=DEFLATE if the server supports it"""
+        return self.getconfboolean('compression', False)
+
+    def getcompressionlevel(self):
+        return self.getconfint('compressionlevel', 6)
+
+    def gethealthcheckidle(self):
+        """Seconds a pooled connection may be idle before it gets checked
+        with a NOOP when it's used again, 0 to never check"""
+        return self.getconfint('healthcheckidle', 60)
+
+    def getretrycount(self):
+        """How often to retry an operation when the connection broke"""
+        return self.getconfint('retrycount', 3)
+
+    def getretrybackoff(self):
+        """Seconds to wait before the first retry, doubled each time"""
+        return self.getconffloat('retrybackoff', 1)
+
+    def getprewarmconnections(self):
+        """Whether to open all connections when the sync starts"""
+        return self.getconfboolean('prewarmconnections', False)
+
     def getexpunge(self):
         return self.getconfboolean('expunge', 1)
 
+    def getrewritesflags(self):
+        """Whether the server may store other flags than it is told to,
+        so that flags need to be read back from its STORE responses"""
+        return self.getconfboolean('rewritesflags', False)
+
+    def getfetchbatchsize(self):
+        """Max number of messages to fetch with one UID FETCH"""
+        return self.getconfint('fetchbatchsize', 50)
+
+    def getfetchbatchbytes(self):
+        """Max total RFC822.SIZE of messages to fetch with one UID FETCH"""
+        return self.getconfint('fetchbatchbytes', 10 * 1024 * 1024)
+
+    def getappendbatchsize(self):
+        """Max number of messages to upload with one MULTIAPPEND"""
+        return self.getconfint('appendbatchsize', 50)
+
+    def getappendbatchbytes(self):
+        """Max total size of messages to upload with one MULTIAPPEND"""
+        return self.getconfint('appendbatchbytes', 10 * 1024 * 1024)
+
+    def getcondstore(self):
+        """Use CONDSTORE/QRESYNC for incremental flag syncs if available?"""
+        return self.getconfboolean('condstore', True)
+
+    def getmodseqdir(self):
+        return self.modseqdir
+
+    def getquickstatusdir(self):
+        return self.quickstatusdir
+
+    def getfolderstatus(self, foldername):
+        """Return the current STATUS of a folder
+
+        The first call queries the STATUS of all folders at once, see
+        :meth:`_queryfolderstatus`. The values are kept until
+        :meth:`forgetfolders` is called.
+
+        :returns: dict of the MESSAGES, UIDNEXT, UIDVALIDITY and (if
+            supported) HIGHESTMODSEQ values as strings, or None if the
+            server did not tell"""
+        self._folderstatuslock.acquire()
+        try:
+            if self._folderstatus is None:
+                self._folderstatus = self._queryfolderstatus()
+        finally:
+            self._folderstatuslock.release()
+        return self._folderstatus.get(foldername)
+
+    def _queryfolderstatus(self):
+        """Get the STATUS of all folders in one round trip
+
+        Uses LIST-STATUS (RFC 5819) if available, and pipelined STATUS
+        commands otherwise and for folders LIST did not return."""
+        foldernames = [f.getfullname() for f in self.getfolders()
+                       if f.sync_this]
+        retval = {}
+        imapobj = self.imapserver.acquireconnection()
+        try:
+            items = 'MESSAGES UIDNEXT UIDVALIDITY'
+            if 'CONDSTORE' in imapobj.capabilities:
+                items += ' HIGHESTMODSEQ'
+            if 'LIST-STATUS' in imapobj.capabilities:
+                try:
+                    typ, dat = imapobj.list(self.imapserver.reference,
+                        bytearray('* RETURN (STATUS (%s))' % items))
+                except imapobj.abort:
+                    raise
+                except imapobj.error as e:
+                    self.ui.debug('imap', "LIST-STATUS failed: %s" % e)
+                else:
+                    typ, dat = imapobj.response('STATUS')
+                    for response in dat:
+                        if isinstance(response, basestring):
+                            name, status = imaputil.status2hash(response)
+                            retval[name] = status
+            missing = [name for name in foldernames if not name in retval]
+            retval.update(imapobj.multistatus(missing, '(%s)' % items))
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        return retval
+
     def getpassword(self):
         """Return the IMAP password for this repository.
 
@@ -255,11 +388,21 @@ class IMAPRepository(BaseRepository):
         return folder.IMAP.IMAPFolder
 
     def connect(self):
+        # Called when each sync starts. forgetfolders() is not called
+        # when a sync fails, so make sure that quickchanged() doesn't
+        # compare against the STATUS of the last one.
+        self._folderstatuslock.acquire()
+        self._folderstatus = None
+        self._folderstatuslock.release()
+        if self.getprewarmconnections():
+            self.imapserver.prewarm()
+            return
         imapobj = self.imapserver.acquireconnection()
         self.imapserver.releaseconnection(imapobj)
 
     def forgetfolders(self):
         self.folders = None
+        self._folderstatus = None
 
     def getfolders(self):
         if self.folders != None:
@@ -18,7 +18,10 @@
 
 from offlineimap.folder.LocalStatus import LocalStatusFolder, magicline
 from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder
+from offlineimap.folder.LocalStatusSQLiteAccount import \
+    LocalStatusSQLiteAccountFolder, AccountStatusDB
 from offlineimap.repository.Base import BaseRepository
+from threading import Lock
 import os
 import re
 
@@ -27,12 +30,18 @@ class LocalStatusRepository(BaseRepository):
         BaseRepository.__init__(self, reposname, account)
         # Root directory in which the LocalStatus folders reside
         self.root = os.path.join(account.getaccountmeta(), 'LocalStatus')
-        # statusbackend can be 'plain' or 'sqlite'
+        self._statusdb = None
+        self._statusdblock = Lock()
+        # statusbackend can be 'plain', 'sqlite' or 'sqlite-account'
         backend = self.account.getconf('status_backend', 'plain')
         if backend == 'sqlite':
             self._backend = 'sqlite'
             self.LocalStatusFolderClass = LocalStatusSQLiteFolder
             self.root += '-sqlite'
+        elif backend == 'sqlite-account':
+            self._backend = 'sqlite-account'
+            self.LocalStatusFolderClass = LocalStatusSQLiteAccountFolder
+            self.root += '-sqlite-account'
         elif backend == 'plain':
             self._backend = 'plain'
             self.LocalStatusFolderClass = LocalStatusFolder
@@ -49,6 +58,20 @@ class LocalStatusRepository(BaseRepository):
     def getsep(self):
         return '.'
 
+    def getstatusdb(self):
+        """Return the AccountStatusDB of the sqlite-account backend
+
+        Folder threads share a single one, so that there is only one
+        writer connection to the database."""
+        self._statusdblock.acquire()
+        try:
+            if self._statusdb is None:
+                self._statusdb = AccountStatusDB(
+                    os.path.join(self.root, 'status.db'), self.account)
+            return self._statusdb
+        finally:
+            self._statusdblock.release()
+
     def getfolderfilename(self, foldername):
         """Return the full path of the status file
 
@@ -67,7 +90,7 @@ class LocalStatusRepository(BaseRepository):
 
         Empty Folder for plain backend. NoOp for sqlite backend as those
         are created on demand."""
-        if self._backend == 'sqlite':
+        if self._backend != 'plain':
             return # noop for sqlite which creates on-demand
 
         if self.account.dryrun:
@@ -91,7 +114,15 @@ class LocalStatusRepository(BaseRepository):
             return self._folders
 
         self._folders = []
+        if self._backend == 'sqlite-account':
+            for folder in self.getstatusdb().getfoldernames():
+                self._folders.append(self.getfolder(folder))
+            return self._folders
         for folder in os.listdir(self.root):
+            if self._backend == 'sqlite' and \
+                    folder.endswith(('-wal', '-shm')) and \
+                    os.path.exists(os.path.join(self.root, folder[:-4])):
+                continue # SQLite WAL files of the folder db
             self._folders.append(self.getfolder(folder))
         return self._folders
 
@@ -20,9 +20,13 @@ from offlineimap import folder
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 from offlineimap.repository.Base import BaseRepository
+from offlineimap import threadutil
 import os
 from stat import *
 
+maildirspecials = set(['cur', 'new', 'tmp'])
+"""Subdirectories of every Maildir folder"""
+
 class MaildirRepository(BaseRepository):
     def __init__(self, reposname, account):
         """Initialize a MaildirRepository object.  Takes a path name
@@ -34,6 +38,13 @@ class MaildirRepository(BaseRepository):
         self.ui = getglobalui()
         self.debug("MaildirRepository initialized, sep is " + repr(self.getsep()))
         self.folder_atimes = []
+        self.scancachedir = None
+        if self.getconfboolean('scancache', True):
+            # Scan caches live next to the UIDVALIDITY cache
+            self.scancachedir = os.path.join(
+                os.path.dirname(self.getuiddir()), 'MaildirScanCache')
+            if not os.path.exists(self.scancachedir):
+                os.mkdir(self.scancachedir, 0o700)
 
         # Create the top-level folder if it doesn't exist
         if not os.path.isdir(self.root):
@@ -60,6 +71,10 @@ class MaildirRepository(BaseRepository):
             os.utime(new_dir, (new_atime, os.path.getmtime(new_dir)))
             os.utime(cur_dir, (cur_atime, os.path.getmtime(cur_dir)))
 
+    def getscancachedir(self):
+        """Directory of the folder scan caches, None if they are disabled"""
+        return self.scancachedir
+
     def getlocalroot(self):
         return os.path.expanduser(self.getconf('localfolders'))
 
@@ -133,11 +148,17 @@ class MaildirRepository(BaseRepository):
                                "folder '%s'." % foldername,
                                OfflineImapError.ERROR.FOLDER)
 
-    def _getfolders_scandir(self, root, extension = None):
+    def _getfolders_scandir(self, root, extension = None, subdirs = None):
         """Recursively scan folder 'root'; return a list of MailDirFolder
 
+        Every directory is listed once, a directory is a Maildir folder
+        if its listing contains cur, new and tmp. The subdirectories of
+        a directory are listed in parallel by 'scanthreads' threads.
+
         :param root: (absolute) path to Maildir root
-        :param extension: (relative) subfolder to examine within root"""
+        :param extension: (relative) subfolder to examine within root
+        :param subdirs: names of the directories in extension, if they
+            have been listed already"""
         self.debug("_GETFOLDERS_SCANDIR STARTING. root = %s, extension = %s" \
                    % (root, extension))
         retval = []
@@ -148,52 +169,49 @@ class MaildirRepository(BaseRepository):
         else:
             toppath = root
         self.debug("  toppath = %s" % toppath)
-
-        # Iterate over directories in top & top itself.
-        for dirname in os.listdir(toppath) + ['']:
+        if subdirs is None:
+            subdirs = folder.Maildir.listsubdirs(toppath)
+
+        # Bypass Maildir special directories
+        dirnames = [dirname for dirname in subdirs
+                    if not dirname in maildirspecials]
+        listings = threadutil.parallelmap(folder.Maildir.listsubdirs,
+            [os.path.join(toppath, dirname) for dirname in dirnames],
+            self.getconfint('scanthreads', 1))
+        for dirname, dirsubdirs in zip(dirnames, listings):
             self.debug("  dirname = %s" % dirname)
-            if dirname == '' and extension is not None:
-                self.debug('  skip this entry (already scanned)')
-                continue
-            if dirname in ['cur', 'new', 'tmp']:
-                self.debug("  skip this entry (Maildir special)")
-                # Bypass special files.
-                continue
-            fullname = os.path.join(toppath, dirname)
-            if not os.path.isdir(fullname):
-                self.debug("  skip this entry (not a directory)")
-                # Not a directory -- not a folder.
-                continue
             if extension:
                 # extension can be None which fails.
                 foldername = os.path.join(extension, dirname)
             else:
                 foldername = dirname
-
-            if (os.path.isdir(os.path.join(fullname, 'cur')) and
-                os.path.isdir(os.path.join(fullname, 'new')) and
-                os.path.isdir(os.path.join(fullname, 'tmp'))):
-                # This directory has maildir stuff -- process
-                self.debug("  This is maildir folder '%s'." % foldername)
-                if self.getconfboolean('restoreatime', False):
-                    self._append_folder_atimes(foldername)
-                retval.append(folder.Maildir.MaildirFolder(self.root,
-                                                           foldername,
-                                                           self.getsep(),
-                                                           self))
-                # filter out the folder?
-                if not self.folderfilter(foldername):
-                    self.debug("Filtering out '%s'[%s] due to folderfilt"
-                               "er" % (foldername, self))
-                    retval[-1].sync_this = False
-
-            if self.getsep() == '/' and dirname != '':
+            if maildirspecials.issubset(dirsubdirs):
+                retval.append(self._getfolderinstance(foldername))
+            if self.getsep() == '/':
                 # Recursively check sub-directories for folders too.
-                retval.extend(self._getfolders_scandir(root, foldername))
+                retval.extend(self._getfolders_scandir(root, foldername,
+                                                       dirsubdirs))
+        if extension is None and maildirspecials.issubset(subdirs):
+            # The root itself has maildir stuff
+            retval.append(self._getfolderinstance(''))
         self.debug("_GETFOLDERS_SCANDIR RETURNING %s" % \
                    repr([x.getname() for x in retval]))
         return retval
 
+    def _getfolderinstance(self, foldername):
+        """Return the MaildirFolder for an existing Maildir directory"""
+        self.debug("  This is maildir folder '%s'." % foldername)
+        if self.getconfboolean('restoreatime', False):
+            self._append_folder_atimes(foldername)
+        retval = folder.Maildir.MaildirFolder(self.root, foldername,
+                                              self.getsep(), self)
+        # filter out the folder?
+        if not self.folderfilter(foldername):
+            self.debug("Filtering out '%s'[%s] due to folderfilt"
+                       "er" % (foldername, self))
+            retval.sync_this = False
+        return retval
+
     def getfolders(self):
         if self.folders == None:
             self.folders = self._getfolders_scandir(self.root)
@@ -15,7 +15,8 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from threading import Lock, Thread, BoundedSemaphore, currentThread
+from threading import Lock, Thread, BoundedSemaphore, Condition, \
+    currentThread
 try:
     from Queue import Queue, Empty
 except ImportError: # python3
@@ -23,6 +24,7 @@ except ImportError: # python3
 import traceback
 import os.path
 import sys
+import time
 from offlineimap.ui import getglobalui
 
 ######################################################################
@@ -38,6 +40,40 @@ def semaphorereset(semaphore, originalstate):
     for i in range(originalstate):
         semaphore.release()
 
+def parallelmap(func, items, threads):
+    """Return [func(item) for item in items], using up to `threads` threads
+
+    Meant for short, I/O bound jobs like listing directories. The first
+    exception raised by func is re-raised in the calling thread."""
+    if threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    todo = Queue()
+    for i in range(len(items)):
+        todo.put(i)
+
+    def worker():
+        while not errors:
+            try:
+                i = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception as e:
+                errors.append(e)
+
+    workers = [Thread(target = worker) for i in range(min(threads,
+                                                          len(items)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
 class threadlist:
     def __init__(self):
         self.lock = Lock()
@@ -203,6 +239,7 @@ class ExitNotifyThread(Thread):
 ######################################################################
 
 instancelimitedsems = {}
+instancelimitedmax = {}
 instancelimitedlock = Lock()
 
 def initInstanceLimit(instancename, instancemax):
@@ -211,8 +248,20 @@ def initInstanceLimit(instancename, instancemax):
     instancelimitedlock.acquire()
     if not instancename in instancelimitedsems:
         instancelimitedsems[instancename] = BoundedSemaphore(instancemax)
+        instancelimitedmax[instancename] = instancemax
     instancelimitedlock.release()
 
+def getInstanceLimit(instancename):
+    """Return the number of threads permitted for instancename
+
+    Defaults to 1 if the limit has not been initialized."""
+    return instancelimitedmax.get(instancename, 1)
+
+def getInstanceSemaphore(instancename):
+    """Return the semaphore limiting instancename, or None if the limit
+    has not been initialized"""
+    return instancelimitedsems.get(instancename)
+
 class InstanceLimitedThread(ExitNotifyThread):
     def __init__(self, instancename, *args, **kwargs):
         self.instancename = instancename
@@ -228,3 +277,141 @@ class InstanceLimitedThread(ExitNotifyThread):
         finally:
             if instancelimitedsems and instancelimitedsems[self.instancename]:
                 instancelimitedsems[self.instancename].release()
+
+
+######################################################################
+# Adaptive instance limits
+######################################################################
+
+adaptivelimits = {}
+
+def initAdaptiveLimit(instancename, minimum, maximum):
+    """Let the number of threads with the given instancename that work
+    at once adapt between minimum and maximum, see :class:`AdaptiveLimit`"""
+    instancelimitedlock.acquire()
+    if not instancename in adaptivelimits:
+        adaptivelimits[instancename] = AdaptiveLimit(instancename, minimum,
+                                                     maximum)
+    instancelimitedlock.release()
+
+def getAdaptiveLimit(instancename):
+    """Return the AdaptiveLimit of instancename, or None if it has none"""
+    return adaptivelimits.get(instancename)
+
+class AdaptiveLimit(object):
+    """Limit the number of threads working at once, adapting the limit
+    to the measured throughput and latency
+
+    Threads call :meth:`acquire` before each operation and
+    :meth:`release` after it, passing how long it took and how many
+    bytes it transferred. Once as many operations as the current limit
+    completed, the limit is adapted:
+
+    - it is halved if the server throttled any of them,
+    - lowered by one if their latency, in seconds per byte so that
+      small and big operations compare, was more than slowfactor
+      times the best one seen recently,
+    - raised by one if the throughput (bytes per second) grew by more
+      than a tenth since the last time,
+    - lowered by one if the throughput fell after the last raise,
+    - and kept as it is otherwise."""
+
+    slowfactor = 3
+
+    bestaging = 1.05
+    """The best latency grows by this factor every time the limit is
+    adapted, so that one quick window doesn't count forever"""
+
+    def __init__(self, name, minimum, maximum):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = self.minimum
+        self.active = 0
+        self.cond = Condition()
+        self._lastrate = None
+        self._raised = False
+        self._bestlatency = None
+        self._startwindow()
+
+    def _startwindow(self):
+        self._start = time.time()
+        self._ops = 0
+        self._seconds = 0.0
+        self._bytes = 0
+        self._throttled = False
+
+    def acquire(self):
+        """Wait until fewer than limit threads are working"""
+        self.cond.acquire()
+        try:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+        finally:
+            self.cond.release()
+
+    def pause(self):
+        """Stop counting the calling thread as working until
+        :meth:`resume`, e.g. while it waits for another thread"""
+        self.cond.acquire()
+        try:
+            self.active -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def resume(self):
+        """Count the calling thread as working again after :meth:`pause`"""
+        self.acquire()
+
+    def release(self, seconds, nbytes=0, throttled=False):
+        """Record an operation that has finished
+
+        :param seconds: how long the operation took
+        :param nbytes: number of bytes it transferred
+        :param throttled: whether the server throttled it"""
+        self.cond.acquire()
+        try:
+            self.active -= 1
+            self._ops += 1
+            self._seconds += seconds
+            self._bytes += nbytes
+            self._throttled = self._throttled or throttled
+            if self._ops >= self.limit:
+                self._adapt()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _adapt(self):
+        latency = None
+        if self._bytes:
+            latency = self._seconds / self._bytes
+        rate = self._bytes / max(time.time() - self._start, 0.001)
+        limit = self.limit
+        if self._throttled:
+            limit = max(self.minimum, limit // 2)
+            reason = 'throttled by server'
+        elif latency is not None and self._bestlatency is not None and \
+                latency > self.slowfactor * self._bestlatency:
+            limit = max(self.minimum, limit - 1)
+            reason = 'latency %.2fs/MB' % (latency * 1024 * 1024)
+        elif self._lastrate is None or rate > self._lastrate * 1.1:
+            limit = min(self.maximum, limit + 1)
+            reason = 'throughput %d bytes/s' % rate
+        elif self._raised and rate < self._lastrate:
+            limit = max(self.minimum, limit - 1)
+            reason = 'throughput %d bytes/s' % rate
+        if latency is not None and (self._bestlatency is None or
+                                    latency < self._bestlatency):
+            self._bestlatency = latency
+        elif self._bestlatency is not None:
+            self._bestlatency *= self.bestaging
+        self._raised = limit > self.limit
+        self._lastrate = rate
+        if limit != self.limit:
+            getglobalui().debug('thread', "%s: %d threads at once (%s)" %
+                                (self.name, limit, reason))
+            self.limit = limit
+        self._startwindow()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Benchmark the plain text LocalStatus backend
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Time the status updates of a first sync of an N message folder
+
+Every copied message results in one LocalStatusFolder.savemessage()
+call. With an append-only journal the total time should grow linearly
+with N. Run from the top source dir:
+
+  python test/benchmarks/bench_localstatus.py [N ...]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.folder.LocalStatus import LocalStatusFolder
+
+
+class BenchRepository(object):
+    """Just enough of a LocalStatusRepository for LocalStatusFolder"""
+    accountname = 'bench'
+
+    def __init__(self, root):
+        self.root = root
+        self.config = CustomConfigParser()
+
+    def getconfig(self):
+        return self.config
+
+    def nametrans(self, name):
+        return name
+
+
+def first_sync(root, count):
+    """Simulate the status updates of copying count new messages
+
+    :returns: seconds taken"""
+    folder = LocalStatusFolder('INBOX', BenchRepository(root))
+    folder.cachemessagelist()
+    start = time.time()
+    for uid in xrange(1, count + 1):
+        folder.savemessage(uid, None, set('S'), None)
+    folder.save()
+    elapsed = time.time() - start
+    # make sure we can read back what we wrote
+    folder.cachemessagelist()
+    assert folder.getmessagecount() == count
+    os.unlink(folder.getfullname())
+    return elapsed
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [12500, 25000, 50000, 100000]
+    root = tempfile.mkdtemp(prefix='offlineimap-bench-')
+    try:
+        for count in counts:
+            elapsed = first_sync(root, count)
+            print("%7d messages: %7.3fs (%.1f us/message)" % (
+                    count, elapsed, elapsed / count * 1e6))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Benchmark the memory used by message lists
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Compare the memory of an N message Maildir message list
+
+Builds the list as the dict of per-message dicts the backends used to
+keep and as a MessageList, each in a child process, and reports how
+much the peak RSS grew. Linux only. Run from the top source dir:
+
+  python test/benchmarks/bench_messagelist.py [N ...]
+"""
+import os
+import resource
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+from offlineimap.folder.MessageList import MessageList
+
+
+def messages(count):
+    """Yields (uid, message) like a Maildir scan does"""
+    for uid in xrange(1, count + 1):
+        yield (uid, {'flags': set('RS' if uid % 3 else 'S'),
+                     'filename': 'cur/1350000000_%d.host,U=%d,'
+                                 'FMD5=7e33429f656f1e6e9d79b29c3f82c57e:2,S' %
+                                 (uid, uid)})
+
+
+def build_dict(count):
+    return dict(messages(count))
+
+
+def build_messagelist(count):
+    return MessageList(messages(count))
+
+
+def measure(build, count):
+    """Build a message list in a child process
+
+    :returns: (seconds taken, MB the peak RSS grew by)"""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        messagelist = build(count)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        assert len(messagelist) == count
+        os.write(write, '%f %d' % (elapsed, after - before))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 100)
+    os.close(read)
+    os.waitpid(pid, 0)
+    elapsed, kbytes = result.split()
+    return float(elapsed), int(kbytes) / 1024.0
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [100000, 1000000]
+    for count in counts:
+        for name, build in (('dict', build_dict),
+                            ('MessageList', build_messagelist)):
+            elapsed, mbytes = measure(build, count)
+            print("%7d messages: %-11s %7.1f MB %7.3fs" % (
+                    count, name, mbytes, elapsed))
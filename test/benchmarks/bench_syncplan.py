@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Benchmark working out what a folder sync needs to do
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Time the diffing of an N message folder against its status folder
+
+Compares the per-UID filter()/uidexists() scans the sync passes used
+to do with BaseFolder.getsyncplan(), for a folder where 1% of the
+messages are new, 1% were deleted and 1% had their flags changed.
+Both must come to the same result. Run from the top source dir:
+
+  python test/benchmarks/bench_syncplan.py [N ...]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+from offlineimap.folder.Base import BaseFolder
+from offlineimap.folder.MessageList import MessageList
+
+
+class BenchFolder(BaseFolder):
+    """A folder with nothing but a message list"""
+
+    def __init__(self, messagelist):
+        # BaseFolder.__init__ wants a repository, which we don't need
+        self.messagelist = MessageList(messagelist)
+
+    def getmessagelist(self):
+        return self.messagelist
+
+    def getmessageflags(self, uid):
+        return self.messagelist.getmessageflags(uid)
+
+
+def make_folders(count):
+    """:returns: (folder, dstfolder, statusfolder) of about count messages"""
+    src, status = {}, {}
+    for uid in xrange(1, count + 1):
+        if uid % 100 != 1:
+            src[uid] = {'uid': uid, 'flags': set('S')}
+        if uid % 100 != 2:
+            flags = set('SF') if uid % 100 == 3 else set('S')
+            status[uid] = {'uid': uid, 'flags': flags}
+    dst = dict(status)
+    return BenchFolder(src), BenchFolder(dst), BenchFolder(status)
+
+
+def legacy_plan(self, dstfolder, statusfolder):
+    """What the sync passes used to compute, one UID at a time"""
+    copy = filter(lambda uid: not statusfolder.uidexists(uid),
+                  self.getmessageuidlist())
+    delete = filter(lambda uid: uid >= 0 and not self.uidexists(uid),
+                    statusfolder.getmessageuidlist())
+    flags = {}
+    for uid in self.getmessageuidlist():
+        if uid < 0 or not dstfolder.uidexists(uid):
+            continue
+        selfflags = self.getmessageflags(uid)
+        statusflags = statusfolder.getmessageflags(uid)
+        if statusflags is None:
+            statusflags = set()
+        addflags = selfflags - statusflags
+        delflags = statusflags - selfflags
+        if addflags or delflags:
+            flags[uid] = (addflags, delflags)
+    return sorted(copy), sorted(delete), flags
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+if __name__ == '__main__':
+    counts = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    for count in counts:
+        folders = make_folders(count)
+        legacy, expected = timed(legacy_plan, *folders)
+        setbased, plan = timed(BaseFolder.getsyncplan, *folders)
+        assert (plan.copy, plan.delete, plan.flags) == expected
+        print("%7d messages: per-UID %7.3fs, set-based %7.3fs (%.1fx)" % (
+                count, legacy, setbased, legacy / max(setbased, 1e-6)))
@@ -97,3 +97,46 @@ class TestInternalFunctions(unittest.TestCase):
         """Test imaputil.uid_sequence()"""
         res = imaputil.uid_sequence([1,2,3,4,5,10,12,13])
         self.assertEqual(res, b'1:5,10,12:13')
+
+    def test_08_uid_sequence_expand(self):
+        """Test imaputil.uid_sequence_expand()"""
+        res = imaputil.uid_sequence_expand(b'1:5,10,13:12')
+        self.assertEqual(res, [1,2,3,4,5,10,12,13])
+        res = imaputil.uid_sequence_expand(imaputil.uid_sequence([7,3,4]))
+        self.assertEqual(res, [3,4,7])
+
+    def test_09_status2hash(self):
+        """Test imaputil.status2hash()"""
+        res = imaputil.status2hash(b'"Sent Items" (MESSAGES 3 UIDNEXT 8)')
+        self.assertEqual(res, (b'Sent Items',
+                               {b'MESSAGES': b'3', b'UIDNEXT': b'8'}))
+        res = imaputil.status2hash(b'INBOX (UIDVALIDITY 42)')
+        self.assertEqual(res, (b'INBOX', {b'UIDVALIDITY': b'42'}))
+
+    def test_10_linechunks(self):
+        """Test imaputil.linechunks() with CRLFs split between chunks"""
+        content = b'a\r\nb\nc\r\n\r\nd\re\n' * 3
+        chunksize = imaputil.MESSAGE_CHUNK_SIZE
+        imaputil.MESSAGE_CHUNK_SIZE = 2
+        try:
+            spool = imaputil.spoolmessage([content])
+            self.assertEqual(b''.join(imaputil.linechunks(spool)),
+                             content.replace(b'\r\n', b'\n'))
+            self.assertEqual(b''.join(imaputil.linechunks(spool, True)),
+                             b'a\r\nb\r\nc\r\n\r\nd\re\r\n' * 3)
+            self.assertEqual(imaputil.messagesize(spool), len(content))
+        finally:
+            imaputil.MESSAGE_CHUNK_SIZE = chunksize
+
+    def test_11_isthrottled(self):
+        """Test imaputil.isthrottled()"""
+        self.assertTrue(imaputil.isthrottled(b'[THROTTLED] Slow down'))
+        self.assertTrue(imaputil.isthrottled(b'Request is throttled.'))
+        self.assertTrue(imaputil.isthrottled(b'[UNAVAILABLE] Try again later'))
+        self.assertFalse(imaputil.isthrottled(b'[TRYCREATE] No such folder'))
+
+    def test_12_uid_sequences(self):
+        """Test imaputil.uid_sequences()"""
+        res = imaputil.uid_sequences([1,2,3,4,5,10,12,13,20], 8)
+        self.assertEqual(res, [b'1:5,10', b'12:13,20'])
+        self.assertEqual(imaputil.uid_sequences([], 8), [])
@@ -0,0 +1,66 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+
+from offlineimap.folder import MessageList as messagelist
+from offlineimap.folder.MessageList import MessageList
+
+
+class TestMessageList(unittest.TestCase):
+    """Tests for the compact message list of the folder backends"""
+
+    def test_01_messagelist(self):
+        """Test MessageList against the dict it replaces"""
+        ml = MessageList({5: {'uid': 5, 'flags': set('S')}})
+        ml[-1] = {'flags': set('Fx'), 'filename': 'new/a'}
+        ml[9] = {'uid': 9, 'flags': set(), 'time': 42}
+        ml[9]['flags'] |= set('R')
+        ml[5]['size'] = 7
+        self.assertEqual(ml.keys(), [-1, 5, 9])
+        self.assertEqual(ml.getmessageflags(-1), set('Fx'))
+        self.assertEqual(ml[9].copy(), {'uid': 9, 'flags': set('R'),
+                                        'time': 42})
+        self.assertEqual(ml[5].get('time', 0), 0)
+        self.assertEqual(ml[5]['size'], 7)
+        self.assertEqual(list(ml.iterflags()), [(-1, set('Fx')),
+                                                (5, set('S')), (9, set('R'))])
+        del ml[5]
+        self.assertFalse(ml.uidexists(5))
+        self.assertEqual(ml.pop(5, None), None)
+        self.assertEqual(len(ml), 2)
+
+    def test_02_largeuids(self):
+        """Test UIDs that don't fit into 32 bits, next to negative ones"""
+        uids = [-2, -1, 1, 2**31 - 1, 2**31, 2**32 - 1]
+        ml = MessageList((uid, {'flags': set('S')}) for uid in uids[2:])
+        ml[-2] = {'flags': set()}
+        ml[-1] = {'flags': set('R')}
+        self.assertEqual(ml.keys(), uids)
+        self.assertEqual([uid for uid, flags in ml.iterflags()], uids)
+        self.assertTrue(ml.uidexists(2**32 - 1))
+        self.assertEqual(ml.getmessageflags(2**31), set('S'))
+
+    def test_03_merge(self):
+        """Test merging many out of order messages and deletes"""
+        ml = MessageList()
+        uids = range(2 * messagelist.MERGE_MIN, 0, -1)
+        for uid in uids:
+            ml[uid] = {'flags': set('S'), 'filename': str(uid)}
+        for uid in uids[::2]:
+            del ml[uid]
+        self.assertEqual(ml.keys(), sorted(uids[1::2]))
+        self.assertEqual(ml[1]['filename'], '1')
+        self.assertEqual(len(ml), messagelist.MERGE_MIN)